@@ -1,1705 +1,3454 @@
-import streamlit as st
-import pandas as pd
-import plotly.express as px
-from datetime import datetime
-from collections import OrderedDict
-import random
-import io
-import re
-import sys
-
-st.set_page_config(page_title="MRP System Dashboard", layout="wide")
-
-# --- Session State Initialization ---
-if 'rm_stock' not in st.session_state:
-    st.session_state.rm_stock = pd.DataFrame(columns=['RM Code', 'Quantity'])
-if 'rm_po' not in st.session_state:
-    st.session_state.rm_po = pd.DataFrame(columns=['RM Code', 'Quantity', 'Arrival Date'])
-if 'fg_formulas' not in st.session_state:
-    st.session_state.fg_formulas = pd.DataFrame(columns=['FG Code', 'RM Code', 'Quantity'])
-if 'fg_analysis_order' not in st.session_state:
-    st.session_state.fg_analysis_order = OrderedDict()
-if 'fg_expected_capacity' not in st.session_state:
-    st.session_state.fg_expected_capacity = {}
-if 'calculation_margin' not in st.session_state:
-    st.session_state.calculation_margin = 3
-if 'fg_colors' not in st.session_state:
-    st.session_state.fg_colors = {}
-if 'analysis_completed' not in st.session_state:
-    st.session_state.analysis_completed = False
-if 'select_all_trigger' not in st.session_state:
-    st.session_state.select_all_trigger = False
-if 'multiselect_key' not in st.session_state:
-    st.session_state.multiselect_key = 0
-
-st.title("🏭 Localhost MRP Dashboard")
-
-tab1, tab2, tab3 = st.tabs(["📦 Stock & PO Management", "🧪 FG Formulas & Settings", "📊 Production Planning"])
-
-# Function to generate or get color for FG code
-def get_fg_color(fg_code):
-    if fg_code not in st.session_state.fg_colors:
-        colors_list = [
-            '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
-            '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
-            '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5',
-            '#c49c94', '#f7b6d2', '#c7c7c7', '#dbdb8d', '#9edae5'
-        ]
-        color = colors_list[len(st.session_state.fg_colors) % len(colors_list)]
-        st.session_state.fg_colors[fg_code] = color
-    return st.session_state.fg_colors[fg_code]
-
-# Function to generate HTML report (fallback if PDF fails)
-def generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status):
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>MRP Production Planning Summary Report</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; }}
-            .header {{ text-align: center; margin-bottom: 30px; }}
-            .title {{ font-size: 24px; font-weight: bold; color: #333; }}
-            .subtitle {{ font-size: 14px; color: #666; margin-top: 10px; }}
-            .section {{ margin: 20px 0; }}
-            .section-title {{ font-size: 18px; font-weight: bold; color: #2c3e50; border-bottom: 2px solid #3498db; padding-bottom: 5px; margin-bottom: 15px; }}
-            table {{ width: 100%; border-collapse: collapse; margin: 10px 0; }}
-            th {{ background-color: #3498db; color: white; padding: 10px; text-align: left; }}
-            td {{ padding: 8px; border: 1px solid #ddd; }}
-            tr:nth-child(even) {{ background-color: #f2f2f2; }}
-            .metric {{ display: inline-block; margin: 10px 20px 10px 0; padding: 10px; background-color: #ecf0f1; border-radius: 5px; }}
-            .metric-label {{ font-weight: bold; color: #7f8c8d; }}
-            .metric-value {{ font-size: 18px; color: #2c3e50; }}
-            .status-ready {{ color: #27ae60; font-weight: bold; }}
-            .status-shortage {{ color: #e74c3c; font-weight: bold; }}
-            .footer {{ margin-top: 40px; text-align: center; color: #7f8c8d; font-size: 12px; border-top: 1px solid #ddd; padding-top: 20px; }}
-            .company-footer {{ margin-top: 30px; text-align: center; color: #3498db; font-weight: bold; font-size: 14px; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <div class="title">MRP Production Planning Summary Report</div>
-            <div class="subtitle">Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
-            <div class="subtitle">Production Date: {prod_date.strftime('%d/%m/%Y')}</div>
-        </div>
-        
-        <div class="section">
-            <div class="section-title">Summary Metrics</div>
-            <div class="metric">
-                <div class="metric-label">Planned Production Date</div>
-                <div class="metric-value">{prod_date.strftime('%d/%m/%Y')}</div>
-            </div>
-            <div class="metric">
-                <div class="metric-label">Producible FG Types</div>
-                <div class="metric-value">{len(ready_fgs)}</div>
-            </div>
-            <div class="metric">
-                <div class="metric-label">Total Production Volume</div>
-                <div class="metric-value">{total_volume:,.1f} Kg</div>
-            </div>
-            <div class="metric">
-                <div class="metric-label">Delayed Purchase Orders</div>
-                <div class="metric-value">{delayed_pos}</div>
-            </div>
-        </div>
-    """
-    
-    # Production Capability List
-    if results:
-        html_content += """
-        <div class="section">
-            <div class="section-title">Production Capability List</div>
-            <table>
-                <tr>
-                    <th>FG Code</th>
-                    <th>Expected</th>
-                    <th>Max (Kg)</th>
-                    <th>Actual (Kg)</th>
-                    <th>Status</th>
-                    <th>Missing RM</th>
-                    <th>Batches</th>
-                </tr>
-        """
-        
-        for item in results:
-            status_class = "status-ready" if "✅" in item['Status'] else "status-shortage"
-            html_content += f"""
-                <tr>
-                    <td>{item['FG']}</td>
-                    <td>{item['Expected']}</td>
-                    <td>{item['Max']}</td>
-                    <td>{item['Actual']}</td>
-                    <td class="{status_class}">{item['Status']}</td>
-                    <td>{item['Missing']}</td>
-                    <td>{item['Batches']}</td>
-                </tr>
-            """
-        
-        html_content += """
-            </table>
-        </div>
-        """
-    
-    # Shortage Details
-    shortage_exists = False
-    for fg in shortage_details:
-        if shortage_details[fg]:
-            shortage_exists = True
-            break
-    
-    if shortage_exists:
-        html_content += """
-        <div class="section">
-            <div class="section-title">Shortage Details</div>
-        """
-        
-        for fg in shortage_details:
-            if shortage_details[fg]:
-                html_content += f"""
-                <div style="margin: 15px 0;">
-                    <div style="font-weight: bold; color: #e74c3c;">FG Code: {fg}</div>
-                    <ul style="margin: 5px 0 20px 20px;">
-                """
-                
-                for item in shortage_details[fg]:
-                    html_content += f"<li>{item}</li>"
-                
-                html_content += """
-                    </ul>
-                </div>
-                """
-        
-        html_content += """
-        </div>
-        """
-    
-    # PO Delay Tracker
-    if po_status is not None and not po_status.empty:
-        html_content += """
-        <div class="section">
-            <div class="section-title">Purchase Order Delay Status</div>
-            <table>
-                <tr>
-                    <th>RM Code</th>
-                    <th>Quantity</th>
-                    <th>Arrival Date</th>
-                    <th>Status</th>
-                </tr>
-        """
-        
-        for _, row in po_status.iterrows():
-            status_class = "status-shortage" if row['Status'] == 'Delayed' else ""
-            arrival_date = row['Arrival Date']
-            arrival_str = arrival_date.strftime('%d/%m/%Y') if hasattr(arrival_date, 'strftime') else str(arrival_date)
-            
-            html_content += f"""
-                <tr>
-                    <td>{row['RM Code']}</td>
-                    <td>{row['Quantity']:,.4f} Kg</td>
-                    <td>{arrival_str}</td>
-                    <td class="{status_class}">{row['Status']}</td>
-                </tr>
-            """
-        
-        html_content += """
-            </table>
-        </div>
-        """
-    
-    # Settings Information
-    html_content += f"""
-        <div class="section">
-            <div class="section-title">System Settings</div>
-            <div style="margin: 10px 0;">
-                • Decimal Precision: {st.session_state.calculation_margin} places<br>
-                • FIFO Order: {', '.join(st.session_state.fg_analysis_order.keys()) if st.session_state.fg_analysis_order else 'Not set'}<br>
-                • Report Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            </div>
-        </div>
-        
-        <div class="company-footer">
-            RGI - Supply Chain Department
-        </div>
-        
-        <div class="footer">
-            Report generated by MRP Dashboard System<br>
-            --- End of Report ---
-        </div>
-    </body>
-    </html>
-    """
-    
-    return html_content
-
-# Function to generate PDF report
-def generate_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status):
-    try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.lib import colors
-        
-        buffer = io.BytesIO()
-        
-        doc = SimpleDocTemplate(buffer, pagesize=A4, 
-                              rightMargin=72, leftMargin=72,
-                              topMargin=72, bottomMargin=72)
-        
-        elements = []
-        styles = getSampleStyleSheet()
-        
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=18,
-            spaceAfter=30,
-            alignment=1
-        )
-        
-        heading_style = ParagraphStyle(
-            'CustomHeading',
-            parent=styles['Heading2'],
-            fontSize=14,
-            spaceAfter=12,
-            spaceBefore=12
-        )
-        
-        normal_style = styles['Normal']
-        
-        elements.append(Paragraph("MRP Production Planning Summary Report", title_style))
-        elements.append(Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", normal_style))
-        elements.append(Paragraph(f"Production Date: {prod_date.strftime('%d/%m/%Y')}", normal_style))
-        elements.append(Spacer(1, 20))
-        
-        elements.append(Paragraph("Summary Metrics", heading_style))
-        
-        summary_data = [
-            ["Metric", "Value"],
-            ["Planned Production Date", prod_date.strftime('%d/%m/%Y')],
-            ["Producible FG Types", str(len(ready_fgs))],
-            ["Total Production Volume", f"{total_volume:,.1f} Kg"],
-            ["Delayed Purchase Orders", str(delayed_pos)]
-        ]
-        
-        summary_table = Table(summary_data, colWidths=[200, 150])
-        summary_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-        elements.append(summary_table)
-        elements.append(Spacer(1, 20))
-        
-        elements.append(Paragraph("Production Capability List", heading_style))
-        
-        if results:
-            table_data = [["FG Code", "Expected", "Max (Kg)", "Actual (Kg)", "Status", "Missing RM", "Batches"]]
-            
-            for item in results:
-                table_data.append([
-                    item['FG'],
-                    item['Expected'],
-                    item['Max'],
-                    item['Actual'],
-                    item['Status'],
-                    item['Missing'],
-                    str(item['Batches'])
-                ])
-            
-            prod_table = Table(table_data, colWidths=[70, 60, 60, 60, 60, 70, 50])
-            prod_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('FONTSIZE', (0, 1), (-1, -1), 9),
-            ]))
-            elements.append(prod_table)
-            elements.append(Spacer(1, 20))
-        
-        shortage_exists = False
-        for fg in shortage_details:
-            if shortage_details[fg]:
-                shortage_exists = True
-                break
-        
-        if shortage_exists:
-            elements.append(Paragraph("Shortage Details", heading_style))
-            
-            for fg in shortage_details:
-                if shortage_details[fg]:
-                    elements.append(Paragraph(f"FG Code: {fg}", styles['Heading3']))
-                    for item in shortage_details[fg]:
-                        elements.append(Paragraph(f"• {item}", normal_style))
-                    elements.append(Spacer(1, 10))
-            elements.append(Spacer(1, 20))
-        
-        if po_status is not None and not po_status.empty:
-            elements.append(Paragraph("Purchase Order Delay Status", heading_style))
-            
-            po_data = [["RM Code", "Quantity", "Arrival Date", "Status"]]
-            
-            for _, row in po_status.iterrows():
-                arrival_date = row['Arrival Date']
-                arrival_str = arrival_date.strftime('%d/%m/%Y') if hasattr(arrival_date, 'strftime') else str(arrival_date)
-                    
-                po_data.append([
-                    str(row['RM Code']),
-                    f"{row['Quantity']:,.4f} Kg",
-                    arrival_str,
-                    row['Status']
-                ])
-            
-            po_table = Table(po_data, colWidths=[80, 80, 80, 80])
-            po_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('FONTSIZE', (0, 1), (-1, -1), 9),
-            ]))
-            elements.append(po_table)
-            elements.append(Spacer(1, 20))
-        
-        elements.append(Paragraph("System Settings", heading_style))
-        settings_text = f"""
-        • Decimal Precision: {st.session_state.calculation_margin} places
-        • FIFO Order: {', '.join(st.session_state.fg_analysis_order.keys()) if st.session_state.fg_analysis_order else 'Not set'}
-        • Report Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-        """
-        elements.append(Paragraph(settings_text, normal_style))
-        
-        elements.append(Spacer(1, 30))
-        elements.append(Paragraph("RGI - Supply Chain Department", ParagraphStyle(
-            'CompanyFooter',
-            parent=styles['Normal'],
-            fontSize=12,
-            alignment=1,
-            textColor=colors.HexColor('#3498db'),
-            spaceBefore=20
-        )))
-        
-        elements.append(Spacer(1, 10))
-        elements.append(Paragraph("Report generated by MRP Dashboard System", ParagraphStyle(
-            'Footer',
-            parent=styles['Normal'],
-            fontSize=10,
-            alignment=1,
-            textColor=colors.grey
-        )))
-        elements.append(Paragraph("--- End of Report ---", ParagraphStyle(
-            'Footer',
-            parent=styles['Normal'],
-            fontSize=10,
-            alignment=1,
-            textColor=colors.grey
-        )))
-        
-        doc.build(elements)
-        
-        pdf_data = buffer.getvalue()
-        buffer.close()
-        
-        return pdf_data, "pdf"
-    
-    except ImportError:
-        html_content = generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status)
-        return html_content.encode('utf-8'), "html"
-    except Exception as e:
-        st.error(f"PDF generation error: {str(e)}")
-        html_content = generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status)
-        return html_content.encode('utf-8'), "html"
-
-# NEW: Improved function to generate missing RM data based on Expected Capacities
-def generate_missing_rm_summary_from_results(results, shortage_details, fg_expected_capacity, fg_formulas, calculation_margin):
-    """Generate missing RM summary based on actual production results and expected capacities"""
-    missing_data = []
-    
-    # First, create a dictionary of actual production for each FG
-    fg_production = {}
-    for item in results:
-        fg_code = item['FG']
-        # Extract actual capacity from the string "X,XXX.X Kg"
-        actual_str = item['Actual'].replace(' Kg', '').replace(',', '')
-        try:
-            actual_capacity = float(actual_str)
-            fg_production[fg_code] = actual_capacity
-        except:
-            fg_production[fg_code] = 0
-    
-    # Process each FG that has shortage details
-    for fg_code, shortage_items in shortage_details.items():
-        if not shortage_items:
-            continue
-            
-        # Get expected capacity for this FG
-        expected_capacity = fg_expected_capacity.get(fg_code, 0)
-        actual_capacity = fg_production.get(fg_code, 0)
-        
-        # Calculate batches based on actual production (not expected)
-        actual_batches = int(actual_capacity // 25) if actual_capacity >= 25 else 0
-        
-        # Get formula for this FG
-        formula = fg_formulas[fg_formulas['FG Code'] == fg_code]
-        if formula.empty:
-            continue
-        
-        for item in shortage_items:
-            if "Shortage" in item:
-                try:
-                    # Extract RM Code
-                    rm_code = item.split(":")[0].strip()
-                    
-                    # Find this RM in the formula
-                    rm_row = formula[formula['RM Code'] == rm_code]
-                    if rm_row.empty:
-                        continue
-                    
-                    req_per_batch = float(rm_row['Quantity'].iloc[0])
-                    
-                    # Parse the shortage string
-                    # Format: "RM123: Required X.XXXX Kg, Available Y.YYYY Kg, Shortage Z.ZZZZ Kg"
-                    shortage_match = re.search(r'Shortage ([\d.]+)', item)
-                    if shortage_match:
-                        shortage_qty = float(shortage_match.group(1))
-                        
-                        # Calculate total required based on what we tried to produce
-                        # If expected capacity > 0, use that to calculate required
-                        if expected_capacity > 0:
-                            expected_batches = max(1, int(expected_capacity // 25))
-                            total_required = req_per_batch * expected_batches
-                        else:
-                            # If no expected capacity, use maximum possible
-                            total_required = req_per_batch * actual_batches if actual_batches > 0 else 0
-                        
-                        # Get available from stock (required - shortage)
-                        available_qty = total_required - shortage_qty if total_required > shortage_qty else 0
-                        
-                        missing_data.append({
-                            'FG Code': fg_code,
-                            'RM Code': rm_code,
-                            'Expected Capacity (Kg)': expected_capacity,
-                            'Actual Production (Kg)': actual_capacity,
-                            'Required per Batch (Kg)': round(req_per_batch, calculation_margin),
-                            'Total Required (Kg)': round(total_required, calculation_margin),
-                            'Available (Kg)': round(available_qty, calculation_margin),
-                            'Shortage (Kg)': round(shortage_qty, calculation_margin)
-                        })
-                except Exception as e:
-                    # If parsing fails, skip this item
-                    continue
-    
-    if missing_data:
-        # Create detailed DataFrame
-        detailed_df = pd.DataFrame(missing_data)
-        
-        # Create summary DataFrame (group by RM Code)
-        if not detailed_df.empty:
-            summary_data = []
-            for rm_code in detailed_df['RM Code'].unique():
-                rm_rows = detailed_df[detailed_df['RM Code'] == rm_code]
-                total_shortage = rm_rows['Shortage (Kg)'].sum()
-                total_required = rm_rows['Total Required (Kg)'].sum()
-                total_available = rm_rows['Available (Kg)'].sum()
-                affected_fgs = ', '.join(rm_rows['FG Code'].unique())
-                
-                summary_data.append({
-                    'RM Code': rm_code,
-                    'Total Required (Kg)': round(total_required, calculation_margin),
-                    'Total Available (Kg)': round(total_available, calculation_margin),
-                    'Total Shortage (Kg)': round(total_shortage, calculation_margin),
-                    'Affected FG Codes': affected_fgs,
-                    'Number of Affected FGs': len(rm_rows['FG Code'].unique())
-                })
-            
-            summary_df = pd.DataFrame(summary_data)
-            return detailed_df, summary_df
-    
-    return pd.DataFrame(), pd.DataFrame()
-
-# Function to generate Excel file with multiple sheets
-def generate_missing_rm_excel(detailed_df, summary_df, shortage_details, results, prod_date):
-    """Generate Excel file with multiple sheets for missing RM analysis"""
-    output = io.BytesIO()
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Sheet 1: Detailed Missing RM by FG
-        if not detailed_df.empty:
-            detailed_df.to_excel(writer, sheet_name='Missing RM Detailed', index=False)
-        
-        # Sheet 2: Summary by RM Code
-        if not summary_df.empty:
-            summary_df.to_excel(writer, sheet_name='Missing RM Summary', index=False)
-        
-        # Sheet 3: FG Production Status
-        if results:
-            status_df = pd.DataFrame(results)
-            status_df.to_excel(writer, sheet_name='FG Production Status', index=False)
-        
-        # Sheet 4: Raw Shortage Details
-        shortage_list = []
-        for fg_code, items in shortage_details.items():
-            for item in items:
-                shortage_list.append({
-                    'FG Code': fg_code,
-                    'Shortage Details': item
-                })
-        
-        if shortage_list:
-            shortage_raw_df = pd.DataFrame(shortage_list)
-            shortage_raw_df.to_excel(writer, sheet_name='Raw Shortage Data', index=False)
-    
-    output.seek(0)
-    return output
-
-# Function to generate All Missing RM Report
-def generate_all_missing_rm_report(detailed_df, summary_df, prod_date):
-    """Generate a comprehensive Excel report with all missing RM data"""
-    output = io.BytesIO()
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Sheet 1: Executive Summary
-        exec_summary = pd.DataFrame({
-            'Report Type': ['Missing RM Analysis Report'],
-            'Production Date': [prod_date.strftime('%Y-%m-%d')],
-            'Report Generated': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
-            'Total Missing RM Types': [len(summary_df) if not summary_df.empty else 0],
-            'Total Shortage Quantity (Kg)': [summary_df['Total Shortage (Kg)'].sum() if not summary_df.empty else 0],
-            'Total Affected FGs': [len(set(detailed_df['FG Code'])) if not detailed_df.empty else 0]
-        })
-        exec_summary.to_excel(writer, sheet_name='Executive Summary', index=False)
-        
-        # Sheet 2: RM Summary (Priority View)
-        if not summary_df.empty:
-            priority_summary = summary_df.copy()
-            priority_summary = priority_summary.sort_values('Total Shortage (Kg)', ascending=False)
-            priority_summary['Priority'] = range(1, len(priority_summary) + 1)
-            priority_summary = priority_summary[['Priority', 'RM Code', 'Total Shortage (Kg)', 
-                                                'Total Required (Kg)', 'Total Available (Kg)', 
-                                                'Number of Affected FGs', 'Affected FG Codes']]
-            priority_summary.to_excel(writer, sheet_name='RM Priority List', index=False)
-        
-        # Sheet 3: Detailed FG Breakdown
-        if not detailed_df.empty:
-            detailed_sorted = detailed_df.sort_values(['RM Code', 'FG Code'])
-            detailed_sorted.to_excel(writer, sheet_name='Detailed Analysis', index=False)
-        
-        # Sheet 4: Action Required
-        if not summary_df.empty:
-            action_items = []
-            for _, row in summary_df.iterrows():
-                action_items.append({
-                    'RM Code': row['RM Code'],
-                    'Shortage (Kg)': row['Total Shortage (Kg)'],
-                    'Action Required': f"Procure {row['Total Shortage (Kg)']:,.4f} Kg of {row['RM Code']}",
-                    'Priority': 'High' if row['Total Shortage (Kg)'] > 100 else 'Medium' if row['Total Shortage (Kg)'] > 50 else 'Low',
-                    'Affected Production': f"{row['Number of Affected FGs']} FG(s): {row['Affected FG Codes']}"
-                })
-            action_df = pd.DataFrame(action_items)
-            action_df.to_excel(writer, sheet_name='Action Items', index=False)
-    
-    output.seek(0)
-    return output
-
-# NEW: Function to generate shortage details table for Excel export
-def generate_shortage_details_table(shortage_details, calculation_margin):
-    """Generate a table with FG code, RM code, Required, and Available columns from shortage details"""
-    shortage_data = []
-    
-    for fg_code, items in shortage_details.items():
-        for item in items:
-            if "Shortage" in item or "Required" in item:
-                try:
-                    # Parse the item string
-                    # Format examples:
-                    # "RM123: Required 100.0000 Kg for 4 batches, Available 50.0000 Kg, Shortage 50.0000 Kg"
-                    # "RM123: Required 25.0000 Kg per batch, Available 0.0000 Kg, Shortage 25.0000 Kg"
-                    
-                    # Extract RM Code
-                    rm_code = item.split(":")[0].strip()
-                    
-                    # Extract Required quantity
-                    required_match = re.search(r'Required ([\d.]+)', item)
-                    required_qty = float(required_match.group(1)) if required_match else 0
-                    
-                    # Extract Available quantity
-                    available_match = re.search(r'Available ([\d.]+)', item)
-                    available_qty = float(available_match.group(1)) if available_match else 0
-                    
-                    shortage_data.append({
-                        'FG Code': fg_code,
-                        'RM Code': rm_code,
-                        'Required (Kg)': round(required_qty, calculation_margin),
-                        'Available (Kg)': round(available_qty, calculation_margin),
-                        'Shortage (Kg)': round(required_qty - available_qty, calculation_margin)
-                    })
-                except Exception as e:
-                    # If parsing fails, skip this item
-                    continue
-    
-    if shortage_data:
-        return pd.DataFrame(shortage_data)
-    else:
-        return pd.DataFrame(columns=['FG Code', 'RM Code', 'Required (Kg)', 'Available (Kg)', 'Shortage (Kg)'])
-
-# Function to add footer to all tabs
-def add_footer():
-    st.markdown("---")
-    st.markdown(
-        """
-        <div style="text-align: center; color: #666; font-size: 12px; padding: 10px;">
-            <strong>RGI - Supply Chain Department</strong> | MRP Dashboard System
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
-
-# --- PAGE 1: STOCK & PO ---
-with tab1:
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        st.subheader("Raw Material Stock (RM)")
-        
-        if st.button("🔄 Clear RM Stock", key="clear_rm"):
-            st.session_state.rm_stock = pd.DataFrame(columns=['RM Code', 'Quantity'])
-            st.session_state.analysis_completed = False
-            st.success("RM Stock cleared!")
-        
-        rm_file = st.file_uploader("Upload RM Stock Excel", type=['xlsx', 'xls'], key="rm_up")
-        
-        if rm_file is not None:
-            try:
-                df = pd.read_excel(rm_file)
-                df.columns = df.columns.str.strip()
-                
-                column_mapping = {}
-                
-                for col in df.columns:
-                    col_lower = str(col).lower()
-                    if 'rm' in col_lower and ('code' in col_lower or 'id' in col_lower):
-                        column_mapping['RM Code'] = col
-                        break
-                
-                for col in df.columns:
-                    col_lower = str(col).lower()
-                    if 'quantity' in col_lower or 'qty' in col_lower or 'amount' in col_lower:
-                        column_mapping['Quantity'] = col
-                        break
-                
-                if 'RM Code' in column_mapping and 'Quantity' in column_mapping:
-                    processed_df = pd.DataFrame()
-                    processed_df['RM Code'] = df[column_mapping['RM Code']].astype(str).str.strip()
-                    processed_df['Quantity'] = pd.to_numeric(df[column_mapping['Quantity']], errors='coerce').fillna(0)
-                    
-                    processed_df = processed_df[processed_df['RM Code'] != '']
-                    processed_df = processed_df[processed_df['RM Code'] != 'nan']
-                    processed_df = processed_df.dropna(subset=['RM Code'])
-                    
-                    if not processed_df.empty:
-                        st.session_state.rm_stock = processed_df
-                        st.success(f"✅ Successfully loaded {len(processed_df)} RM stock records!")
-                    else:
-                        st.warning("No valid data found in the uploaded file")
-                        
-                else:
-                    missing_cols = []
-                    if 'RM Code' not in column_mapping:
-                        missing_cols.append("RM Code")
-                    if 'Quantity' not in column_mapping:
-                        missing_cols.append("Quantity")
-                    st.error(f"Missing columns: {', '.join(missing_cols)}. Found columns: {list(df.columns)}")
-                    
-            except Exception as e:
-                st.error(f"Error processing RM file: {str(e)}")
-        
-        if not st.session_state.rm_stock.empty:
-            st.write("### 📊 Current Stock Inventory")
-            
-            display_df = st.session_state.rm_stock.copy()
-            display_df['Quantity'] = display_df['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-            
-            st.dataframe(
-                display_df,
-                use_container_width=True,
-                height=min(300, len(display_df) * 35 + 40),
-                hide_index=True
-            )
-            
-            st.write("### 🔍 View RM Details")
-            if not st.session_state.rm_stock.empty:
-                sel_rm = st.selectbox(
-                    "Select RM Code:",
-                    st.session_state.rm_stock['RM Code'].unique(),
-                    key="rm_select"
-                )
-                if sel_rm:
-                    qty_row = st.session_state.rm_stock[st.session_state.rm_stock['RM Code'] == sel_rm]
-                    if not qty_row.empty:
-                        qty = qty_row['Quantity'].values[0]
-                        st.metric(label=f"Available {sel_rm}", value=f"{qty:,.4f} Kg")
-        else:
-            st.info("📤 No RM stock data loaded yet. Please upload an Excel file with RM Code and Quantity columns.")
-
-    with col2:
-        st.subheader("RM in Purchase Orders (PO)")
-        
-        if st.button("🔄 Clear RM PO", key="clear_po"):
-            st.session_state.rm_po = pd.DataFrame(columns=['RM Code', 'Quantity', 'Arrival Date'])
-            st.session_state.analysis_completed = False
-            st.success("RM PO cleared!")
-        
-        po_file = st.file_uploader("Upload RM PO Excel", type=['xlsx', 'xls'], key="po_up")
-        
-        if po_file is not None:
-            try:
-                df_po = pd.read_excel(po_file)
-                df_po.columns = df_po.columns.str.strip()
-                
-                column_mapping = {}
-                
-                for col in df_po.columns:
-                    col_lower = str(col).lower()
-                    if 'rm' in col_lower and ('code' in col_lower or 'id' in col_lower):
-                        column_mapping['RM Code'] = col
-                        break
-                
-                for col in df_po.columns:
-                    col_lower = str(col).lower()
-                    if 'quantity' in col_lower or 'qty' in col_lower or 'amount' in col_lower:
-                        column_mapping['Quantity'] = col
-                        break
-                
-                for col in df_po.columns:
-                    col_lower = str(col).lower()
-                    if 'arrival' in col_lower or 'date' in col_lower or 'delivery' in col_lower:
-                        column_mapping['Arrival Date'] = col
-                        break
-                
-                if all(col in column_mapping for col in ['RM Code', 'Quantity', 'Arrival Date']):
-                    processed_df = pd.DataFrame()
-                    processed_df['RM Code'] = df_po[column_mapping['RM Code']].astype(str).str.strip()
-                    processed_df['Quantity'] = pd.to_numeric(df_po[column_mapping['Quantity']], errors='coerce').fillna(0)
-                    
-                    date_col = df_po[column_mapping['Arrival Date']]
-                    try:
-                        processed_df['Arrival Date'] = pd.to_datetime(date_col, dayfirst=True, errors='coerce')
-                    except:
-                        try:
-                            processed_df['Arrival Date'] = pd.to_datetime(date_col, errors='coerce')
-                        except:
-                            st.error("Could not parse date column")
-                            processed_df['Arrival Date'] = pd.NaT
-                    
-                    processed_df = processed_df[processed_df['RM Code'] != '']
-                    processed_df = processed_df[processed_df['RM Code'] != 'nan']
-                    processed_df = processed_df.dropna(subset=['RM Code', 'Arrival Date'])
-                    
-                    if not processed_df.empty:
-                        st.session_state.rm_po = processed_df
-                        st.success(f"✅ Successfully loaded {len(processed_df)} PO records!")
-                    else:
-                        st.warning("No valid data found in the uploaded file")
-                        
-                else:
-                    missing_cols = []
-                    for col in ['RM Code', 'Quantity', 'Arrival Date']:
-                        if col not in column_mapping:
-                            missing_cols.append(col)
-                    st.error(f"Missing columns: {', '.join(missing_cols)}. Found columns: {list(df_po.columns)}")
-                    
-            except Exception as e:
-                st.error(f"Error processing PO file: {str(e)}")
-        
-        if not st.session_state.rm_po.empty:
-            st.write("### 📅 PO Schedule")
-            
-            display_po = st.session_state.rm_po.copy()
-            display_po = display_po.sort_values(by='Arrival Date')
-            display_po['Quantity'] = display_po['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-            display_po['Arrival Date'] = display_po['Arrival Date'].dt.strftime('%d/%m/%Y')
-            
-            st.dataframe(
-                display_po,
-                use_container_width=True,
-                height=min(300, len(display_po) * 35 + 40),
-                hide_index=True
-            )
-            
-            st.write("### 📊 Total RM in PO by Code")
-            if not st.session_state.rm_po.empty:
-                total_po = st.session_state.rm_po.groupby('RM Code')['Quantity'].sum().reset_index()
-                total_po['Quantity'] = total_po['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-                
-                st.dataframe(
-                    total_po,
-                    use_container_width=True,
-                    hide_index=True
-                )
-        else:
-            st.info("📤 No PO data loaded yet. Please upload an Excel file with RM Code, Quantity, and Arrival Date columns.")
-    
-    add_footer()
-
-# --- PAGE 2: FG FORMULAS & SETTINGS ---
-with tab2:
-    col1, col2 = st.columns([2, 1])
-    
-    with col1:
-        st.subheader("Finished Goods Formula Management")
-        
-        fg_files = st.file_uploader(
-            "Upload FG Formulas (Multiple allowed)", 
-            type=['xlsx', 'xls'], 
-            accept_multiple_files=True,
-            key="fg_uploader"
-        )
-        
-        if fg_files:
-            total_loaded = 0
-            for f in fg_files:
-                try:
-                    new_fg = pd.read_excel(f)
-                    new_fg.columns = new_fg.columns.str.strip()
-                    
-                    column_mapping = {}
-                    
-                    for col in new_fg.columns:
-                        col_lower = str(col).lower()
-                        if 'fg' in col_lower and ('code' in col_lower or 'id' in col_lower):
-                            column_mapping['FG Code'] = col
-                            break
-                    
-                    for col in new_fg.columns:
-                        col_lower = str(col).lower()
-                        if 'rm' in col_lower and ('code' in col_lower or 'id' in col_lower):
-                            column_mapping['RM Code'] = col
-                            break
-                    
-                    for col in new_fg.columns:
-                        col_lower = str(col).lower()
-                        if 'quantity' in col_lower or 'qty' in col_lower:
-                            column_mapping['Quantity'] = col
-                            break
-                    
-                    if all(col in column_mapping for col in ['FG Code', 'RM Code', 'Quantity']):
-                        processed_fg = pd.DataFrame()
-                        processed_fg['FG Code'] = new_fg[column_mapping['FG Code']].astype(str).str.strip()
-                        processed_fg['RM Code'] = new_fg[column_mapping['RM Code']].astype(str).str.strip()
-                        processed_fg['Quantity'] = pd.to_numeric(new_fg[column_mapping['Quantity']], errors='coerce').fillna(0)
-                        
-                        processed_fg = processed_fg[
-                            (processed_fg['FG Code'] != '') & 
-                            (processed_fg['FG Code'] != 'nan') &
-                            (processed_fg['RM Code'] != '') &
-                            (processed_fg['RM Code'] != 'nan')
-                        ]
-                        processed_fg = processed_fg.dropna(subset=['FG Code', 'RM Code'])
-                        
-                        if not processed_fg.empty:
-                            if st.session_state.fg_formulas.empty:
-                                st.session_state.fg_formulas = processed_fg
-                            else:
-                                combined = pd.concat([st.session_state.fg_formulas, processed_fg])
-                                st.session_state.fg_formulas = combined.drop_duplicates(
-                                    subset=['FG Code', 'RM Code'], 
-                                    keep='first'
-                                ).reset_index(drop=True)
-                            
-                            for fg_code in processed_fg['FG Code'].unique():
-                                if fg_code not in st.session_state.fg_colors:
-                                    get_fg_color(fg_code)
-                            
-                            total_loaded += len(processed_fg['FG Code'].unique())
-                            st.success(f"✅ Loaded {len(processed_fg['FG Code'].unique())} FG formulas from {f.name}")
-                        else:
-                            st.warning(f"No valid data found in {f.name}")
-                            
-                    else:
-                        missing_cols = []
-                        for col in ['FG Code', 'RM Code', 'Quantity']:
-                            if col not in column_mapping:
-                                missing_cols.append(col)
-                        st.error(f"{f.name}: Missing columns {', '.join(missing_cols)}. Found: {list(new_fg.columns)}")
-                        
-                except Exception as e:
-                    st.error(f"Error reading {f.name}: {str(e)}")
-            
-            if total_loaded > 0:
-                st.session_state.analysis_completed = False
-        
-        if not st.session_state.fg_formulas.empty:
-            st.divider()
-            st.write("### 📋 Current FG Formulas")
-            
-            display_fg = st.session_state.fg_formulas.copy()
-            display_fg['Quantity'] = display_fg['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-            
-            st.dataframe(
-                display_fg,
-                use_container_width=True,
-                height=min(400, len(display_fg) * 35 + 40),
-                hide_index=True
-            )
-            
-            st.divider()
-            st.write("### 🔍 Analyze FG Formula")
-            
-            fg_codes = sorted(st.session_state.fg_formulas['FG Code'].unique().tolist())
-            
-            # FIXED SELECT ALL FUNCTIONALITY
-            # Create two columns for layout
-            col_select, col_button = st.columns([4, 1])
-            
-            with col_select:
-                # Get current selection
-                if st.session_state.select_all_trigger:
-                    current_selection = fg_codes.copy()
-                else:
-                    current_selection = list(st.session_state.fg_analysis_order.keys())
-                
-                # Create the multiselect widget with dynamic key
-                selected_fgs = st.multiselect(
-                    "Select FG Codes for analysis (Order determines FIFO priority):",
-                    options=fg_codes,
-                    default=current_selection,
-                    key=f"fg_analysis_select_{st.session_state.multiselect_key}"
-                )
-            
-            with col_button:
-                st.write("")  # Spacing
-                st.write("")  # Spacing
-                if st.button("📋 Select All", key="select_all_fg_button", type="secondary"):
-                    # Set the trigger and force widget refresh
-                    st.session_state.select_all_trigger = True
-                    st.session_state.multiselect_key += 1
-                    st.rerun()
-            
-            # Update the analysis order based on current selection
-            if selected_fgs:
-                # Sort selected FGs alphabetically/numerically
-                sorted_selected_fgs = sorted(selected_fgs)
-                
-                # Create new order preserving sorted order
-                new_order = OrderedDict()
-                for i, fg in enumerate(sorted_selected_fgs):
-                    new_order[fg] = i
-                
-                # Update session state
-                st.session_state.fg_analysis_order = new_order
-                st.session_state.analysis_completed = False
-                
-                # Reset select_all_trigger if not all are selected
-                if set(selected_fgs) != set(fg_codes):
-                    st.session_state.select_all_trigger = False
-            else:
-                # Clear if nothing selected
-                st.session_state.fg_analysis_order = OrderedDict()
-                st.session_state.analysis_completed = False
-                st.session_state.select_all_trigger = False
-            
-            # Display the current FIFO order
-            if st.session_state.fg_analysis_order:
-                st.write("**🎯 FIFO Order (First to Last):**")
-                for i, (fg, _) in enumerate(st.session_state.fg_analysis_order.items(), 1):
-                    st.write(f"{i}. {fg}")
-                
-                st.write("### 📊 View Formula Details")
-                sel_fg_view = st.selectbox(
-                    "Select FG to view details:",
-                    list(st.session_state.fg_analysis_order.keys()),
-                    key="fg_view_select"
-                )
-                
-                if sel_fg_view:
-                    formula_view = st.session_state.fg_formulas[
-                        st.session_state.fg_formulas['FG Code'] == sel_fg_view
-                    ].copy()
-                    formula_view['Quantity'] = formula_view['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-                    
-                    st.dataframe(
-                        formula_view,
-                        use_container_width=True,
-                        height=min(300, len(formula_view) * 35 + 40),
-                        hide_index=True
-                    )
-            else:
-                if fg_codes:  # Only show if there are FGs available
-                    st.info("Select FG codes above to analyze production planning in Tab 3")
-        
-        else:
-            st.info("🧪 No FG formulas loaded yet. Please upload Excel files with FG Code, RM Code, and Quantity columns.")
-    
-    with col2:
-        st.subheader("⚙️ Calculation Settings")
-        
-        st.write("### 🔢 Decimal Precision")
-        margin = st.number_input(
-            "Decimal places for calculations:",
-            min_value=0,
-            max_value=6,
-            value=st.session_state.calculation_margin,
-            help="Controls rounding precision for all calculations",
-            key="decimal_precision"
-        )
-        
-        if margin != st.session_state.calculation_margin:
-            st.session_state.calculation_margin = int(margin)
-        
-        st.divider()
-        
-        st.write("### 🗑️ Data Management")
-        
-        if st.button("🗑️ Clear All FG Formulas", type="secondary", key="clear_all_fg"):
-            st.session_state.fg_formulas = pd.DataFrame(columns=['FG Code', 'RM Code', 'Quantity'])
-            st.session_state.fg_analysis_order = OrderedDict()
-            st.session_state.fg_expected_capacity = {}
-            st.session_state.fg_colors = {}
-            st.session_state.analysis_completed = False
-            st.session_state.select_all_trigger = False
-            st.session_state.multiselect_key = 0
-            st.success("All FG formulas cleared!")
-        
-        st.divider()
-        
-        if not st.session_state.fg_formulas.empty:
-            st.write("### 🎯 Delete Specific FG")
-            fg_codes = st.session_state.fg_formulas['FG Code'].unique().tolist()
-            to_delete = st.multiselect("Select FG to delete:", fg_codes, key="fg_delete_select")
-            
-            if st.button("🗑️ Delete Selected FG", type="primary", key="delete_fg") and to_delete:
-                st.session_state.fg_formulas = st.session_state.fg_formulas[
-                    ~st.session_state.fg_formulas['FG Code'].isin(to_delete)
-                ]
-                
-                for fg in to_delete:
-                    if fg in st.session_state.fg_analysis_order:
-                        del st.session_state.fg_analysis_order[fg]
-                
-                for fg in to_delete:
-                    if fg in st.session_state.fg_expected_capacity:
-                        del st.session_state.fg_expected_capacity[fg]
-                
-                for fg in to_delete:
-                    if fg in st.session_state.fg_colors:
-                        del st.session_state.fg_colors[fg]
-                
-                # Update analysis flag
-                if not st.session_state.fg_analysis_order:
-                    st.session_state.analysis_completed = False
-                
-                # Reset select all trigger
-                st.session_state.select_all_trigger = False
-                st.session_state.multiselect_key += 1
-                
-                st.success(f"✅ Deleted {len(to_delete)} FG(s): {', '.join(to_delete)}")
-                st.rerun()
-    
-    add_footer()
-
-# --- PAGE 3: PRODUCTION PLANNING ---
-with tab3:
-    col_date, col_export = st.columns([2, 1])
-    
-    with col_date:
-        st.subheader("Production Planning Summary")
-        prod_date = st.date_input("Select Planned Production Date", datetime.now(), key="prod_date")
-    
-    with col_export:
-        st.write("")
-        st.write("")
-        if st.button("📊 Generate Production Analysis", type="primary", key="generate_analysis"):
-            if st.session_state.fg_analysis_order:
-                st.session_state.analysis_completed = True
-                st.success("✅ Production analysis generated! Scroll down to see results.")
-            else:
-                st.warning("⚠️ Please select FG codes in Tab 2 first.")
-    
-    data_ready = True
-    warning_messages = []
-    
-    if st.session_state.rm_stock.empty:
-        warning_messages.append("📦 RM Stock")
-        data_ready = False
-    
-    if st.session_state.fg_formulas.empty:
-        warning_messages.append("🧪 FG Formulas")
-        data_ready = False
-    
-    if not st.session_state.fg_analysis_order:
-        warning_messages.append("🎯 FG selection for analysis")
-        data_ready = False
-    
-    if not data_ready:
-        st.warning(f"⚠️ Please complete the following in previous tabs:")
-        for msg in warning_messages:
-            st.write(f"- {msg}")
-    else:
-        # Show analysis if completed
-        if st.session_state.analysis_completed:
-            decimal_places = st.session_state.calculation_margin
-            
-            stock_dict = st.session_state.rm_stock.set_index('RM Code')['Quantity'].to_dict()
-            stock_dict = {k: round(float(v), decimal_places) for k, v in stock_dict.items()}
-            
-            # Create a copy for calculation (won't be modified for max capacity calculation)
-            initial_stock = stock_dict.copy()
-            allocated_stock = stock_dict.copy()
-            
-            results = []
-            shortage_details = {}
-            
-            for fg in st.session_state.fg_analysis_order.keys():
-                formula = st.session_state.fg_formulas[st.session_state.fg_formulas['FG Code'] == fg]
-                
-                if formula.empty:
-                    continue
-                
-                expected_capacity = st.session_state.fg_expected_capacity.get(fg, 0)
-                
-                # Calculate MAX capacity first (using initial stock, not allocated stock)
-                max_possible_batches_list = []
-                max_shortage_breakdown = []
-                
-                for _, row in formula.iterrows():
-                    rm = str(row['RM Code']).strip()
-                    req_per_batch = round(float(row['Quantity']), decimal_places)
-                    avail = initial_stock.get(rm, 0)  # Use initial stock for max calculation
-                    
-                    if req_per_batch <= 0 or avail <= 0:
-                        max_possible_batches_list.append(0)
-                        if avail <= 0:
-                            max_shortage_breakdown.append(f"{rm}: Available 0.0000 Kg")
-                    else:
-                        max_batches_for_rm = int(avail // req_per_batch)
-                        max_possible_batches_list.append(max_batches_for_rm)
-                
-                max_possible_batches = min(max_possible_batches_list) if max_possible_batches_list else 0
-                max_capacity = max_possible_batches * 25
-                
-                # Now calculate ACTUAL capacity based on expected and allocated stock
-                possible_batches = []
-                missing_rms = []
-                shortage_breakdown = []
-                
-                # Calculate based on expected capacity
-                if expected_capacity > 0:
-                    # Calculate required batches based on expected capacity
-                    expected_batches = max(1, int(expected_capacity // 25))
-                    actual_expected_capacity = expected_batches * 25
-                    
-                    for _, row in formula.iterrows():
-                        rm = str(row['RM Code']).strip()
-                        req_per_batch = round(float(row['Quantity']), decimal_places)
-                        avail = allocated_stock.get(rm, 0)
-                        
-                        # Calculate total required for expected batches
-                        total_required = req_per_batch * expected_batches
-                        
-                        if total_required <= 0:
-                            shortage_breakdown.append(f"{rm}: Invalid requirement ({req_per_batch:.{decimal_places}f} Kg per batch)")
-                            possible_batches.append(0)
-                        elif avail <= 0:
-                            possible_batches.append(0)
-                            missing_rms.append(rm)
-                            shortage_breakdown.append(f"{rm}: Required {total_required:.{decimal_places}f} Kg, Available 0.0000 Kg")
-                        else:
-                            # Check if we have enough for expected batches
-                            if avail >= total_required:
-                                max_batches_for_rm = expected_batches
-                                possible_batches.append(max_batches_for_rm)
-                            else:
-                                # Calculate how many batches we can make
-                                max_batches_for_rm = int(avail // req_per_batch)
-                                possible_batches.append(max_batches_for_rm)
-                                
-                                if max_batches_for_rm < expected_batches:
-                                    missing_rms.append(rm)
-                                    shortage = total_required - avail
-                                    shortage_breakdown.append(f"{rm}: Required {total_required:.{decimal_places}f} Kg for {expected_batches} batches, Available {avail:.{decimal_places}f} Kg, Shortage {shortage:.{decimal_places}f} Kg")
-                else:
-                    # If no expected capacity, calculate maximum possible
-                    for _, row in formula.iterrows():
-                        rm = str(row['RM Code']).strip()
-                        req_per_batch = round(float(row['Quantity']), decimal_places)
-                        avail = allocated_stock.get(rm, 0)
-                        
-                        if req_per_batch <= 0:
-                            possible_batches.append(0)
-                            shortage_breakdown.append(f"{rm}: Invalid requirement ({req_per_batch:.{decimal_places}f} Kg)")
-                        elif avail <= 0:
-                            possible_batches.append(0)
-                            missing_rms.append(rm)
-                            shortage_breakdown.append(f"{rm}: Required {req_per_batch:.{decimal_places}f} Kg per batch, Available 0.0000 Kg")
-                        else:
-                            max_batches_for_rm = int(avail // req_per_batch)
-                            possible_batches.append(max_batches_for_rm)
-                            
-                            if max_batches_for_rm == 0:
-                                missing_rms.append(rm)
-                                shortage = req_per_batch - avail
-                                shortage_breakdown.append(f"{rm}: Required {req_per_batch:.{decimal_places}f} Kg per batch, Available {avail:.{decimal_places}f} Kg, Shortage {shortage:.{decimal_places}f} Kg")
-                
-                if expected_capacity > 0:
-                    # For expected capacity mode, use minimum of possible batches
-                    max_possible_for_actual = min(possible_batches) if possible_batches else 0
-                    actual_batches = min(expected_batches, max_possible_for_actual)
-                    actual_capacity = actual_batches * 25
-                else:
-                    # For auto mode
-                    max_possible_for_actual = min(possible_batches) if possible_batches else 0
-                    actual_batches = max_possible_for_actual
-                    actual_capacity = max_possible_for_actual * 25
-                
-                if actual_capacity >= 25:
-                    status = "✅ Ready"
-                else:
-                    status = "❌ Shortage"
-                
-                shortage_details[fg] = shortage_breakdown
-                
-                if missing_rms:
-                    missing_display = f"{len(missing_rms)} RM(s)"
-                else:
-                    missing_display = "None"
-                
-                # Allocate stock for production
-                if actual_batches > 0 and status == "✅ Ready":
-                    for _, row in formula.iterrows():
-                        rm = str(row['RM Code']).strip()
-                        req_total = round(row['Quantity'] * actual_batches, decimal_places)
-                        if rm in allocated_stock:
-                            allocated_stock[rm] = round(allocated_stock[rm] - req_total, decimal_places)
-                
-                results.append({
-                    "FG": fg,
-                    "Expected": f"{expected_capacity:,.1f} Kg" if expected_capacity > 0 else "Auto",
-                    "Max": f"{max_capacity:,.1f} Kg",  # This is the TRUE max based on initial stock
-                    "Actual": f"{actual_capacity:,.1f} Kg",
-                    "Status": status,
-                    "Missing": missing_display,
-                    "Batches": actual_batches
-                })
-            
-            if not st.session_state.rm_po.empty:
-                po_status_for_report = st.session_state.rm_po.copy()
-                po_status_for_report['Status'] = po_status_for_report['Arrival Date'].apply(
-                    lambda x: "Delayed" if x.date() < prod_date else "Incoming"
-                )
-                delayed_pos = len(po_status_for_report[po_status_for_report['Status'] == "Delayed"])
-            else:
-                po_status_for_report = None
-                delayed_pos = 0
-            
-            ready_fgs = [r for r in results if "✅" in r['Status']]
-            total_volume = sum(float(r['Actual'].replace(' Kg', '').replace(',', '')) 
-                              for r in results if r['Actual'] != "0.0 Kg")
-            
-            # Generate Missing RM Summary based on Expected Capacities
-            detailed_missing_df, summary_missing_df = generate_missing_rm_summary_from_results(
-                results, 
-                shortage_details,
-                st.session_state.fg_expected_capacity,
-                st.session_state.fg_formulas,
-                st.session_state.calculation_margin
-            )
-            
-            # Generate shortage details table for Excel export
-            shortage_table_df = generate_shortage_details_table(shortage_details, st.session_state.calculation_margin)
-            
-            # Display Missing RM Summary if available
-            if summary_missing_df is not None and not summary_missing_df.empty:
-                st.divider()
-                st.write("### 📋 Missing RM Summary (Based on Expected Capacities)")
-                
-                # Display summary table
-                st.dataframe(
-                    summary_missing_df,
-                    use_container_width=True,
-                    height=min(300, len(summary_missing_df) * 35 + 40),
-                    hide_index=True,
-                    column_config={
-                        "RM Code": st.column_config.TextColumn("RM Code", width="small"),
-                        "Total Required (Kg)": st.column_config.NumberColumn("Total Required", format="%.4f"),
-                        "Total Available (Kg)": st.column_config.NumberColumn("Total Available", format="%.4f"),
-                        "Total Shortage (Kg)": st.column_config.NumberColumn("Total Shortage", format="%.4f"),
-                        "Affected FG Codes": st.column_config.TextColumn("Affected FGs", width="medium"),
-                        "Number of Affected FGs": st.column_config.NumberColumn("Affected Count")
-                    }
-                )
-            
-            st.write("### 🎯 Set Expected Capacities")
-            st.caption("Set 0 for automatic calculation based on available RM")
-            
-            capacity_col1, capacity_col2 = st.columns(2)
-            
-            fg_list = list(st.session_state.fg_analysis_order.keys())
-            mid_point = (len(fg_list) + 1) // 2
-            
-            with capacity_col1:
-                for fg in fg_list[:mid_point]:
-                    current_val = st.session_state.fg_expected_capacity.get(fg, 0)
-                    new_capacity = st.number_input(
-                        f"{fg} (Kg, min 25):",
-                        min_value=0.0,
-                        value=float(current_val),
-                        step=25.0,
-                        format="%.1f",
-                        key=f"exp_cap_{fg}"
-                    )
-                    if new_capacity != current_val:
-                        st.session_state.fg_expected_capacity[fg] = new_capacity
-            
-            with capacity_col2:
-                for fg in fg_list[mid_point:]:
-                    current_val = st.session_state.fg_expected_capacity.get(fg, 0)
-                    new_capacity = st.number_input(
-                        f"{fg} (Kg, min 25):",
-                        min_value=0.0,
-                        value=float(current_val),
-                        step=25.0,
-                        format="%.1f",
-                        key=f"exp_cap_{fg}_2"
-                    )
-                    if new_capacity != current_val:
-                        st.session_state.fg_expected_capacity[fg] = new_capacity
-            
-            st.divider()
-            st.write("### 📊 Production Summary")
-            
-            col1, col2, col3, col4 = st.columns(4)
-            col1.metric("Producible FG", len(ready_fgs))
-            col2.metric("Total Volume", f"{total_volume:,.1f} Kg")
-            col3.metric("Total Batches", sum(r['Batches'] for r in results))
-            col4.metric("Delayed POs", delayed_pos)
-            
-            st.divider()
-            st.write("### 📋 Production Capability List")
-            
-            res_df = pd.DataFrame(results)
-            
-            st.dataframe(
-                res_df,
-                use_container_width=True,
-                height=min(400, len(res_df) * 35 + 40),
-                hide_index=True,
-                column_config={
-                    "FG": st.column_config.TextColumn("FG Code", width="small"),
-                    "Expected": st.column_config.TextColumn("Expected", width="small"),
-                    "Max": st.column_config.TextColumn("Max Cap", width="small"),
-                    "Actual": st.column_config.TextColumn("Actual Cap", width="small"),
-                    "Status": st.column_config.TextColumn("Status", width="small"),
-                    "Missing": st.column_config.TextColumn("Missing RM", width="small"),
-                    "Batches": st.column_config.NumberColumn("Batches", width="small")
-                }
-            )
-            
-            st.divider()
-            st.write("### 🔍 Shortage Details")
-            
-            shortage_exists = False
-            for fg in shortage_details:
-                if shortage_details[fg]:
-                    shortage_exists = True
-                    with st.expander(f"❌ {fg} - RM Shortage Breakdown", expanded=False):
-                        for item in shortage_details[fg]:
-                            st.write(f"• {item}")
-            
-            if not shortage_exists:
-                st.info("✅ No shortages detected for selected FGs")
-            
-            if not st.session_state.rm_po.empty:
-                st.divider()
-                st.write("### ⏰ PO Delay Tracker")
-                
-                po_display = po_status_for_report.copy()
-                po_display['Quantity'] = po_display['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
-                po_display['Arrival Date'] = po_display['Arrival Date'].dt.strftime('%d/%m/%Y')
-                
-                st.dataframe(
-                    po_display,
-                    use_container_width=True,
-                    height=min(300, len(po_display) * 35 + 40),
-                    hide_index=True,
-                    column_config={
-                        "RM Code": st.column_config.TextColumn("RM Code", width="small"),
-                        "Quantity": st.column_config.TextColumn("Quantity", width="small"),
-                        "Arrival Date": st.column_config.TextColumn("Arrival", width="small"),
-                        "Status": st.column_config.TextColumn("Status", width="small")
-                    }
-                )
-            
-            st.divider()
-            st.write("### 📈 Production Capacity Visualization")
-            
-            chart_col1, chart_col2 = st.columns(2)
-            
-            with chart_col1:
-                if len(results) > 0:
-                    res_df = pd.DataFrame(results)
-                    chart_data = res_df.copy()
-                    chart_data['Actual_Num'] = chart_data['Actual'].str.replace(' Kg', '').str.replace(',', '').astype(float)
-                    chart_data['Max_Num'] = chart_data['Max'].str.replace(' Kg', '').str.replace(',', '').astype(float)
-                    
-                    color_discrete_map = {}
-                    for fg_code in chart_data['FG'].unique():
-                        color_discrete_map[fg_code] = get_fg_color(fg_code)
-                    
-                    # Create stacked bar chart for Actual vs Max
-                    fig1_data = []
-                    for _, row in chart_data.iterrows():
-                        fig1_data.append({'FG': row['FG'], 'Capacity': row['Actual_Num'], 'Type': 'Actual'})
-                        fig1_data.append({'FG': row['FG'], 'Capacity': row['Max_Num'] - row['Actual_Num'], 'Type': 'Available'})
-                    
-                    fig1_df = pd.DataFrame(fig1_data)
-                    
-                    fig1 = px.bar(
-                        fig1_df,
-                        x='FG',
-                        y='Capacity',
-                        title="Actual vs Maximum Capacity",
-                        color='Type',
-                        color_discrete_map={'Actual': '#2ca02c', 'Available': '#aec7e8'},
-                        text=fig1_df['Capacity'].apply(lambda x: f"{x:,.1f}" if x > 0 else ''),
-                        hover_data=['Type']
-                    )
-                    
-                    fig1.update_traces(
-                        texttemplate='%{text}',
-                        textposition='outside',
-                        hovertemplate='<b>%{x}</b><br>' +
-                                    'Type: %{customdata[0]}<br>' +
-                                    'Capacity: %{y:,.1f} Kg<br>' +
-                                    '<extra></extra>'
-                    )
-                    
-                    fig1.update_layout(
-                        yaxis_title="Capacity (Kg)",
-                        showlegend=True,
-                        height=400,
-                        xaxis_tickangle=-45,
-                        legend_title="Capacity Type",
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="right",
-                            x=1
-                        )
-                    )
-                    st.plotly_chart(fig1, use_container_width=True)
-            
-            with chart_col2:
-                if len(res_df) > 1:
-                    pie_data = res_df.copy()
-                    pie_data['Actual_Num'] = pie_data['Actual'].str.replace(' Kg', '').str.replace(',', '').astype(float)
-                    pie_data = pie_data[pie_data['Actual_Num'] > 0]
-                    
-                    if len(pie_data) > 0:
-                        pie_colors = [get_fg_color(fg) for fg in pie_data['FG']]
-                        
-                        fig2 = px.pie(
-                            pie_data,
-                            values='Actual_Num',
-                            names='FG',
-                            title="Capacity Distribution",
-                            color='FG',
-                            color_discrete_sequence=pie_colors,
-                            hole=0.3,
-                            hover_data=['Status']
-                        )
-                        
-                        fig2.update_traces(
-                            hovertemplate='<b>%{label}</b><br>' +
-                                        'Capacity: %{value:,.1f} Kg<br>' +
-                                        'Percentage: %{percent}<br>' +
-                                        '<extra></extra>'
-                        )
-                        
-                        fig2.update_layout(
-                            height=400,
-                            legend_title="FG Code",
-                            showlegend=True
-                        )
-                        st.plotly_chart(fig2, use_container_width=True)
-            
-            st.info(
-                f"**⚙️ Current Settings:**\n"
-                f"• Decimal Precision: {st.session_state.calculation_margin} places\n"
-                f"• FIFO Order: {', '.join(st.session_state.fg_analysis_order.keys())}\n"
-                f"• Batch Size: 25 Kg per batch"
-            )
-            
-            # --- EXPORT REPORTS ---
-            st.divider()
-            st.write("### 📤 Export Reports")
-            
-            # Create 3 columns for export buttons
-            export_col1, export_col2, export_col3 = st.columns(3)
-            
-            with export_col1:
-                # PDF/HTML Report Button
-                try:
-                    report_data, report_type = generate_report(
-                        results, 
-                        shortage_details, 
-                        prod_date, 
-                        total_volume, 
-                        ready_fgs, 
-                        delayed_pos,
-                        po_status_for_report
-                    )
-                    
-                    if report_type == "pdf":
-                        mime_type = "application/pdf"
-                        file_name = f"MRP_Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-                        btn_label = "⬇️ PDF Report"
-                    else:
-                        mime_type = "text/html"
-                        file_name = f"MRP_Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-                        btn_label = "⬇️ HTML Report"
-                    
-                    st.download_button(
-                        label=btn_label,
-                        data=report_data,
-                        file_name=file_name,
-                        mime=mime_type,
-                        key="pdf_html_download"
-                    )
-                    
-                except Exception as e:
-                    st.error(f"Error generating report: {str(e)}")
-            
-            with export_col2:
-                # Excel Export Button with Shortage Details only
-                if not results:
-                    st.info("No production data")
-                elif not shortage_table_df.empty:
-                    try:
-                        # Create Excel with shortage details only
-                        output = io.BytesIO()
-                        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                            # Sheet 1: Shortage Details (FG Code, RM Code, Required, Available)
-                            shortage_table_df.to_excel(writer, sheet_name='Shortage Details', index=False)
-                            
-                            # Sheet 2: Production Summary
-                            results_df = pd.DataFrame(results)
-                            results_df.to_excel(writer, sheet_name='Production Summary', index=False)
-                            
-                            # Sheet 3: Missing RM Summary (if available)
-                            if not summary_missing_df.empty:
-                                summary_missing_df.to_excel(writer, sheet_name='Missing RM Summary', index=False)
-                        
-                        output.seek(0)
-                        
-                        st.download_button(
-                            label="📈 Shortage Details (Excel)",
-                            data=output,
-                            file_name=f"Shortage_Details_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="shortage_excel_download"
-                        )
-                        
-                    except Exception as e:
-                        st.error(f"Error generating Excel file: {str(e)}")
-                else:
-                    # Create a simple Excel with production results if no shortages
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        results_df = pd.DataFrame(results)
-                        results_df.to_excel(writer, sheet_name='Production Summary', index=False)
-                    output.seek(0)
-                    
-                    st.download_button(
-                        label="📈 Production Summary (Excel)",
-                        data=output,
-                        file_name=f"Production_Summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="results_excel_download"
-                    )
-            
-            with export_col3:
-                # Complete Report Button (Missing RM Analysis)
-                if not results:
-                    st.info("No production data")
-                elif not detailed_missing_df.empty and not summary_missing_df.empty:
-                    try:
-                        all_missing_report = generate_all_missing_rm_report(
-                            detailed_missing_df,
-                            summary_missing_df,
-                            prod_date
-                        )
-                        
-                        st.download_button(
-                            label="🚀 Complete Missing RM Report",
-                            data=all_missing_report,
-                            file_name=f"Complete_Missing_RM_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key="all_missing_download"
-                        )
-                        
-                    except Exception as e:
-                        st.error(f"Error generating comprehensive report: {str(e)}")
-                else:
-                    # Create a basic report even without shortages
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        results_df = pd.DataFrame(results)
-                        results_df.to_excel(writer, sheet_name='Production Summary', index=False)
-                        
-                        exec_summary = pd.DataFrame({
-                            'Report Type': ['Production Planning Report'],
-                            'Production Date': [prod_date.strftime('%Y-%m-%d')],
-                            'Report Generated': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
-                            'Total FG Types': [len(results)],
-                            'Total Production Volume (Kg)': [total_volume],
-                            'Producible FGs': [len(ready_fgs)]
-                        })
-                        exec_summary.to_excel(writer, sheet_name='Executive Summary', index=False)
-                    output.seek(0)
-                    
-                    st.download_button(
-                        label="📋 Basic Production Report",
-                        data=output,
-                        file_name=f"Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="production_report_download"
-                    )
-            
-            # Display the shortage details table that will be exported
-            if not shortage_table_df.empty:
-                st.divider()
-                st.write("### 📊 Shortage Details for Export")
-                
-                # Display the table that will be exported
-                st.dataframe(
-                    shortage_table_df,
-                    use_container_width=True,
-                    height=min(300, len(shortage_table_df) * 35 + 40),
-                    hide_index=True,
-                    column_config={
-                        "FG Code": st.column_config.TextColumn("FG Code", width="small"),
-                        "RM Code": st.column_config.TextColumn("RM Code", width="small"),
-                        "Required (Kg)": st.column_config.NumberColumn("Required", format="%.4f"),
-                        "Available (Kg)": st.column_config.NumberColumn("Available", format="%.4f"),
-                        "Shortage (Kg)": st.column_config.NumberColumn("Shortage", format="%.4f")
-                    }
-                )
-                st.caption("This table will be exported in the 'Shortage Details (Excel)' download")
-        else:
-            st.info("👆 Click 'Generate Production Analysis' button above to see production planning results.")
-    
-    add_footer()
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from mrp_engine import (
+    ALLOCATION_POLICIES, DEFAULT_SUPPLIER_TERMS, AllocationLedger, LOCATION_RULES, SUPPLIER_TERMS_COLUMNS, PRIORITY_CLASS_WEIGHTS, VERSIONED_TABLES, LocationStock, LotQueue, MasterDataHistory, OrderProblem, PlanCancelled,
+    POIndex, RequirementMatrix, SensitivityPlanner, WhereUsedIndex, apply_po_delta, apply_stock_delta, blocked_fgs,
+    bottleneck_analysis, compute_production_plan, diff_plans, estimate_nbytes, expiry_risk_report, fefo_draws,
+    latest_stock_rows, location_draws, location_rank, normalize_formula_frame,
+    normalize_po_frame, normalize_stock_frame, normalize_supplier_terms_frame, planned_batches, pooled_stock,
+    recommend_purchases, residual_by_location, search_fifo_order, usable_stock, validate_master_data, with_location
+)
+from datetime import datetime
+from collections import OrderedDict
+from html import escape
+import random
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import string
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+st.set_page_config(page_title="MRP System Dashboard", layout="wide")
+
+# --- Session State Initialization ---
+if 'rm_stock' not in st.session_state:
+    st.session_state.rm_stock = pd.DataFrame(columns=['RM Code', 'Location', 'Quantity'])
+if 'rm_po' not in st.session_state:
+    st.session_state.rm_po = pd.DataFrame(columns=['RM Code', 'Location', 'Quantity', 'Arrival Date'])
+if 'supplier_terms' not in st.session_state:
+    st.session_state.supplier_terms = pd.DataFrame(columns=SUPPLIER_TERMS_COLUMNS)
+if 'procurement_defaults' not in st.session_state:
+    st.session_state.procurement_defaults = dict(DEFAULT_SUPPLIER_TERMS)
+if 'fg_formulas' not in st.session_state:
+    st.session_state.fg_formulas = pd.DataFrame(columns=['FG Code', 'RM Code', 'Quantity'])
+if 'fg_analysis_order' not in st.session_state:
+    st.session_state.fg_analysis_order = OrderedDict()
+if 'fg_expected_capacity' not in st.session_state:
+    st.session_state.fg_expected_capacity = {}
+if 'calculation_margin' not in st.session_state:
+    st.session_state.calculation_margin = 3
+if 'fixed_point_mode' not in st.session_state:
+    st.session_state.fixed_point_mode = False
+if 'allocation_policy' not in st.session_state:
+    st.session_state.allocation_policy = 'fifo'
+if 'fg_priority_class' not in st.session_state:
+    st.session_state.fg_priority_class = {}
+if 'location_rule' not in st.session_state:
+    st.session_state.location_rule = 'transfer_cost'
+if 'location_settings' not in st.session_state:
+    st.session_state.location_settings = {}
+if 'fg_colors' not in st.session_state:
+    st.session_state.fg_colors = {}
+if 'analysis_completed' not in st.session_state:
+    st.session_state.analysis_completed = False
+if 'select_all_trigger' not in st.session_state:
+    st.session_state.select_all_trigger = False
+if 'multiselect_key' not in st.session_state:
+    st.session_state.multiselect_key = 0
+if 'analysis_job' not in st.session_state:
+    st.session_state.analysis_job = None
+if 'analysis_result' not in st.session_state:
+    st.session_state.analysis_result = None
+if 'analysis_error' not in st.session_state:
+    st.session_state.analysis_error = None
+if 'analysis_requested' not in st.session_state:
+    st.session_state.analysis_requested = False
+if 'ingested_uploads' not in st.session_state:
+    st.session_state.ingested_uploads = {}
+if 'master_data' not in st.session_state:
+    st.session_state.master_data = MasterDataHistory({name: st.session_state[name] for name in VERSIONED_TABLES})
+if 'data_versions' not in st.session_state:
+    st.session_state.data_versions = dict(st.session_state.master_data.head.table_ids)
+if 'derived_cache' not in st.session_state:
+    st.session_state.derived_cache = {}
+if 'fifo_order_custom' not in st.session_state:
+    st.session_state.fifo_order_custom = False
+if 'order_search_result' not in st.session_state:
+    st.session_state.order_search_result = None
+if 'ingestion_issues' not in st.session_state:
+    st.session_state.ingestion_issues = {'rm_stock': [], 'rm_po': [], 'fg_formulas': []}
+if 'memory_budget_mb' not in st.session_state:
+    st.session_state.memory_budget_mb = 512
+if 'memory_lru' not in st.session_state:
+    st.session_state.memory_lru = OrderedDict()
+if 'memory_evictions' not in st.session_state:
+    st.session_state.memory_evictions = []
+if 'memory_report' not in st.session_state:
+    st.session_state.memory_report = None
+if 'history_enabled' not in st.session_state:
+    st.session_state.history_enabled = False
+if 'chart_cache' not in st.session_state:
+    st.session_state.chart_cache = {'fingerprint': None, 'figures': {}}
+
+st.title("🏭 Localhost MRP Dashboard")
+
+tab1, tab2, tab3 = st.tabs(["📦 Stock & PO Management", "🧪 FG Formulas & Settings", "📊 Production Planning"])
+
+# Function to generate or get color for FG code
+def get_fg_color(fg_code):
+    if fg_code not in st.session_state.fg_colors:
+        colors_list = [
+            '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+            '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
+            '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5',
+            '#c49c94', '#f7b6d2', '#c7c7c7', '#dbdb8d', '#9edae5'
+        ]
+        color = colors_list[len(st.session_state.fg_colors) % len(colors_list)]
+        st.session_state.fg_colors[fg_code] = color
+    return st.session_state.fg_colors[fg_code]
+
+# Uploaded files stay in their uploader across reruns; remember which ones were
+# already ingested so a rerun doesn't parse (and re-apply) the same file again
+def is_new_upload(slot, uploaded_file):
+    seen = st.session_state.ingested_uploads.setdefault(slot, set())
+    if uploaded_file.file_id in seen:
+        return False
+    seen.add(uploaded_file.file_id)
+    return True
+
+# Every change to the master data is committed as a new immutable version
+# (see MasterDataHistory) and the session keeps the head's tables as plain
+# frames. data_versions holds the version ID of each table; caches and the
+# analysis key on (table, version ID) instead of re-hashing the data.
+def sync_master_data():
+    history = st.session_state.master_data
+    for name in VERSIONED_TABLES:
+        st.session_state[name] = history.table(name)
+    st.session_state.data_versions = dict(history.head.table_ids)
+
+def commit_master_data(label, **tables):
+    st.session_state.master_data.commit(label, **tables)
+    sync_master_data()
+
+def undo_master_data():
+    if st.session_state.master_data.undo() is not None:
+        sync_master_data()
+        st.session_state.analysis_completed = False
+
+def redo_master_data():
+    if st.session_state.master_data.redo() is not None:
+        sync_master_data()
+        st.session_state.analysis_completed = False
+
+def restore_master_data(version_id):
+    st.session_state.master_data.restore(version_id)
+    sync_master_data()
+    st.session_state.analysis_completed = False
+
+def versioned_artefact(name, tables, build, key=None):
+    """Return an artefact derived from session tables, rebuilt only when one of the tables' versions changes.
+
+    ``key`` holds any other input of ``build``; a new key replaces the entry rather than adding one.
+    """
+    if isinstance(tables, str):
+        tables = (tables,)
+    version = tuple(st.session_state.data_versions[table] for table in tables) + (key,)
+    cached = st.session_state.derived_cache.get(name)
+    if cached is None or cached[0] != version:
+        cached = (version, build())
+        st.session_state.derived_cache[name] = cached
+    return cached[1]
+
+# Rows dropped or repaired while reading uploads, kept per table for the data-quality report
+def record_ingestion_issues(table, issues, replace):
+    if replace:
+        st.session_state.ingestion_issues[table] = issues
+    else:
+        st.session_state.ingestion_issues[table].extend(issues)
+
+def format_quantity_column(df):
+    display_df = df.copy()
+    display_df['Quantity'] = display_df['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
+    return display_df
+
+# HTML report (fallback if PDF fails). The page is a set of templates compiled once
+# at import; table rows are written in chunks, and the shortage details travel once
+# as compact JSON that the page paginates itself, so the file stays small and quick
+# to open even for thousands of FGs.
+HTML_REPORT_CHUNK_ROWS = 500
+HTML_REPORT_OPEN_ROWS = 200
+HTML_SHORTAGE_PAGE_SIZE = 25
+
+HTML_REPORT_HEAD = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>MRP Production Planning Summary Report</title>
+<style>
+body { font-family: Arial, sans-serif; margin: 40px; }
+.header { text-align: center; margin-bottom: 30px; }
+.title { font-size: 24px; font-weight: bold; color: #333; }
+.subtitle { font-size: 14px; color: #666; margin-top: 10px; }
+.section { margin: 20px 0; }
+.section-title { font-size: 18px; font-weight: bold; color: #2c3e50; border-bottom: 2px solid #3498db; padding-bottom: 5px; margin-bottom: 15px; cursor: pointer; }
+table { width: 100%; border-collapse: collapse; margin: 10px 0; }
+th { background-color: #3498db; color: white; padding: 10px; text-align: left; }
+td { padding: 8px; border: 1px solid #ddd; }
+tr:nth-child(even) { background-color: #f2f2f2; }
+.metric { display: inline-block; margin: 10px 20px 10px 0; padding: 10px; background-color: #ecf0f1; border-radius: 5px; }
+.metric-label { font-weight: bold; color: #7f8c8d; }
+.metric-value { font-size: 18px; color: #2c3e50; }
+.ready { color: #27ae60; font-weight: bold; }
+.short { color: #e74c3c; font-weight: bold; }
+.shortage-fg { margin: 15px 0; }
+.shortage-fg ul { margin: 5px 0 20px 20px; }
+.pager { margin: 10px 0; }
+.pager button { margin: 0 5px; }
+.footer { margin-top: 40px; text-align: center; color: #7f8c8d; font-size: 12px; border-top: 1px solid #ddd; padding-top: 20px; }
+.company-footer { margin-top: 30px; text-align: center; color: #3498db; font-weight: bold; font-size: 14px; }
+</style>
+</head>
+<body>
+<div class="header">
+<div class="title">MRP Production Planning Summary Report</div>
+<div class="subtitle">Generated on: $generated</div>
+<div class="subtitle">Production Date: $prod_date</div>
+</div>
+<div class="section">
+<div class="section-title">Summary Metrics</div>
+<div class="metric"><div class="metric-label">Planned Production Date</div><div class="metric-value">$prod_date</div></div>
+<div class="metric"><div class="metric-label">Producible FG Types</div><div class="metric-value">$ready_fgs</div></div>
+<div class="metric"><div class="metric-label">Total Production Volume</div><div class="metric-value">$total_volume Kg</div></div>
+<div class="metric"><div class="metric-label">Delayed Purchase Orders</div><div class="metric-value">$delayed_pos</div></div>
+</div>
+""")
+
+# Large tables start collapsed so the browser only lays them out on demand
+HTML_TABLE_OPEN = string.Template("""<details class="section"$open>
+<summary class="section-title">$title ($count rows)</summary>
+<table>
+<tr>$headers</tr>
+""")
+HTML_TABLE_CLOSE = "</table>\n</details>\n"
+
+HTML_RESULT_ROW = string.Template(
+    '<tr><td>$fg</td><td>$expected</td><td>$max</td><td>$actual</td>'
+    '<td class="$status_class">$status</td><td>$missing</td><td>$batches</td></tr>\n'
+)
+HTML_PO_ROW = string.Template(
+    '<tr><td>$rm</td><td>$quantity Kg</td><td>$arrival</td><td class="$status_class">$status</td></tr>\n'
+)
+
+HTML_SHORTAGE_SECTION = string.Template("""<details class="section" open>
+<summary class="section-title">Shortage Details ($count FGs)</summary>
+<div class="pager"><button type="button" id="shortage-prev">&laquo; Prev</button><span id="shortage-page"></span><button type="button" id="shortage-next">Next &raquo;</button></div>
+<div id="shortage-list"><noscript>Enable JavaScript to browse the shortage details.</noscript></div>
+<script type="application/json" id="shortage-data">$data</script>
+<script>
+(function () {
+  var data = JSON.parse(document.getElementById('shortage-data').textContent);
+  var pageSize = $page_size, page = 0, pages = Math.max(1, Math.ceil(data.length / pageSize));
+  var list = document.getElementById('shortage-list');
+  function render() {
+    list.textContent = '';
+    data.slice(page * pageSize, (page + 1) * pageSize).forEach(function (entry) {
+      var block = document.createElement('div');
+      block.className = 'shortage-fg';
+      var title = document.createElement('div');
+      title.className = 'short';
+      title.textContent = 'FG Code: ' + entry[0];
+      var items = document.createElement('ul');
+      entry[1].forEach(function (text) {
+        var item = document.createElement('li');
+        item.textContent = text;
+        items.appendChild(item);
+      });
+      block.appendChild(title);
+      block.appendChild(items);
+      list.appendChild(block);
+    });
+    document.getElementById('shortage-page').textContent = ' Page ' + (page + 1) + ' of ' + pages + ' ';
+  }
+  document.getElementById('shortage-prev').onclick = function () { if (page > 0) { page--; render(); } };
+  document.getElementById('shortage-next').onclick = function () { if (page < pages - 1) { page++; render(); } };
+  render();
+})();
+</script>
+</details>
+""")
+
+HTML_REPORT_TAIL = string.Template("""<div class="section">
+<div class="section-title">System Settings</div>
+<div style="margin: 10px 0;">
+&bull; Decimal Precision: $calculation_margin places<br>
+&bull; FIFO Order: $fifo_order<br>
+&bull; Report Generated: $generated
+</div>
+</div>
+<div class="company-footer">RGI - Supply Chain Department</div>
+<div class="footer">Report generated by MRP Dashboard System<br>--- End of Report ---</div>
+</body>
+</html>
+""")
+
+def _write_html_table(out, title, headers, rows, row_template, render_row):
+    out.write(HTML_TABLE_OPEN.substitute(
+        open=" open" if len(rows) <= HTML_REPORT_OPEN_ROWS else "",
+        title=title,
+        count=f"{len(rows):,}",
+        headers=''.join(f"<th>{header}</th>" for header in headers),
+    ))
+    for start in range(0, len(rows), HTML_REPORT_CHUNK_ROWS):
+        out.write(''.join(row_template.substitute(render_row(row))
+                          for row in rows[start:start + HTML_REPORT_CHUNK_ROWS]))
+    out.write(HTML_TABLE_CLOSE)
+
+def _result_row(item):
+    return {
+        'fg': escape(str(item['FG'])),
+        'expected': item['Expected'],
+        'max': item['Max'],
+        'actual': item['Actual'],
+        'status_class': "ready" if "✅" in item['Status'] else "short",
+        'status': escape(str(item['Status'])),
+        'missing': escape(str(item['Missing'])),
+        'batches': item['Batches'],
+    }
+
+def _po_row(row):
+    rm_code, quantity, arrival_date, status = row
+    return {
+        'rm': escape(str(rm_code)),
+        'quantity': f"{quantity:,.4f}",
+        'arrival': arrival_date.strftime('%d/%m/%Y') if hasattr(arrival_date, 'strftime') else escape(str(arrival_date)),
+        'status_class': "short" if status == 'Delayed' else "",
+        'status': escape(str(status)),
+    }
+
+def write_html_report(out, results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                      calculation_margin, fifo_order):
+    """Write the HTML report to the text stream ``out`` section by section"""
+    generated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    out.write(HTML_REPORT_HEAD.substitute(
+        generated=generated,
+        prod_date=prod_date.strftime('%d/%m/%Y'),
+        ready_fgs=len(ready_fgs),
+        total_volume=f"{total_volume:,.1f}",
+        delayed_pos=delayed_pos,
+    ))
+
+    if results:
+        _write_html_table(out, "Production Capability List",
+                          ["FG Code", "Expected", "Max (Kg)", "Actual (Kg)", "Status", "Missing RM", "Batches"],
+                          results, HTML_RESULT_ROW, _result_row)
+
+    shortages = [[fg, items] for fg, items in shortage_details.items() if items]
+    if shortages:
+        # "</" can't appear inside a script element; the JSON escape keeps the data intact
+        data = json.dumps(shortages, separators=(',', ':'), ensure_ascii=False).replace('</', '<\\/')
+        out.write(HTML_SHORTAGE_SECTION.substitute(
+            count=f"{len(shortages):,}", data=data, page_size=HTML_SHORTAGE_PAGE_SIZE
+        ))
+
+    if po_status is not None and not po_status.empty:
+        po_rows = list(po_status[['RM Code', 'Quantity', 'Arrival Date', 'Status']].itertuples(index=False, name=None))
+        _write_html_table(out, "Purchase Order Delay Status",
+                          ["RM Code", "Quantity", "Arrival Date", "Status"],
+                          po_rows, HTML_PO_ROW, _po_row)
+
+    out.write(HTML_REPORT_TAIL.substitute(
+        calculation_margin=calculation_margin,
+        fifo_order=escape(', '.join(fifo_order)) if fifo_order else 'Not set',
+        generated=generated,
+    ))
+
+def generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                         calculation_margin, fifo_order):
+    out = io.StringIO()
+    write_html_report(out, results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                      calculation_margin, fifo_order)
+    return out.getvalue()
+
+# Function to generate PDF report
+def generate_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                    calculation_margin, fifo_order, errors=None):
+    try:
+        from reportlab.lib.pagesizes import A4
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib import colors
+        
+        buffer = io.BytesIO()
+        
+        doc = SimpleDocTemplate(buffer, pagesize=A4, 
+                              rightMargin=72, leftMargin=72,
+                              topMargin=72, bottomMargin=72)
+        
+        elements = []
+        styles = getSampleStyleSheet()
+        
+        title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=18,
+            spaceAfter=30,
+            alignment=1
+        )
+        
+        heading_style = ParagraphStyle(
+            'CustomHeading',
+            parent=styles['Heading2'],
+            fontSize=14,
+            spaceAfter=12,
+            spaceBefore=12
+        )
+        
+        normal_style = styles['Normal']
+        
+        elements.append(Paragraph("MRP Production Planning Summary Report", title_style))
+        elements.append(Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", normal_style))
+        elements.append(Paragraph(f"Production Date: {prod_date.strftime('%d/%m/%Y')}", normal_style))
+        elements.append(Spacer(1, 20))
+        
+        elements.append(Paragraph("Summary Metrics", heading_style))
+        
+        summary_data = [
+            ["Metric", "Value"],
+            ["Planned Production Date", prod_date.strftime('%d/%m/%Y')],
+            ["Producible FG Types", str(len(ready_fgs))],
+            ["Total Production Volume", f"{total_volume:,.1f} Kg"],
+            ["Delayed Purchase Orders", str(delayed_pos)]
+        ]
+        
+        summary_table = Table(summary_data, colWidths=[200, 150])
+        summary_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 12),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ]))
+        elements.append(summary_table)
+        elements.append(Spacer(1, 20))
+        
+        elements.append(Paragraph("Production Capability List", heading_style))
+        
+        if results:
+            table_data = [["FG Code", "Expected", "Max (Kg)", "Actual (Kg)", "Status", "Missing RM", "Batches"]]
+            
+            for item in results:
+                table_data.append([
+                    item['FG'],
+                    item['Expected'],
+                    item['Max'],
+                    item['Actual'],
+                    item['Status'],
+                    item['Missing'],
+                    str(item['Batches'])
+                ])
+            
+            prod_table = Table(table_data, colWidths=[70, 60, 60, 60, 60, 70, 50])
+            prod_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, 0), 10),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+                ('FONTSIZE', (0, 1), (-1, -1), 9),
+            ]))
+            elements.append(prod_table)
+            elements.append(Spacer(1, 20))
+        
+        shortage_exists = False
+        for fg in shortage_details:
+            if shortage_details[fg]:
+                shortage_exists = True
+                break
+        
+        if shortage_exists:
+            elements.append(Paragraph("Shortage Details", heading_style))
+            
+            for fg in shortage_details:
+                if shortage_details[fg]:
+                    elements.append(Paragraph(f"FG Code: {fg}", styles['Heading3']))
+                    for item in shortage_details[fg]:
+                        elements.append(Paragraph(f"• {item}", normal_style))
+                    elements.append(Spacer(1, 10))
+            elements.append(Spacer(1, 20))
+        
+        if po_status is not None and not po_status.empty:
+            elements.append(Paragraph("Purchase Order Delay Status", heading_style))
+            
+            po_data = [["RM Code", "Quantity", "Arrival Date", "Status"]]
+            
+            for _, row in po_status.iterrows():
+                arrival_date = row['Arrival Date']
+                arrival_str = arrival_date.strftime('%d/%m/%Y') if hasattr(arrival_date, 'strftime') else str(arrival_date)
+                    
+                po_data.append([
+                    str(row['RM Code']),
+                    f"{row['Quantity']:,.4f} Kg",
+                    arrival_str,
+                    row['Status']
+                ])
+            
+            po_table = Table(po_data, colWidths=[80, 80, 80, 80])
+            po_table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, 0), 10),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+                ('FONTSIZE', (0, 1), (-1, -1), 9),
+            ]))
+            elements.append(po_table)
+            elements.append(Spacer(1, 20))
+        
+        elements.append(Paragraph("System Settings", heading_style))
+        settings_text = f"""
+        • Decimal Precision: {calculation_margin} places
+        • FIFO Order: {', '.join(fifo_order) if fifo_order else 'Not set'}
+        • Report Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        """
+        elements.append(Paragraph(settings_text, normal_style))
+        
+        elements.append(Spacer(1, 30))
+        elements.append(Paragraph("RGI - Supply Chain Department", ParagraphStyle(
+            'CompanyFooter',
+            parent=styles['Normal'],
+            fontSize=12,
+            alignment=1,
+            textColor=colors.HexColor('#3498db'),
+            spaceBefore=20
+        )))
+        
+        elements.append(Spacer(1, 10))
+        elements.append(Paragraph("Report generated by MRP Dashboard System", ParagraphStyle(
+            'Footer',
+            parent=styles['Normal'],
+            fontSize=10,
+            alignment=1,
+            textColor=colors.grey
+        )))
+        elements.append(Paragraph("--- End of Report ---", ParagraphStyle(
+            'Footer',
+            parent=styles['Normal'],
+            fontSize=10,
+            alignment=1,
+            textColor=colors.grey
+        )))
+        
+        doc.build(elements)
+        
+        pdf_data = buffer.getvalue()
+        buffer.close()
+        
+        return pdf_data, "pdf"
+    
+    except ImportError:
+        html_content = generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                                            calculation_margin, fifo_order)
+        return html_content.encode('utf-8'), "html"
+    except Exception as e:
+        # Reports may be built on a worker thread, so errors are collected instead of rendered
+        if errors is not None:
+            errors.append(f"PDF generation error: {str(e)}")
+        else:
+            st.error(f"PDF generation error: {str(e)}")
+        html_content = generate_html_report(results, shortage_details, prod_date, total_volume, ready_fgs, delayed_pos, po_status,
+                                            calculation_margin, fifo_order)
+        return html_content.encode('utf-8'), "html"
+
+# NEW: Improved function to generate missing RM data based on Expected Capacities
+def generate_missing_rm_summary_from_results(results, shortage_details, fg_expected_capacity, where_used, calculation_margin):
+    """Generate missing RM summary based on actual production results and expected capacities.
+
+    Per-batch requirements come from the RM -> FG ``where_used`` index instead of
+    re-filtering the formula table for every FG and RM, and the per-RM summary is
+    a single grouped aggregation over the detailed rows.
+    """
+    missing_data = []
+    
+    # First, create a dictionary of actual production for each FG
+    fg_production = {}
+    for item in results:
+        fg_code = item['FG']
+        # Extract actual capacity from the string "X,XXX.X Kg"
+        actual_str = item['Actual'].replace(' Kg', '').replace(',', '')
+        try:
+            actual_capacity = float(actual_str)
+            fg_production[fg_code] = actual_capacity
+        except:
+            fg_production[fg_code] = 0
+    
+    # Process each FG that has shortage details
+    for fg_code, shortage_items in shortage_details.items():
+        if not shortage_items:
+            continue
+            
+        # Get expected capacity for this FG
+        expected_capacity = fg_expected_capacity.get(fg_code, 0)
+        actual_capacity = fg_production.get(fg_code, 0)
+        
+        # Calculate batches based on actual production (not expected)
+        actual_batches = int(actual_capacity // 25) if actual_capacity >= 25 else 0
+        
+        for item in shortage_items:
+            if "Shortage" in item:
+                try:
+                    # Extract RM Code
+                    rm_code = item.split(":")[0].strip()
+                    
+                    # Find this RM in the FG's formula
+                    req_per_batch = where_used.requirement(fg_code, rm_code)
+                    if req_per_batch is None:
+                        continue
+                    
+                    # Parse the shortage string
+                    # Format: "RM123: Required X.XXXX Kg, Available Y.YYYY Kg, Shortage Z.ZZZZ Kg"
+                    shortage_match = re.search(r'Shortage ([\d.]+)', item)
+                    if shortage_match:
+                        shortage_qty = float(shortage_match.group(1))
+                        
+                        # Calculate total required based on what we tried to produce
+                        # If expected capacity > 0, use that to calculate required
+                        if expected_capacity > 0:
+                            expected_batches = max(1, int(expected_capacity // 25))
+                            total_required = req_per_batch * expected_batches
+                        else:
+                            # If no expected capacity, use maximum possible
+                            total_required = req_per_batch * actual_batches if actual_batches > 0 else 0
+                        
+                        # Get available from stock (required - shortage)
+                        available_qty = total_required - shortage_qty if total_required > shortage_qty else 0
+                        
+                        missing_data.append({
+                            'FG Code': fg_code,
+                            'RM Code': rm_code,
+                            'Expected Capacity (Kg)': expected_capacity,
+                            'Actual Production (Kg)': actual_capacity,
+                            'Required per Batch (Kg)': req_per_batch,
+                            'Total Required (Kg)': total_required,
+                            'Available (Kg)': available_qty,
+                            'Shortage (Kg)': shortage_qty
+                        })
+                except Exception as e:
+                    # If parsing fails, skip this item
+                    continue
+    
+    if missing_data:
+        # Create detailed DataFrame, rounding the quantity columns in one go
+        detailed_df = pd.DataFrame(missing_data)
+        qty_columns = ['Required per Batch (Kg)', 'Total Required (Kg)', 'Available (Kg)', 'Shortage (Kg)']
+        detailed_df[qty_columns] = detailed_df[qty_columns].astype(float).round(calculation_margin)
+        
+        # Create summary DataFrame (group by RM Code) in a single grouped pass
+        if not detailed_df.empty:
+            by_rm = detailed_df.groupby('RM Code', sort=False)
+            totals = by_rm[['Total Required (Kg)', 'Available (Kg)', 'Shortage (Kg)']].sum().round(calculation_margin)
+            
+            # Affected FG lists: unique (RM, FG) pairs bucketed by RM position
+            fg_pairs = detailed_df.drop_duplicates(['RM Code', 'FG Code'])
+            rm_pos = totals.index.get_indexer(fg_pairs['RM Code'])
+            fg_counts = np.bincount(rm_pos, minlength=len(totals))
+            fg_groups = np.split(fg_pairs['FG Code'].to_numpy()[np.argsort(rm_pos, kind='stable')], np.cumsum(fg_counts)[:-1])
+            
+            summary_df = pd.DataFrame({
+                'RM Code': totals.index,
+                'Total Required (Kg)': totals['Total Required (Kg)'].to_numpy(),
+                'Total Available (Kg)': totals['Available (Kg)'].to_numpy(),
+                'Total Shortage (Kg)': totals['Shortage (Kg)'].to_numpy(),
+                'Affected FG Codes': [', '.join(fgs) for fgs in fg_groups],
+                'Number of Affected FGs': fg_counts
+            })
+            return detailed_df, summary_df
+    
+    return pd.DataFrame(), pd.DataFrame()
+
+# Function to convert "1,234.5 Kg" display strings back to numbers
+def kg_to_float(series):
+    return series.str.replace(' Kg', '').str.replace(',', '').astype(float)
+
+# Function to build the impact of one RM on the planned FGs
+def build_rm_impact(where_used, rm_code, results, shortage_table_df):
+    """Affected FGs of ``rm_code`` with their planned batches and the output lost to this RM.
+
+    FGs are found through the where-used index. An FG counts as short of the RM
+    when the RM appears in its shortage table; its lost output is the gap
+    between the targeted batches (expected capacity, or the stock-based
+    maximum in auto mode) and the batches actually planned.
+    """
+    fg_codes, req_per_batch = where_used.where_used(rm_code)
+    impact = pd.DataFrame({'FG Code': fg_codes, 'Required per Batch (Kg)': req_per_batch})
+    
+    res_df = pd.DataFrame(results, columns=['FG', 'Expected', 'Max', 'Actual', 'Status', 'Missing', 'Batches'])
+    res_df['FIFO Position'] = range(1, len(res_df) + 1)
+    expected_kg = pd.to_numeric(res_df['Expected'].str.replace(' Kg', '').str.replace(',', ''), errors='coerce')
+    actual_kg = kg_to_float(res_df['Actual'])
+    target_kg = (expected_kg // 25).clip(lower=1) * 25
+    target_kg = target_kg.where(expected_kg.notna(), kg_to_float(res_df['Max']))
+    res_df['Lost Output (Kg)'] = (target_kg - actual_kg).clip(lower=0)
+    
+    rm_shortages = shortage_table_df.loc[shortage_table_df['RM Code'] == rm_code, ['FG Code', 'Shortage (Kg)']]
+    rm_shortages = rm_shortages.rename(columns={'Shortage (Kg)': 'RM Shortage (Kg)'})
+    
+    impact = impact.merge(
+        res_df[['FG', 'FIFO Position', 'Batches', 'Status', 'Lost Output (Kg)']].rename(columns={'FG': 'FG Code'}),
+        on='FG Code', how='left'
+    ).merge(rm_shortages, on='FG Code', how='left')
+    
+    short = impact['RM Shortage (Kg)'].notna()
+    impact['Lost Output (Kg)'] = impact['Lost Output (Kg)'].where(short, 0.0)
+    impact['RM Shortage (Kg)'] = impact['RM Shortage (Kg)'].fillna(0.0)
+    impact['Status'] = impact['Status'].fillna("Not in plan")
+    impact['Batches'] = impact['Batches'].fillna(0).astype(int)
+    
+    return impact.sort_values(['FIFO Position', 'FG Code'], na_position='last')[
+        ['FG Code', 'FIFO Position', 'Required per Batch (Kg)', 'Batches', 'Status', 'RM Shortage (Kg)', 'Lost Output (Kg)']
+    ]
+
+# --- Excel export pipeline ---
+# Every sheet is serialized once into plain row tuples and the workbooks are
+# assembled from those parts with openpyxl's write-only (streaming) mode, so a
+# sheet shared by several downloads (e.g. "Production Summary") is built once.
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def serialize_sheet(df):
+    """Serialize a DataFrame into a header row and plain-Python row tuples"""
+    values = df.astype(object).where(df.notna(), None)
+    return [str(col) for col in df.columns], list(values.itertuples(index=False, name=None))
+
+def write_workbook(sheet_parts):
+    """Stream serialized sheets into a write-only workbook.
+
+    ``sheet_parts`` is a list of ``(sheet title, (header, rows))`` tuples.
+    """
+    wb = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    
+    for title, (header, rows) in sheet_parts:
+        ws = wb.create_sheet(title=title)
+        header_cells = []
+        for name in header:
+            cell = WriteOnlyCell(ws, value=name)
+            cell.font = header_font
+            header_cells.append(cell)
+        ws.append(header_cells)
+        for row in rows:
+            ws.append(row)
+    
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
+def build_export_workbooks(parts, bundles):
+    """Build several workbooks from a shared set of sheet parts.
+
+    ``parts`` maps a part key to a DataFrame and ``bundles`` maps a workbook
+    name to a list of ``(sheet title, part key)`` pairs. Each part used by any
+    bundle is serialized exactly once; empty or missing parts are skipped.
+    """
+    serialized = {}
+    workbooks = {}
+    
+    for bundle_name, layout in bundles.items():
+        sheet_parts = []
+        for title, key in layout:
+            df = parts.get(key)
+            if df is None or df.empty:
+                continue
+            if key not in serialized:
+                serialized[key] = serialize_sheet(df)
+            sheet_parts.append((title, serialized[key]))
+        if sheet_parts:
+            workbooks[bundle_name] = write_workbook(sheet_parts)
+    
+    return workbooks
+
+DATA_QUALITY_LAYOUT = [
+    ('Summary', 'quality_summary'),
+    ('Issues', 'quality_issues'),
+]
+
+# Function to generate the data-quality report workbook
+def generate_data_quality_excel(issues):
+    """Generate Excel file with a per-check summary and every data-quality finding"""
+    parts = {
+        'quality_summary': issues.groupby(['Severity', 'Table', 'Check'], sort=False).size().reset_index(name='Count'),
+        'quality_issues': issues,
+    }
+    return build_export_workbooks(parts, {'quality': DATA_QUALITY_LAYOUT})['quality']
+
+def build_shortage_raw_df(shortage_details):
+    """Flatten shortage details into one row per (FG Code, shortage line)"""
+    shortage_list = [
+        {'FG Code': fg_code, 'Shortage Details': item}
+        for fg_code, items in shortage_details.items()
+        for item in items
+    ]
+    return pd.DataFrame(shortage_list, columns=['FG Code', 'Shortage Details'])
+
+def shortage_purchase_recommendations(summary_df, po_index, supplier_terms, prod_date, defaults=None):
+    """Suggested POs for the RM shortages of a plan, needed by the production date"""
+    if summary_df.empty:
+        return pd.DataFrame()
+    shortages = summary_df.rename(columns={'Total Shortage (Kg)': 'Shortage (Kg)'})
+    recs = recommend_purchases(shortages, po_index, supplier_terms, prod_date, datetime.now(), defaults)
+    affected = summary_df.set_index('RM Code')
+    recs['Affected Production'] = (affected['Number of Affected FGs'].astype(str) + ' FG(s): '
+                                   + affected['Affected FG Codes']).reindex(recs['RM Code']).to_numpy()
+    return recs
+
+def build_missing_rm_report_parts(detailed_df, summary_df, prod_date, purchase_recs=None):
+    """Build the sheets of the complete missing RM report as export parts"""
+    parts = {}
+    
+    # Sheet 1: Executive Summary
+    parts['missing_exec_summary'] = pd.DataFrame({
+        'Report Type': ['Missing RM Analysis Report'],
+        'Production Date': [prod_date.strftime('%Y-%m-%d')],
+        'Report Generated': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
+        'Total Missing RM Types': [len(summary_df) if not summary_df.empty else 0],
+        'Total Shortage Quantity (Kg)': [summary_df['Total Shortage (Kg)'].sum() if not summary_df.empty else 0],
+        'Total Affected FGs': [len(set(detailed_df['FG Code'])) if not detailed_df.empty else 0]
+    })
+    
+    # Sheet 2: RM Summary (Priority View)
+    if not summary_df.empty:
+        priority_summary = summary_df.copy()
+        priority_summary = priority_summary.sort_values('Total Shortage (Kg)', ascending=False)
+        priority_summary['Priority'] = range(1, len(priority_summary) + 1)
+        parts['rm_priority_list'] = priority_summary[['Priority', 'RM Code', 'Total Shortage (Kg)', 
+                                                      'Total Required (Kg)', 'Total Available (Kg)', 
+                                                      'Number of Affected FGs', 'Affected FG Codes']]
+    
+    # Sheet 3: Detailed FG Breakdown
+    if not detailed_df.empty:
+        parts['missing_detailed_sorted'] = detailed_df.sort_values(['RM Code', 'FG Code'])
+    
+    # Sheet 4: Action Required, from the procurement recommendations (open POs, MOQ, lot size, lead time)
+    if not summary_df.empty:
+        if purchase_recs is None:
+            purchase_recs = shortage_purchase_recommendations(summary_df, None, None, prod_date)
+        parts['action_items'] = purchase_recs[['RM Code', 'Shortage (Kg)', 'Net Requirement (Kg)', 'Suggested Order (Kg)',
+                                               'Order By', 'Need By', 'Priority', 'Action Required', 'Affected Production']]
+        
+        # Sheet 5: Suggested POs
+        parts['suggested_pos'] = purchase_recs.loc[
+            purchase_recs['Suggested Order (Kg)'] > 0,
+            ['RM Code', 'Suggested Order (Kg)', 'Order By', 'Need By', 'Lead Time (days)', 'MOQ (Kg)', 'Lot Size (Kg)']
+        ]
+    
+    return parts
+
+MISSING_RM_EXCEL_LAYOUT = [
+    ('Missing RM Detailed', 'missing_detailed'),
+    ('Missing RM Summary', 'missing_summary'),
+    ('FG Production Status', 'production_summary'),
+    ('Raw Shortage Data', 'shortage_raw'),
+]
+
+ALLOCATION_LEDGER_LAYOUT = [
+    ('Allocation Ledger', 'allocation_ledger'),
+    ('Residual Stock', 'rm_residual'),
+]
+
+COMPLETE_MISSING_RM_LAYOUT = [
+    ('Executive Summary', 'missing_exec_summary'),
+    ('RM Priority List', 'rm_priority_list'),
+    ('Detailed Analysis', 'missing_detailed_sorted'),
+    ('Action Items', 'action_items'),
+    ('Suggested POs', 'suggested_pos'),
+]
+
+# Function to generate Excel file with multiple sheets
+def generate_missing_rm_excel(detailed_df, summary_df, shortage_details, results, prod_date):
+    """Generate Excel file with multiple sheets for missing RM analysis"""
+    parts = {
+        'missing_detailed': detailed_df,
+        'missing_summary': summary_df,
+        'production_summary': pd.DataFrame(results),
+        'shortage_raw': build_shortage_raw_df(shortage_details),
+    }
+    return build_export_workbooks(parts, {'missing_rm': MISSING_RM_EXCEL_LAYOUT})['missing_rm']
+
+# Function to generate All Missing RM Report
+def generate_all_missing_rm_report(detailed_df, summary_df, prod_date, purchase_recs=None):
+    """Generate a comprehensive Excel report with all missing RM data"""
+    parts = build_missing_rm_report_parts(detailed_df, summary_df, prod_date, purchase_recs)
+    return build_export_workbooks(parts, {'complete': COMPLETE_MISSING_RM_LAYOUT})['complete']
+
+# NEW: Function to generate shortage details table for Excel export
+def generate_shortage_details_table(shortage_details, calculation_margin):
+    """Generate a table with FG code, RM code, Required, and Available columns from shortage details"""
+    shortage_data = []
+    
+    for fg_code, items in shortage_details.items():
+        for item in items:
+            if "Shortage" in item or "Required" in item:
+                try:
+                    # Parse the item string
+                    # Format examples:
+                    # "RM123: Required 100.0000 Kg for 4 batches, Available 50.0000 Kg, Shortage 50.0000 Kg"
+                    # "RM123: Required 25.0000 Kg per batch, Available 0.0000 Kg, Shortage 25.0000 Kg"
+                    
+                    # Extract RM Code
+                    rm_code = item.split(":")[0].strip()
+                    
+                    # Extract Required quantity
+                    required_match = re.search(r'Required ([\d.]+)', item)
+                    required_qty = float(required_match.group(1)) if required_match else 0
+                    
+                    # Extract Available quantity
+                    available_match = re.search(r'Available ([\d.]+)', item)
+                    available_qty = float(available_match.group(1)) if available_match else 0
+                    
+                    shortage_data.append({
+                        'FG Code': fg_code,
+                        'RM Code': rm_code,
+                        'Required (Kg)': round(required_qty, calculation_margin),
+                        'Available (Kg)': round(available_qty, calculation_margin),
+                        'Shortage (Kg)': round(required_qty - available_qty, calculation_margin)
+                    })
+                except Exception as e:
+                    # If parsing fails, skip this item
+                    continue
+    
+    if shortage_data:
+        return pd.DataFrame(shortage_data)
+    else:
+        return pd.DataFrame(columns=['FG Code', 'RM Code', 'Required (Kg)', 'Available (Kg)', 'Shortage (Kg)'])
+
+# Function to build the Excel downloads of one analysis from shared sheet parts
+def build_analysis_workbooks(results, shortage_table_df, detailed_missing_df, summary_missing_df,
+                             prod_date, total_volume, ready_fgs, purchase_recs=None, allocation_ledger=None,
+                             rm_residual=None):
+    """Serialize every sheet once and assemble the Excel downloads from the shared parts"""
+    export_parts = {
+        'shortage_table': shortage_table_df,
+        'production_summary': pd.DataFrame(results),
+        'allocation_ledger': allocation_ledger,
+        'rm_residual': rm_residual,
+        'missing_summary': summary_missing_df,
+        'production_exec_summary': pd.DataFrame({
+            'Report Type': ['Production Planning Report'],
+            'Production Date': [prod_date.strftime('%Y-%m-%d')],
+            'Report Generated': [datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
+            'Total FG Types': [len(results)],
+            'Total Production Volume (Kg)': [total_volume],
+            'Producible FGs': [len(ready_fgs)]
+        }),
+    }
+    has_missing_report = not detailed_missing_df.empty and not summary_missing_df.empty
+    if has_missing_report:
+        export_parts.update(build_missing_rm_report_parts(detailed_missing_df, summary_missing_df, prod_date,
+                                                          purchase_recs))
+    
+    export_bundles = {}
+    if results:
+        if not shortage_table_df.empty:
+            export_bundles['shortage'] = [
+                ('Shortage Details', 'shortage_table'),
+                ('Production Summary', 'production_summary'),
+                ('Missing RM Summary', 'missing_summary'),
+            ]
+        else:
+            export_bundles['production_summary'] = [('Production Summary', 'production_summary')]
+        
+        if has_missing_report:
+            export_bundles['complete'] = COMPLETE_MISSING_RM_LAYOUT
+        else:
+            export_bundles['basic'] = [
+                ('Production Summary', 'production_summary'),
+                ('Executive Summary', 'production_exec_summary'),
+            ]
+        
+        # Every plan download carries what the plan consumes and leaves behind
+        for layout_name in export_bundles:
+            export_bundles[layout_name] = export_bundles[layout_name] + ALLOCATION_LEDGER_LAYOUT
+    
+    return build_export_workbooks(export_parts, export_bundles)
+
+# --- Columnar plan export ---
+# Downstream schedulers and BI tools read the plan as typed tables instead of
+# the formatted Excel sheets: each table is converted to Arrow in one call and
+# written as Parquet or Arrow IPC, next to a manifest that records the input
+# fingerprint the plan was computed from. Bundles go under PLAN_EXPORT_DIR, set
+# by the server (MRP_EXPORT_DIR) like the run history, and are offered as a zip.
+PLAN_EXPORT_FORMATS = {'parquet': "Parquet", 'arrow': "Arrow IPC (Feather)"}
+PLAN_EXPORT_DIR = os.path.abspath(os.environ.get("MRP_EXPORT_DIR", "mrp_exports"))
+
+def typed_results_frame(results):
+    """The plan results with quantities as numbers instead of display strings"""
+    res_df = pd.DataFrame(results, columns=['FG', 'Expected', 'Max', 'Actual', 'Status', 'Missing', 'Batches'])
+    return pd.DataFrame({
+        'FG Code': res_df['FG'].astype(str),
+        'FIFO Position': np.arange(1, len(res_df) + 1, dtype=np.int64),
+        'Expected (Kg)': pd.to_numeric(res_df['Expected'].str.replace(' Kg', '').str.replace(',', ''), errors='coerce'),
+        'Max (Kg)': kg_to_float(res_df['Max']),
+        'Actual (Kg)': kg_to_float(res_df['Actual']),
+        'Batches': res_df['Batches'].astype(np.int64),
+        'Ready': res_df['Status'].str.contains("✅", regex=False),
+        'Missing RMs': pd.to_numeric(res_df['Missing'].str.extract(r'(\d+)', expand=False), errors='coerce')
+                         .fillna(0).astype(np.int64),
+    })
+
+def plan_export_tables(analysis):
+    """{name: DataFrame} of the typed plan tables in a columnar export"""
+    return {
+        'results': typed_results_frame(analysis['results']),
+        'shortages': analysis['shortage_table_df'],
+        'allocations': analysis['allocation_ledger'],
+        'rm_residual': analysis['rm_residual'],
+        'draws': analysis['location_draws'],
+        'residual_stock': analysis['residual_stock'],
+    }
+
+def input_fingerprint(inputs):
+    """Content hash of every input table and setting a plan was computed from"""
+    def table(df):
+        digest = int(pd.util.hash_pandas_object(df, index=False).sum()) if len(df) else 0
+        return {'rows': len(df), 'columns': list(df.columns), 'hash': f"{digest & 0xFFFFFFFFFFFFFFFF:016x}"}
+    
+    fingerprint = {
+        'tables': {
+            'rm_stock': table(inputs['location_stock']),
+            'rm_po': table(inputs['po_index'].schedule()),
+            'fg_formulas': table(inputs['fg_formulas']),
+            'supplier_terms': table(inputs['supplier_terms']),
+        },
+        'settings': {
+            'production_date': inputs['prod_date'].isoformat(),
+            'fg_order': inputs['fg_order'],
+            'fg_expected_capacity': {fg: float(kg) for fg, kg in inputs['fg_expected_capacity'].items()},
+            'calculation_margin': inputs['calculation_margin'],
+            'fixed_point': inputs['fixed_point'],
+            'allocation_policy': inputs['allocation_policy'],
+            'fg_weights': {fg: float(w) for fg, w in inputs['fg_weights'].items()},
+            'location_rule': inputs['location_rule'],
+            'procurement_defaults': inputs['procurement_defaults'],
+        },
+    }
+    canonical = json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')
+    fingerprint['digest'] = hashlib.sha256(canonical).hexdigest()
+    return fingerprint
+
+def write_plan_bundle(analysis, directory, fmt='parquet'):
+    """Write the plan tables and a manifest.json into a new bundle folder under ``directory``.
+
+    Needs pyarrow; raises ImportError without it. Returns the bundle path.
+    """
+    import pyarrow as pa
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        write, suffix = pq.write_table, 'parquet'
+    else:
+        import pyarrow.feather as feather
+        write, suffix = feather.write_feather, 'arrow'
+    
+    fingerprint = analysis['input_fingerprint']
+    created = datetime.now()
+    bundle = os.path.join(directory, f"mrp_plan_{created.strftime('%Y%m%d_%H%M%S')}_{fingerprint['digest'][:8]}")
+    os.makedirs(bundle, exist_ok=True)
+    
+    tables = {}
+    for name, df in plan_export_tables(analysis).items():
+        arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+        file_name = f"{name}.{suffix}"
+        write(arrow_table, os.path.join(bundle, file_name))
+        tables[name] = {
+            'file': file_name,
+            'rows': arrow_table.num_rows,
+            'schema': {field.name: str(field.type) for field in arrow_table.schema},
+        }
+    
+    manifest = {
+        'created': created.isoformat(timespec='seconds'),
+        'format': fmt,
+        'production_date': analysis['prod_date'].isoformat(),
+        'input_fingerprint': fingerprint,
+        'summary': {
+            'fgs': len(analysis['results']),
+            'ready_fgs': len(analysis['ready_fgs']),
+            'total_volume_kg': analysis['total_volume'],
+            'delayed_pos': analysis['delayed_pos'],
+        },
+        'tables': tables,
+    }
+    with open(os.path.join(bundle, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    return bundle
+
+def zip_plan_bundle(bundle):
+    """The bundle folder as zip bytes, its files under the bundle's name"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for entry in sorted(os.scandir(bundle), key=lambda entry: entry.name):
+            archive.write(entry.path, os.path.join(os.path.basename(bundle), entry.name))
+    return output.getvalue()
+
+# --- Run history ---
+# With history on (session key history_enabled, off by default), every finished analysis is saved as a
+# Parquet plan bundle (see above) under HISTORY_DIR, so earlier runs survive new clicks of Generate. The
+# folder is set by the server (MRP_HISTORY_DIR), never by a session, and only the newest HISTORY_MAX_RUNS
+# bundles are kept. Runs are listed from their manifests and two of them are compared with diff_plans on
+# their typed tables.
+HISTORY_DIR = os.path.abspath(os.environ.get("MRP_HISTORY_DIR", "mrp_history"))
+HISTORY_MAX_RUNS = int(os.environ.get("MRP_HISTORY_MAX_RUNS", "50"))
+
+def prune_history(directory, keep=HISTORY_MAX_RUNS):
+    """Delete all but the newest ``keep`` plan bundles under ``directory``"""
+    bundles = sorted(
+        (entry.path for entry in os.scandir(directory)
+         if entry.is_dir() and entry.name.startswith('mrp_plan_')),
+        key=os.path.basename, reverse=True
+    )
+    for path in bundles[keep:]:
+        # Another session may be pruning the same folder
+        shutil.rmtree(path, ignore_errors=True)
+
+def save_run_to_history(analysis, directory=HISTORY_DIR):
+    """Write the run into the history directory and prune it; returns (bundle path, error message)"""
+    try:
+        bundle = write_plan_bundle(analysis, directory, 'parquet')
+        prune_history(directory)
+        return bundle, None
+    except ImportError:
+        return None, "Run history needs pyarrow (pip install pyarrow)."
+    except OSError as e:
+        return None, f"Could not save the run to history: {str(e)}"
+
+def list_history_runs(directory):
+    """Saved runs under ``directory``, newest first, read from their manifests"""
+    rows = []
+    if os.path.isdir(directory):
+        for entry in os.scandir(directory):
+            manifest_path = os.path.join(entry.path, 'manifest.json')
+            if not entry.is_dir() or not os.path.exists(manifest_path):
+                continue
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            summary = manifest.get('summary', {})
+            rows.append({
+                'Run': entry.name,
+                'Created': manifest['created'].replace('T', ' '),
+                'Production Date': manifest['production_date'],
+                'FGs': summary.get('fgs'),
+                'Ready FGs': summary.get('ready_fgs'),
+                'Total Volume (Kg)': summary.get('total_volume_kg'),
+                'Input Fingerprint': manifest['input_fingerprint']['digest'][:12],
+                'path': entry.path,
+                'manifest': manifest,
+            })
+    runs = pd.DataFrame(rows, columns=['Run', 'Created', 'Production Date', 'FGs', 'Ready FGs', 'Total Volume (Kg)',
+                                       'Input Fingerprint', 'path', 'manifest'])
+    return runs.sort_values('Created', ascending=False, kind='stable').reset_index(drop=True)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_history_run(path):
+    """The typed plan tables of a saved run (runs never change once written)"""
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    read = pq.read_table if manifest['format'] == 'parquet' else feather.read_table
+    return {name: read(os.path.join(path, table['file'])).to_pandas() for name, table in manifest['tables'].items()}
+
+def changed_inputs(old_manifest, new_manifest):
+    """Names of the input tables and settings that differ between two runs"""
+    old_fp, new_fp = old_manifest['input_fingerprint'], new_manifest['input_fingerprint']
+    changed = [name for name, table in new_fp['tables'].items()
+               if old_fp['tables'].get(name, {}).get('hash') != table['hash']]
+    changed += [name for name, value in new_fp['settings'].items() if old_fp['settings'].get(name) != value]
+    return changed
+
+# --- Background analysis jobs ---
+# The plan and its reports run on a shared worker pool so the script thread
+# only renders. Jobs work on snapshots of the session data and never touch
+# st.* APIs; the page polls their progress from a fragment.
+ANALYSIS_WORKERS = 4
+BOTTLENECK_EXTRA_BATCHES = 5
+
+@st.cache_resource
+def get_job_executor():
+    return ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="mrp-analysis")
+
+# Order search scores candidates on separate processes; on a single core it runs inline
+ORDER_SEARCH_WORKERS = min(4, os.cpu_count() or 1)
+
+@st.cache_resource
+def get_order_search_pool():
+    if ORDER_SEARCH_WORKERS < 2:
+        return None
+    return ProcessPoolExecutor(max_workers=ORDER_SEARCH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+class AnalysisJob:
+    """A planning run submitted to the background worker pool"""
+    
+    def __init__(self, fingerprint, total_fgs):
+        self.fingerprint = fingerprint
+        self.total_fgs = total_fgs
+        self.done_fgs = 0
+        self.stage = "Queued"
+        self.cancel_event = threading.Event()
+        self.future = None
+    
+    def report_progress(self, done, total):
+        self.done_fgs = done
+        self.total_fgs = total
+    
+    def cancel(self):
+        self.cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+    
+    def fraction(self):
+        if self.stage == "Building reports":
+            return 1.0
+        return self.done_fgs / self.total_fgs if self.total_fgs else 0.0
+    
+    def status_text(self):
+        if self.stage == "Planning":
+            return f"⏳ Planning: {self.done_fgs:,} of {self.total_fgs:,} FGs processed"
+        return f"⏳ {self.stage}..."
+
+def run_analysis_job(job, inputs):
+    """Worker entry point: run the plan and build every report for one snapshot of inputs"""
+    job.stage = "Planning"
+    decimal_places = inputs['calculation_margin']
+    prod_date = inputs['prod_date']
+    
+    allocation_ledger = AllocationLedger(decimal_places)
+    results, shortage_details = compute_production_plan(
+        inputs['rm_stock'],
+        inputs['fg_formulas'],
+        inputs['fg_order'],
+        inputs['fg_expected_capacity'],
+        decimal_places,
+        progress=job.report_progress,
+        cancel_event=job.cancel_event,
+        fixed_point=inputs['fixed_point'],
+        skip_fgs=inputs['skip_fgs'],
+        policy=inputs['allocation_policy'],
+        fg_weights=inputs['fg_weights'],
+        ledger=allocation_ledger
+    )
+    
+    # Bottlenecks come from the same requirement matrix, not from re-planning
+    requirement_matrix = RequirementMatrix(inputs['fg_formulas'], inputs['fg_order'], decimal_places)
+    sensitivity_planner = SensitivityPlanner(requirement_matrix, inputs['rm_stock'], inputs['fg_expected_capacity'],
+                                             fixed_point=inputs['fixed_point'], policy=inputs['allocation_policy'],
+                                             fg_weights=inputs['fg_weights'], skip_fgs=inputs['skip_fgs'])
+    bottlenecks = bottleneck_analysis(requirement_matrix, inputs['rm_stock'], results,
+                                      inputs['fg_expected_capacity'], BOTTLENECK_EXTRA_BATCHES,
+                                      available=sensitivity_planner.line_available())
+    
+    # The plan is sized on pooled stock; split each allocation over the locations,
+    # lot by lot (first-expired-first-out) when the stock is kept per lot
+    stock_rows = usable_stock(inputs['location_stock'], prod_date)
+    location_stock = LocationStock(stock_rows, requirement_matrix.rm_codes, decimal_places)
+    rank = location_rank(location_stock.locations, inputs['location_rule'],
+                         inputs['location_priority'], inputs['location_transfer_cost'])
+    batches = planned_batches(requirement_matrix, results)
+    if 'Expiry Date' in stock_rows.columns:
+        # Unused RMs get queues too so their expiring lots show up in the risk report
+        planned_rms = set(requirement_matrix.rm_codes)
+        lot_rm_codes = list(requirement_matrix.rm_codes) + [rm for rm in stock_rows['RM Code'].unique()
+                                                            if rm not in planned_rms]
+        lot_queue = LotQueue(stock_rows, lot_rm_codes, decimal_places, location_stock.locations[rank])
+        location_draws_df, lot_remaining = fefo_draws(requirement_matrix, lot_queue, batches,
+                                                      inputs['location_transfer_cost'])
+        location_residual = residual_by_location(location_stock, location_draws_df, decimal_places)
+    else:
+        lot_queue = lot_remaining = None
+        location_draws_df, location_residual = location_draws(requirement_matrix, location_stock, batches, rank,
+                                                              inputs['location_transfer_cost'])
+    location_summary = summarize_location_draws(location_stock, location_draws_df, location_residual, rank)
+    residual_stock = residual_stock_table(stock_rows, location_stock, location_draws_df, location_residual)
+    
+    po_index = inputs['po_index']
+    if len(po_index):
+        po_status_for_report = po_index.schedule().assign(Status=po_index.status(prod_date))
+        delayed_pos = po_index.delayed_count(prod_date)
+    else:
+        po_status_for_report = None
+        delayed_pos = 0
+    
+    ready_fgs = [r for r in results if "✅" in r['Status']]
+    total_volume = sum(float(r['Actual'].replace(' Kg', '').replace(',', '')) 
+                      for r in results if r['Actual'] != "0.0 Kg")
+    
+    # Generate Missing RM Summary based on Expected Capacities
+    detailed_missing_df, summary_missing_df = generate_missing_rm_summary_from_results(
+        results, 
+        shortage_details,
+        inputs['fg_expected_capacity'],
+        inputs['where_used'],
+        decimal_places
+    )
+    
+    # Generate shortage details table for Excel export
+    shortage_table_df = generate_shortage_details_table(shortage_details, decimal_places)
+    
+    purchase_recommendations = shortage_purchase_recommendations(summary_missing_df, po_index, inputs['supplier_terms'],
+                                                                 prod_date, inputs['procurement_defaults'])
+    
+    if job.cancel_event.is_set():
+        raise PlanCancelled()
+    job.stage = "Building reports"
+    
+    analysis = {
+        'fingerprint': job.fingerprint,
+        'results': results,
+        'shortage_details': shortage_details,
+        'where_used': inputs['where_used'],
+        'rm_stock': inputs['rm_stock'],
+        'fg_expected_capacity': inputs['fg_expected_capacity'],
+        'requirement_matrix': requirement_matrix,
+        'bottlenecks': bottlenecks,
+        'sensitivity_planner': sensitivity_planner,
+        'location_draws': location_draws_df,
+        'location_summary': location_summary,
+        'residual_stock': residual_stock,
+        'allocation_ledger': allocation_ledger.frame(),
+        'rm_residual': allocation_ledger.residual(),
+        'lot_queue': lot_queue,
+        'lot_remaining': lot_remaining,
+        'stock_rows': latest_stock_rows(inputs['location_stock']),
+        'po_index': po_index,
+        'po_status_for_report': po_status_for_report,
+        'delayed_pos': delayed_pos,
+        'ready_fgs': ready_fgs,
+        'total_volume': total_volume,
+        'detailed_missing_df': detailed_missing_df,
+        'summary_missing_df': summary_missing_df,
+        'shortage_table_df': shortage_table_df,
+        'purchase_recommendations': purchase_recommendations,
+        'prod_date': prod_date,
+        'calculation_margin': decimal_places,
+        'fg_order': inputs['fg_order'],
+        'input_fingerprint': input_fingerprint(inputs),
+    }
+    build_analysis_exports(analysis)
+    # Sized here, off the UI thread, so the memory budget doesn't walk the whole session after every job.
+    # The cached indexes are shared with the session and counted under their own keys.
+    analysis['nbytes'] = estimate_nbytes(analysis, {id(inputs['where_used']), id(inputs['po_index'])})
+    analysis['history_run'], analysis['history_error'] = (
+        save_run_to_history(analysis) if inputs['history_enabled'] else (None, None)
+    )
+    return analysis
+
+def build_analysis_exports(analysis):
+    """(Re)build the PDF/HTML report and the Excel workbooks of an analysis in place"""
+    report_errors = []
+    try:
+        analysis['report_data'], analysis['report_type'] = generate_report(
+            analysis['results'],
+            analysis['shortage_details'],
+            analysis['prod_date'],
+            analysis['total_volume'],
+            analysis['ready_fgs'],
+            analysis['delayed_pos'],
+            analysis['po_status_for_report'],
+            analysis['calculation_margin'],
+            analysis['fg_order'],
+            errors=report_errors
+        )
+    except Exception as e:
+        analysis['report_data'], analysis['report_type'] = None, None
+        report_errors.append(f"Error generating report: {str(e)}")
+    
+    try:
+        analysis['workbooks'] = build_analysis_workbooks(
+            analysis['results'], analysis['shortage_table_df'], analysis['detailed_missing_df'],
+            analysis['summary_missing_df'], analysis['prod_date'], analysis['total_volume'], analysis['ready_fgs'],
+            analysis['purchase_recommendations'], analysis['allocation_ledger'], analysis['rm_residual']
+        )
+    except Exception as e:
+        analysis['workbooks'] = {}
+        report_errors.append(f"Error generating Excel file: {str(e)}")
+    
+    analysis['errors'] = report_errors
+    analysis['exports_evicted'] = False
+
+def summarize_location_draws(location_stock, draws, residual, rank):
+    """Stock, draws, transfer cost and what is left per location, in draw order"""
+    per_location = draws.groupby('Location')[['Drawn (Kg)', 'Transfer Cost']].sum()
+    locations = location_stock.locations[rank]
+    summary = pd.DataFrame({
+        'Draw Order': np.arange(1, len(locations) + 1),
+        'Location': locations,
+        'Stock (Kg)': location_stock.quantities[:, rank].sum(axis=0),
+        'Drawn (Kg)': per_location['Drawn (Kg)'].reindex(locations, fill_value=0.0).to_numpy(),
+        'Remaining (Kg)': residual[:, rank].sum(axis=0),
+        'Transfer Cost': per_location['Transfer Cost'].reindex(locations, fill_value=0.0).to_numpy(),
+    })
+    summary['FGs Served'] = draws.groupby('Location')['FG Code'].nunique().reindex(locations, fill_value=0).to_numpy()
+    return summary
+
+def residual_stock_table(stock_rows, location_stock, draws, residual):
+    """Stock, drawn and residual Kg per RM and location after the plan; RMs no FG uses keep all their stock"""
+    rm_idx, loc_idx = np.nonzero((location_stock.quantities > 0) | (residual > 0))
+    drawn = draws.groupby(['RM Code', 'Location'])['Drawn (Kg)'].sum()
+    planned = pd.DataFrame({
+        'RM Code': location_stock.rm_codes[rm_idx],
+        'Location': location_stock.locations[loc_idx],
+        'Stock (Kg)': location_stock.quantities[rm_idx, loc_idx],
+        'Residual (Kg)': residual[rm_idx, loc_idx],
+    })
+    planned['Drawn (Kg)'] = drawn.reindex(pd.MultiIndex.from_frame(planned[['RM Code', 'Location']]),
+                                          fill_value=0.0).to_numpy()
+    
+    unused = with_location(stock_rows)
+    unused = unused[~unused['RM Code'].isin(set(location_stock.rm_codes))]
+    unused = unused.groupby(['RM Code', 'Location'], sort=False)['Quantity'].sum().reset_index()
+    unused = unused.rename(columns={'Quantity': 'Stock (Kg)'}).assign(**{'Drawn (Kg)': 0.0})
+    unused['Residual (Kg)'] = unused['Stock (Kg)']
+    
+    columns = ['RM Code', 'Location', 'Stock (Kg)', 'Drawn (Kg)', 'Residual (Kg)']
+    return pd.concat([planned[columns], unused[columns]], ignore_index=True)
+
+def analysis_fingerprint(prod_date):
+    """Fingerprint of everything the analysis depends on, read from the session"""
+    fg_order = tuple(st.session_state.fg_analysis_order.keys())
+    capacities = tuple(float(st.session_state.fg_expected_capacity.get(fg, 0)) for fg in fg_order)
+    return (
+        st.session_state.data_versions['rm_stock'],
+        st.session_state.data_versions['rm_po'],
+        st.session_state.data_versions['fg_formulas'],
+        st.session_state.data_versions['supplier_terms'],
+        tuple(sorted(st.session_state.procurement_defaults.items())),
+        fg_order,
+        capacities,
+        st.session_state.calculation_margin,
+        st.session_state.fixed_point_mode,
+        st.session_state.allocation_policy,
+        tuple(sorted(priority_weights().items())),
+        st.session_state.location_rule,
+        tuple(sorted((loc, tuple(sorted(settings.items()))) for loc, settings in st.session_state.location_settings.items())),
+        prod_date,
+    )
+
+def priority_weights():
+    """Allocation weight per FG from its priority class (only used by the priority policy)"""
+    if st.session_state.allocation_policy != 'priority':
+        return {}
+    return {fg: PRIORITY_CLASS_WEIGHTS[st.session_state.fg_priority_class.get(fg, 'Medium')]
+            for fg in st.session_state.fg_analysis_order}
+
+def get_where_used_index():
+    """RM -> FG index of the current formulas, rebuilt only when the formulas change"""
+    return versioned_artefact('where_used', 'fg_formulas', lambda: WhereUsedIndex(st.session_state.fg_formulas))
+
+def get_po_index():
+    """Per-RM PO schedule with cumulative quantities, rebuilt only when the POs change"""
+    return versioned_artefact('po_index', 'rm_po', lambda: POIndex(st.session_state.rm_po))
+
+MASTER_TABLES = ('rm_stock', 'rm_po', 'fg_formulas')
+
+def get_pooled_stock(as_of=None):
+    """Stock per RM over all locations and lots, the table the planner reads.
+
+    With ``as_of`` (the production date) lots expired by then are left out.
+    """
+    # One entry per kind, so picking another production date replaces the dated table instead of piling up
+    name = 'pooled_stock' if as_of is None else 'pooled_stock_as_of'
+    return versioned_artefact(name, 'rm_stock', lambda: pooled_stock(usable_stock(st.session_state.rm_stock, as_of)),
+                              key=as_of)
+
+def stock_locations():
+    if st.session_state.rm_stock.empty:
+        return []
+    return sorted(with_location(st.session_state.rm_stock)['Location'].astype(str).unique())
+
+def location_setting(name):
+    """{location: value} of one column of the location settings"""
+    return {loc: settings[name] for loc, settings in st.session_state.location_settings.items()}
+
+def get_data_quality_report():
+    """Validation of the current master data, rebuilt only when one of the tables changes"""
+    def build():
+        ingestion_issues = [frame for table in MASTER_TABLES for frame in st.session_state.ingestion_issues[table]]
+        return validate_master_data(st.session_state.rm_stock, st.session_state.rm_po, st.session_state.fg_formulas,
+                                    ingestion_issues)
+    return versioned_artefact('data_quality', MASTER_TABLES, build)
+
+def snapshot_analysis_inputs(prod_date):
+    """Copy the session data a job needs so later edits can't race with it"""
+    return {
+        'rm_stock': get_pooled_stock(prod_date).copy(),
+        'location_stock': st.session_state.rm_stock.copy(),
+        'location_rule': st.session_state.location_rule,
+        'location_priority': location_setting('Priority'),
+        'location_transfer_cost': location_setting('Transfer Cost (per Kg)'),
+        'po_index': get_po_index(),
+        'supplier_terms': st.session_state.supplier_terms.copy(),
+        'procurement_defaults': dict(st.session_state.procurement_defaults),
+        'fg_formulas': st.session_state.fg_formulas.copy(),
+        'where_used': get_where_used_index(),
+        'skip_fgs': blocked_fgs(get_data_quality_report()),
+        'fg_order': list(st.session_state.fg_analysis_order.keys()),
+        'fg_expected_capacity': dict(st.session_state.fg_expected_capacity),
+        'calculation_margin': st.session_state.calculation_margin,
+        'fixed_point': st.session_state.fixed_point_mode,
+        'allocation_policy': st.session_state.allocation_policy,
+        'fg_weights': priority_weights(),
+        'prod_date': prod_date,
+        'history_enabled': st.session_state.history_enabled,
+    }
+
+def cancel_analysis_job():
+    if st.session_state.analysis_job is not None:
+        st.session_state.analysis_job.cancel()
+        st.session_state.analysis_job = None
+
+def harvest_analysis_job():
+    """Move a finished job's output into the session; cancelled jobs are dropped"""
+    job = st.session_state.analysis_job
+    if job is None or not job.future.done():
+        return
+    st.session_state.analysis_job = None
+    if job.future.cancelled() or job.cancel_event.is_set():
+        return
+    error = job.future.exception()
+    if error is not None:
+        st.session_state.analysis_error = f"Production analysis failed: {str(error)}"
+    else:
+        st.session_state.analysis_error = None
+        analysis = job.future.result()
+        st.session_state.analysis_result = analysis
+        report = st.session_state.memory_report
+        if report is None:
+            enforce_memory_budget()
+        else:
+            # Swap the new plan's size into the last measurement instead of measuring again
+            report['usage']['analysis_result'] = analysis['nbytes']
+            enforce_memory_budget(sum(report['usage'].values()))
+
+def ensure_analysis_job(prod_date, fingerprint, force=False):
+    """Make sure a job is computing the analysis for the current inputs.
+
+    A job already running for the same inputs is reused (coalesced); one
+    running for outdated inputs is cancelled. Without ``force`` nothing is
+    submitted while the stored result is still current.
+    """
+    job = st.session_state.analysis_job
+    if job is not None:
+        if job.fingerprint == fingerprint:
+            return job
+        cancel_analysis_job()
+    
+    result = st.session_state.analysis_result
+    if not force and result is not None and result['fingerprint'] == fingerprint:
+        return None
+    
+    job = AnalysisJob(fingerprint, len(st.session_state.fg_analysis_order))
+    job.future = get_job_executor().submit(run_analysis_job, job, snapshot_analysis_inputs(prod_date))
+    st.session_state.analysis_job = job
+    return job
+
+# --- Session memory ---
+# Every session keeps its own tables, plan and export buffers, so a few
+# sessions with big uploads can exhaust the server. The diagnostics panel
+# reports what each session_state key and cached artefact holds; when the
+# session goes over its budget the least recently used exports, plan
+# checkpoints and cached charts are dropped first (all can be rebuilt on demand).
+def touch_artefact(key):
+    """Mark an evictable artefact as just used"""
+    st.session_state.memory_lru[key] = time.time()
+    st.session_state.memory_lru.move_to_end(key)
+
+def evictable_artefacts():
+    """{key: object} of the exports, plan snapshots and chart figures the memory budget may drop"""
+    artefacts = {}
+    analysis = st.session_state.analysis_result
+    if analysis is not None:
+        if analysis['report_data'] is not None:
+            artefacts[('export', 'report')] = analysis['report_data']
+        for name, workbook in analysis['workbooks'].items():
+            artefacts[('export', name)] = workbook
+        planner = analysis['sensitivity_planner']
+        if getattr(planner, 'checkpoints', None):
+            artefacts[('checkpoints', 'plan')] = planner.checkpoints
+    for view, figures in st.session_state.chart_cache['figures'].items():
+        artefacts[('chart', view)] = figures
+    return artefacts
+
+def evict_artefact(key):
+    analysis = st.session_state.analysis_result
+    kind, name = key
+    if kind == 'export' and name == 'report':
+        analysis['report_data'] = None
+        analysis['exports_evicted'] = True
+    elif kind == 'export':
+        analysis['workbooks'].pop(name, None)
+        analysis['exports_evicted'] = True
+    elif kind == 'checkpoints':
+        analysis['sensitivity_planner'].drop_checkpoints()
+    elif kind == 'chart':
+        st.session_state.chart_cache['figures'].pop(name, None)
+    st.session_state.memory_lru.pop(key, None)
+
+def session_memory_usage():
+    """Bytes held by each session_state key; data shared between keys is counted once, under the first"""
+    seen = set()
+    keys = [key for key in MASTER_TABLES if key in st.session_state]
+    keys += sorted((key for key in st.session_state.keys() if key not in MASTER_TABLES), key=str)
+    return {key: estimate_nbytes(st.session_state[key], seen) for key in keys}
+
+def measure_session_memory():
+    """Walk the whole session once; the diagnostics and the budget reuse the result until the next measurement"""
+    usage = session_memory_usage()
+    st.session_state.memory_report = {
+        'usage': usage,
+        'artefacts': cached_artefact_sizes(),
+        'measured': datetime.now().strftime('%H:%M:%S'),
+    }
+    return sum(usage.values())
+
+def enforce_memory_budget(total=None):
+    """Evict least recently used exports/checkpoints until the session fits its budget"""
+    budget = st.session_state.memory_budget_mb * 1024 ** 2
+    if total is None:
+        total = measure_session_memory()
+    if total <= budget:
+        return total
+    
+    artefacts = evictable_artefacts()
+    lru = st.session_state.memory_lru
+    for key in list(lru):
+        if key not in artefacts:
+            del lru[key]
+    # Artefacts never touched count as created now
+    for key in artefacts:
+        if key not in lru:
+            touch_artefact(key)
+    
+    for key in list(lru):
+        if total <= budget:
+            break
+        size = estimate_nbytes(artefacts[key])
+        evict_artefact(key)
+        total -= size
+        st.session_state.memory_evictions.append({
+            'Time': datetime.now().strftime('%H:%M:%S'),
+            'Artefact': ' / '.join(key),
+            'Freed (MB)': size / 1024 ** 2,
+        })
+    del st.session_state.memory_evictions[:-20]
+    return total
+
+def cached_artefact_sizes():
+    """Bytes held by each derived-cache entry and each part of the current analysis"""
+    rows = []
+    for name, (version, value) in st.session_state.derived_cache.items():
+        rows.append({'Artefact': name, 'Kind': 'Derived cache', 'Version': str(version),
+                     'Size (MB)': estimate_nbytes(value) / 1024 ** 2})
+    for view, figures in st.session_state.chart_cache['figures'].items():
+        rows.append({'Artefact': f"charts/{view}", 'Kind': 'Chart', 'Version': '',
+                     'Size (MB)': estimate_nbytes(figures) / 1024 ** 2})
+    analysis = st.session_state.analysis_result
+    if analysis is not None:
+        evictable = {id(obj) for obj in evictable_artefacts().values()}
+        for name, value in analysis.items():
+            if name == 'workbooks':
+                for workbook_name, workbook in value.items():
+                    rows.append({'Artefact': f"workbooks/{workbook_name}", 'Kind': 'Export', 'Version': '',
+                                 'Size (MB)': estimate_nbytes(workbook) / 1024 ** 2})
+                continue
+            kind = 'Export' if id(value) in evictable else 'Plan'
+            rows.append({'Artefact': name, 'Kind': kind, 'Version': '',
+                         'Size (MB)': estimate_nbytes(value) / 1024 ** 2})
+            if name == 'sensitivity_planner' and getattr(value, 'checkpoints', None):
+                rows.append({'Artefact': 'sensitivity_planner/checkpoints', 'Kind': 'Plan snapshot', 'Version': '',
+                             'Size (MB)': estimate_nbytes(value.checkpoints) / 1024 ** 2})
+    return pd.DataFrame(rows, columns=['Artefact', 'Kind', 'Version', 'Size (MB)'])
+
+def render_master_data_versions():
+    history = st.session_state.master_data
+    with st.expander("🕘 Master Data Versions", expanded=False):
+        st.caption(f"Version {history.head.id}: {history.head.label}")
+        undo_col, redo_col = st.columns(2)
+        undo_col.button("↩️ Undo", key="undo_master_data", on_click=undo_master_data, disabled=not history.can_undo(),
+                        use_container_width=True)
+        redo_col.button("↪️ Redo", key="redo_master_data", on_click=redo_master_data, disabled=not history.can_redo(),
+                        use_container_width=True)
+        
+        versions = history.summary()
+        st.dataframe(versions, use_container_width=True, hide_index=True, height=min(250, len(versions) * 35 + 40))
+        labels = dict(zip(versions['Version'], "v" + versions['Version'].astype(str) + ": " + versions['Change']))
+        version_id = st.selectbox("Version:", list(labels), format_func=labels.get, key="restore_version_select")
+        st.button("⏪ Restore Version", key="restore_master_data", on_click=restore_master_data, args=(version_id,),
+                  disabled=version_id == history.head.id, use_container_width=True)
+        st.caption(f"The last {history.limit} versions are kept; unchanged tables and FG formulas are shared "
+                   "between versions.")
+
+def render_memory_diagnostics():
+    with st.expander("🧠 Session Diagnostics", expanded=False):
+        st.number_input(
+            "Memory budget (MB)",
+            min_value=1,
+            max_value=16384,
+            step=64,
+            key="memory_budget_mb",
+            on_change=enforce_memory_budget,
+            help="When this session holds more, the least recently used exports, plan checkpoints and charts are evicted"
+        )
+        # Measuring walks everything the session holds, so it only runs on request
+        if st.button("📏 Measure Session Memory", key="measure_memory"):
+            total = measure_session_memory()
+            if total > st.session_state.memory_budget_mb * 1024 ** 2:
+                enforce_memory_budget(total)
+                measure_session_memory()
+        
+        report = st.session_state.memory_report
+        if report is None:
+            st.caption("Session memory hasn't been measured yet.")
+        else:
+            usage = report['usage']
+            total = sum(usage.values())
+            st.caption(f"Measured at {report['measured']}; the plan's size is updated after every analysis.")
+            st.metric("Session Memory", f"{total / 1024 ** 2:,.1f} MB",
+                      delta=f"{st.session_state.memory_budget_mb - total / 1024 ** 2:,.1f} MB left", delta_color="off")
+            
+            st.write("**Session state keys**")
+            key_sizes = pd.DataFrame({'Key': [str(key) for key in usage],
+                                      'Size (MB)': [size / 1024 ** 2 for size in usage.values()]})
+            st.dataframe(
+                key_sizes.sort_values('Size (MB)', ascending=False),
+                use_container_width=True,
+                hide_index=True,
+                column_config={"Size (MB)": st.column_config.NumberColumn("Size (MB)", format="%.3f")}
+            )
+            
+            st.write("**Cached artefacts**")
+            st.dataframe(
+                report['artefacts'],
+                use_container_width=True,
+                hide_index=True,
+                column_config={"Size (MB)": st.column_config.NumberColumn("Size (MB)", format="%.3f")}
+            )
+        
+        if st.session_state.memory_evictions:
+            st.write("**Recent evictions**")
+            st.dataframe(
+                pd.DataFrame(st.session_state.memory_evictions),
+                use_container_width=True,
+                hide_index=True,
+                column_config={"Freed (MB)": st.column_config.NumberColumn("Freed (MB)", format="%.3f")}
+            )
+        
+        if st.button("🧹 Evict Exports & Checkpoints", key="evict_artefacts"):
+            for key in evictable_artefacts():
+                evict_artefact(key)
+            st.rerun()
+
+# --- Production planning views ---
+# The plan view is a fragment: committing capacities or waiting on a job only
+# reruns it, not the upload/formula tabs. The results table and the charts are
+# nested fragments so their own controls rerun nothing else.
+def request_analysis():
+    if st.session_state.fg_analysis_order:
+        st.session_state.analysis_completed = True
+        st.session_state.analysis_requested = True
+
+def commit_expected_capacities(fg_list):
+    """Form submit callback: apply every edited capacity in one batch"""
+    for fg in fg_list:
+        widget_key = f"exp_cap_{fg}"
+        if widget_key in st.session_state:
+            st.session_state.fg_expected_capacity[fg] = st.session_state[widget_key]
+
+def wait_for_analysis_job(job):
+    """Show job progress until it finishes.
+
+    The plan itself runs on the worker pool; this loop only sleeps between
+    progress updates, so any widget interaction interrupts it and the next run
+    picks the same job up again.
+    """
+    progress_bar = st.progress(job.fraction(), text=job.status_text())
+    while not job.future.done():
+        time.sleep(0.2)
+        progress_bar.progress(job.fraction(), text=job.status_text())
+    progress_bar.empty()
+    harvest_analysis_job()
+
+def render_capacity_editor():
+    st.write("### 🎯 Set Expected Capacities")
+    st.caption("Set 0 for automatic calculation based on available RM. Edits are applied together when you click 'Apply Capacities'.")
+    
+    fg_list = list(st.session_state.fg_analysis_order.keys())
+    mid_point = (len(fg_list) + 1) // 2
+    
+    with st.form("expected_capacity_form", border=False):
+        capacity_col1, capacity_col2 = st.columns(2)
+        
+        for column, column_fgs in ((capacity_col1, fg_list[:mid_point]), (capacity_col2, fg_list[mid_point:])):
+            with column:
+                for fg in column_fgs:
+                    current_val = st.session_state.fg_expected_capacity.get(fg, 0)
+                    st.number_input(
+                        f"{fg} (Kg, min 25):",
+                        min_value=0.0,
+                        value=float(current_val),
+                        step=25.0,
+                        format="%.1f",
+                        key=f"exp_cap_{fg}"
+                    )
+        
+        st.form_submit_button(
+            "✅ Apply Capacities",
+            type="primary",
+            on_click=commit_expected_capacities,
+            args=(fg_list,)
+        )
+
+@st.fragment
+def render_results_table(results):
+    st.write("### 📋 Production Capability List")
+    
+    res_df = pd.DataFrame(results)
+    
+    filter_col1, filter_col2 = st.columns([1, 2])
+    status_filter = filter_col1.selectbox(
+        "Status:",
+        ["All", "✅ Ready", "❌ Shortage"],
+        key="results_status_filter"
+    )
+    fg_search = filter_col2.text_input("Search FG Code:", key="results_fg_search")
+    
+    if status_filter != "All":
+        res_df = res_df[res_df['Status'] == status_filter]
+    if fg_search:
+        res_df = res_df[res_df['FG'].str.contains(fg_search.strip(), case=False, regex=False)]
+    
+    st.dataframe(
+        res_df,
+        use_container_width=True,
+        height=min(400, len(res_df) * 35 + 40),
+        hide_index=True,
+        column_config={
+            "FG": st.column_config.TextColumn("FG Code", width="small"),
+            "Expected": st.column_config.TextColumn("Expected", width="small"),
+            "Max": st.column_config.TextColumn("Max Cap", width="small"),
+            "Actual": st.column_config.TextColumn("Actual Cap", width="small"),
+            "Status": st.column_config.TextColumn("Status", width="small"),
+            "Missing": st.column_config.TextColumn("Missing RM", width="small"),
+            "Batches": st.column_config.NumberColumn("Batches", width="small")
+        }
+    )
+
+# --- Capacity charts ---
+# One bar and one pie slice per FG stops being readable (and gets slow to ship to
+# the browser) past a few dozen FGs, so larger plans default to top-N + "Others";
+# FGs can also be binned by product family (a code prefix) or shown as a
+# utilisation heatmap with a WebGL scatter. Figures are cached per plan
+# fingerprint and view, so reruns that don't change the plan reuse them.
+CHART_MODES = {
+    'all': "Every FG",
+    'top_n': "Top N + Others",
+    'family': "By product family",
+    'heatmap': "Heatmap (WebGL)",
+}
+CHART_FULL_DETAIL_LIMIT = 40
+CHART_LABEL_LIMIT = 30
+CHART_OTHERS_COLOR = '#c7c7c7'
+
+def capacity_chart_frame(results):
+    """FG, Actual, Max (Kg) and Ready flag per planned FG, in plan order"""
+    res_df = pd.DataFrame(results, columns=['FG', 'Expected', 'Max', 'Actual', 'Status', 'Missing', 'Batches'])
+    return pd.DataFrame({
+        'FG': res_df['FG'],
+        'Actual': kg_to_float(res_df['Actual']),
+        'Max': kg_to_float(res_df['Max']),
+        'Ready': res_df['Status'].str.contains("✅", regex=False),
+    })
+
+def group_capacity_frame(chart_df, mode, top_n=15, family_chars=2):
+    """Aggregate the chart frame to one row per bar/slice: Group, Actual, Max, FGs, Is FG"""
+    if mode == 'family':
+        families = chart_df['FG'].str.slice(0, family_chars)
+        grouped = chart_df.groupby(families, sort=False).agg(
+            Actual=('Actual', 'sum'), Max=('Max', 'sum'), FGs=('FG', 'size')
+        )
+        grouped = grouped.rename_axis('Group').reset_index().sort_values('Actual', ascending=False, kind='stable')
+        return grouped.assign(**{'Is FG': False})
+    
+    grouped = chart_df[['FG', 'Actual', 'Max']].rename(columns={'FG': 'Group'}).assign(FGs=1)
+    if mode != 'top_n' or len(grouped) <= top_n + 1:
+        return grouped.assign(**{'Is FG': True})
+    
+    # Largest actual output first; ties broken by the larger maximum
+    order = np.lexsort((-grouped['Max'].to_numpy(), -grouped['Actual'].to_numpy()))
+    top, rest = grouped.iloc[order[:top_n]], grouped.iloc[order[top_n:]]
+    others = pd.DataFrame({
+        'Group': [f"Others ({len(rest)} FGs)"],
+        'Actual': [rest['Actual'].sum()],
+        'Max': [rest['Max'].sum()],
+        'FGs': [len(rest)],
+    })
+    return pd.concat([top, others], ignore_index=True).assign(**{'Is FG': [True] * len(top) + [False]})
+
+def capacity_bar_figure(groups):
+    bar_df = pd.concat([
+        groups[['Group', 'FGs']].assign(Capacity=groups['Actual'], Type='Actual'),
+        groups[['Group', 'FGs']].assign(Capacity=groups['Max'] - groups['Actual'], Type='Available'),
+    ], ignore_index=True)
+    labelled = len(groups) <= CHART_LABEL_LIMIT
+    
+    fig = px.bar(
+        bar_df,
+        x='Group',
+        y='Capacity',
+        title="Actual vs Maximum Capacity",
+        color='Type',
+        color_discrete_map={'Actual': '#2ca02c', 'Available': '#aec7e8'},
+        text=bar_df['Capacity'].map(lambda x: f"{x:,.1f}" if x > 0 else '') if labelled else None,
+        custom_data=['Type', 'FGs']
+    )
+    fig.update_traces(
+        texttemplate='%{text}' if labelled else None,
+        textposition='outside' if labelled else 'none',
+        hovertemplate='<b>%{x}</b><br>' +
+                    'Type: %{customdata[0]}<br>' +
+                    'Capacity: %{y:,.1f} Kg<br>' +
+                    'FGs: %{customdata[1]}<br>' +
+                    '<extra></extra>'
+    )
+    fig.update_layout(
+        xaxis_title="FG" if groups['Is FG'].all() else "Group",
+        yaxis_title="Capacity (Kg)",
+        showlegend=True,
+        height=400,
+        xaxis_tickangle=-45,
+        legend_title="Capacity Type",
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        )
+    )
+    return fig
+
+def capacity_pie_figure(groups, mode):
+    pie_df = groups[groups['Actual'] > 0]
+    if pie_df.empty:
+        return None
+    if mode == 'family':
+        colors = px.colors.qualitative.Plotly
+    else:
+        colors = [get_fg_color(group) if is_fg else CHART_OTHERS_COLOR
+                  for group, is_fg in zip(pie_df['Group'], pie_df['Is FG'])]
+    
+    fig = px.pie(
+        pie_df,
+        values='Actual',
+        names='Group',
+        title="Capacity Distribution",
+        color_discrete_sequence=colors,
+        hole=0.3
+    )
+    fig.update_traces(
+        sort=False,
+        hovertemplate='<b>%{label}</b><br>' +
+                    'Capacity: %{value:,.1f} Kg<br>' +
+                    'Percentage: %{percent}<br>' +
+                    '<extra></extra>'
+    )
+    fig.update_layout(
+        height=400,
+        legend_title="Product Family" if mode == 'family' else "FG Code",
+        showlegend=True
+    )
+    return fig
+
+def capacity_heatmap_figures(chart_df):
+    """Utilisation heatmap (FGs in plan order on a square grid) and a WebGL Max vs Actual scatter"""
+    n = len(chart_df)
+    width = int(np.ceil(np.sqrt(n)))
+    height = int(np.ceil(n / width))
+    actual = chart_df['Actual'].to_numpy()
+    maximum = chart_df['Max'].to_numpy()
+    utilisation = np.divide(actual * 100, maximum, out=np.full(n, np.nan), where=maximum > 0)
+    
+    def grid(values, fill):
+        padded = np.full(width * height, fill, dtype=object if isinstance(fill, str) else float)
+        padded[:n] = values
+        return padded.reshape(height, width)
+    
+    hover = chart_df['FG'] + '<br>Actual: ' + chart_df['Actual'].map('{:,.1f} Kg'.format) \
+        + '<br>Max: ' + chart_df['Max'].map('{:,.1f} Kg'.format)
+    heatmap = go.Figure(go.Heatmap(
+        z=grid(utilisation, np.nan),
+        text=grid(hover.to_numpy(), ''),
+        hovertemplate='%{text}<br>Utilisation: %{z:.0f}%<extra></extra>',
+        colorscale='RdYlGn',
+        zmin=0,
+        zmax=100,
+        colorbar=dict(title="Used %"),
+        xgap=1,
+        ygap=1
+    ))
+    heatmap.update_layout(
+        title="Capacity Utilisation (Actual / Max, plan order)",
+        height=400,
+        xaxis=dict(showticklabels=False),
+        yaxis=dict(showticklabels=False, autorange='reversed')
+    )
+    
+    ready = chart_df['Ready'].to_numpy()
+    scatter = go.Figure()
+    for mask, name, color in ((ready, "✅ Ready", '#2ca02c'), (~ready, "❌ Shortage", '#d62728')):
+        scatter.add_trace(go.Scattergl(
+            x=maximum[mask],
+            y=actual[mask],
+            mode='markers',
+            name=name,
+            marker=dict(color=color, size=6),
+            text=chart_df['FG'].to_numpy()[mask],
+            hovertemplate='<b>%{text}</b><br>Max: %{x:,.1f} Kg<br>Actual: %{y:,.1f} Kg<extra></extra>'
+        ))
+    scatter.update_layout(
+        title="Actual vs Maximum per FG",
+        xaxis_title="Max (Kg)",
+        yaxis_title="Actual (Kg)",
+        height=400,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+    )
+    return heatmap, scatter
+
+def build_capacity_charts(results, mode, top_n, family_chars):
+    """(left figure, right figure or None) for one chart view of the plan"""
+    chart_df = capacity_chart_frame(results)
+    if mode == 'heatmap':
+        return capacity_heatmap_figures(chart_df)
+    groups = group_capacity_frame(chart_df, mode, top_n, family_chars)
+    pie = capacity_pie_figure(groups, mode) if len(chart_df) > 1 else None
+    return capacity_bar_figure(groups), pie
+
+def capacity_chart_figures(analysis, mode, top_n, family_chars):
+    """Chart figures for the plan, cached per plan fingerprint and view"""
+    cache = st.session_state.chart_cache
+    if cache['fingerprint'] != analysis['fingerprint']:
+        cache = {'fingerprint': analysis['fingerprint'], 'figures': {}}
+        st.session_state.chart_cache = cache
+    view = {'top_n': f"top_n:{top_n}", 'family': f"family:{family_chars}"}.get(mode, mode)
+    if view not in cache['figures']:
+        cache['figures'][view] = build_capacity_charts(analysis['results'], mode, top_n, family_chars)
+    touch_artefact(('chart', view))
+    return cache['figures'][view]
+
+@st.fragment
+def render_capacity_charts(analysis):
+    st.write("### 📈 Production Capacity Visualization")
+    
+    results = analysis['results']
+    if not results:
+        return
+    
+    mode_col, param_col = st.columns([2, 1])
+    mode = mode_col.radio(
+        "Chart view:",
+        list(CHART_MODES),
+        format_func=CHART_MODES.get,
+        index=0 if len(results) <= CHART_FULL_DETAIL_LIMIT else 1,
+        horizontal=True,
+        key="capacity_chart_mode"
+    )
+    top_n = st.session_state.get('capacity_chart_top_n', 15)
+    family_chars = st.session_state.get('capacity_chart_family_chars', 2)
+    if mode == 'top_n':
+        top_n = param_col.slider("FGs shown:", min_value=5, max_value=50, value=15, key="capacity_chart_top_n")
+    elif mode == 'family':
+        family_chars = param_col.number_input(
+            "Family = first N characters of FG code:",
+            min_value=1,
+            max_value=20,
+            value=2,
+            step=1,
+            key="capacity_chart_family_chars"
+        )
+    
+    fig1, fig2 = capacity_chart_figures(analysis, mode, top_n, family_chars)
+    chart_col1, chart_col2 = st.columns(2)
+    with chart_col1:
+        st.plotly_chart(fig1, use_container_width=True)
+    with chart_col2:
+        if fig2 is not None:
+            st.plotly_chart(fig2, use_container_width=True)
+
+@st.fragment
+def render_plan_bundle_export(analysis):
+    with st.expander("🗄️ Columnar Export (Parquet / Arrow)", expanded=False):
+        st.caption("Writes the plan results, shortages, allocation ledger, location draws and residual stock as "
+                   "typed tables, with a manifest.json recording the input fingerprint, into a new folder under "
+                   f"{PLAN_EXPORT_DIR}, and offers the folder as a zip.")
+        fmt = st.radio("Format:", list(PLAN_EXPORT_FORMATS), format_func=PLAN_EXPORT_FORMATS.get,
+                       key="plan_export_format", horizontal=True)
+        if st.button("💾 Write Plan Bundle", key="write_plan_bundle"):
+            try:
+                bundle = write_plan_bundle(analysis, PLAN_EXPORT_DIR, fmt)
+                st.success(f"✅ Plan written to {bundle}")
+                st.download_button(
+                    label="📥 Download Plan Bundle (.zip)",
+                    data=zip_plan_bundle(bundle),
+                    file_name=f"{os.path.basename(bundle)}.zip",
+                    mime="application/zip",
+                    key="plan_bundle_download"
+                )
+            except ImportError:
+                st.error("Columnar export needs pyarrow (pip install pyarrow).")
+            except OSError as e:
+                st.error(f"Could not write the plan bundle: {str(e)}")
+
+@st.fragment
+def render_run_history(analysis):
+    with st.expander("🕘 Run History & Plan Diff", expanded=False):
+        st.checkbox("Save every run", key="history_enabled",
+                    help="Each generated plan is kept as a Parquet snapshot with its input fingerprint")
+        st.caption(f"Saved under {HISTORY_DIR}; the newest {HISTORY_MAX_RUNS} runs are kept.")
+        if analysis.get('history_error'):
+            st.warning(analysis['history_error'])
+
+        runs = list_history_runs(HISTORY_DIR)
+        if runs.empty:
+            st.info("No saved runs yet. Generate a plan with history on to start one.")
+            return
+        st.dataframe(runs.drop(columns=['path', 'manifest']), use_container_width=True, hide_index=True,
+                     height=min(250, len(runs) * 35 + 40))
+        if len(runs) < 2:
+            st.info("Generate another run to compare plans.")
+            return
+
+        labels = dict(zip(runs['Run'], runs['Created'] + " · " + runs['Input Fingerprint']))
+        old_col, new_col = st.columns(2)
+        old_run = old_col.selectbox("Compare run:", list(runs['Run']), index=1, format_func=labels.get,
+                                    key="history_old_run")
+        new_run = new_col.selectbox("Against run:", list(runs['Run']), index=0, format_func=labels.get,
+                                    key="history_new_run")
+        old, new = runs.set_index('Run').loc[[old_run, new_run]].itertuples()
+        try:
+            diff = diff_plans(load_history_run(old.path), load_history_run(new.path))
+        except ImportError:
+            st.error("Run history needs pyarrow (pip install pyarrow).")
+            return
+
+        changed = changed_inputs(old.manifest, new.manifest)
+        st.caption("Changed inputs: " + (", ".join(changed) if changed else "none (same input fingerprint)"))
+        fgs, shortages = diff['fgs'], diff['shortages']
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("FGs Changed", len(fgs))
+        m2.metric("Δ Batches", f"{fgs['Δ Batches'].sum():+,.0f}")
+        m3.metric("New Shortages", int((shortages['Change'] == 'New shortage').sum()))
+        m4.metric("Cleared Shortages", int((shortages['Change'] == 'Cleared').sum()))
+        for title, table in (("FG Batch Changes", fgs), ("Shortage Changes", shortages),
+                             ("Stock Movements", diff['stock'])):
+            st.write(f"**{title}**")
+            if table.empty:
+                st.caption("No changes")
+            else:
+                st.dataframe(table, use_container_width=True, hide_index=True,
+                             height=min(300, len(table) * 35 + 40))
+
+@st.fragment
+def render_bottlenecks(analysis):
+    st.write("### 🧮 Bottleneck & Marginal Value")
+    st.caption("Which RM limits each FG in its FIFO slot, and how much more of it would unlock extra batches.")
+    
+    extra_batches = st.number_input(
+        "Extra batches (+k):",
+        min_value=1,
+        value=BOTTLENECK_EXTRA_BATCHES,
+        step=1,
+        key="bottleneck_extra_batches"
+    )
+    if extra_batches == BOTTLENECK_EXTRA_BATCHES:
+        bottlenecks = analysis['bottlenecks']
+    else:
+        bottlenecks = bottleneck_analysis(analysis['requirement_matrix'], analysis['rm_stock'], analysis['results'],
+                                          analysis['fg_expected_capacity'], int(extra_batches),
+                                          available=analysis['sensitivity_planner'].line_available())
+    
+    fgs_df = bottlenecks['fgs']
+    rms_df = bottlenecks['rms']
+    if fgs_df.empty:
+        st.info("No FGs with formulas in the plan")
+        return
+    
+    rm_limited = fgs_df[fgs_df['Limited By'] == 'RM']
+    metric_col1, metric_col2, metric_col3 = st.columns(3)
+    metric_col1.metric("FGs Limited by an RM", len(rm_limited))
+    metric_col2.metric("Distinct Binding RMs", rm_limited['Binding RM'].nunique())
+    metric_col3.metric("Output Unlockable (+1 batch)", f"{rms_df['Output Unlocked (Kg)'].sum():,.1f} Kg")
+    
+    st.write("**Top RMs to unlock output**")
+    st.dataframe(
+        rms_df.head(20),
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Kg for +1 Batch (All FGs)": st.column_config.NumberColumn(format="%.4f"),
+            "Kg to Unlock": st.column_config.NumberColumn(format="%.4f"),
+            "Output Unlocked (Kg)": st.column_config.NumberColumn(format="%.1f"),
+            "Output per Kg RM": st.column_config.NumberColumn(format="%.2f")
+        }
+    )
+    
+    with st.expander("📋 Binding RM per FG", expanded=False):
+        st.dataframe(fgs_df, use_container_width=True, hide_index=True, height=min(400, len(fgs_df) * 35 + 40))
+        
+        fg_code = st.selectbox("RM needs for FG:", fgs_df['FG Code'].tolist(), key="bottleneck_fg_select")
+        fg_lines = bottlenecks['lines'][bottlenecks['lines']['FG Code'] == fg_code]
+        st.dataframe(fg_lines.drop(columns=['FG Code', 'FIFO Position']), use_container_width=True, hide_index=True)
+
+@st.fragment
+def render_sensitivity_panel(analysis):
+    st.write("### 🎚️ Stock Sensitivity (What-If)")
+    st.caption("Drag stock adjustments for a few RMs; only this panel replans, from the last allocation checkpoint before the RM is first used.")
+    
+    planner = analysis['sensitivity_planner']
+    rm_codes = planner.matrix.rm_codes.tolist()
+    if not rm_codes:
+        st.info("No formulas in the plan")
+        return
+    
+    # Start from the RMs that unlock the most output
+    default_rms = analysis['bottlenecks']['rms']['RM Code'].head(3).tolist()
+    chosen_rms = st.multiselect(
+        "RMs to adjust:",
+        rm_codes,
+        default=default_rms,
+        max_selections=8,
+        key="sensitivity_rms"
+    )
+    
+    adjustments = {}
+    for rm_code in chosen_rms:
+        in_stock = planner.stock_of(rm_code)
+        adjustments[rm_code] = st.slider(
+            f"{rm_code} (in stock: {in_stock:,.1f} Kg)",
+            min_value=-in_stock,
+            max_value=max(1000.0, in_stock * 2),
+            value=0.0,
+            step=5.0,
+            key=f"sensitivity_{rm_code}"
+        )
+    
+    if any(adjustments.values()):
+        touch_artefact(('checkpoints', 'plan'))
+    started = time.perf_counter()
+    batches = planner.plan(adjustments)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    baseline = planner.baseline
+    
+    metric_col1, metric_col2, metric_col3 = st.columns(3)
+    metric_col1.metric(
+        "What-If Output",
+        f"{batches.sum() * 25:,.1f} Kg",
+        delta=f"{(batches.sum() - baseline.sum()) * 25:+,.1f} Kg"
+    )
+    metric_col2.metric(
+        "Ready FGs",
+        int((batches > 0).sum()),
+        delta=int((batches > 0).sum() - (baseline > 0).sum())
+    )
+    metric_col3.metric("Replanned In", f"{elapsed_ms:.1f} ms")
+    
+    changed = np.flatnonzero(batches != baseline)
+    if len(changed) == 0:
+        st.info("No FG changes with these adjustments")
+        return
+    
+    st.dataframe(
+        pd.DataFrame({
+            'FG Code': planner.matrix.fg_codes[changed],
+            'FIFO Position': changed + 1,
+            'Baseline Batches': baseline[changed],
+            'What-If Batches': batches[changed],
+            'Change (Kg)': (batches[changed] - baseline[changed]) * 25.0
+        }),
+        use_container_width=True,
+        hide_index=True,
+        height=min(300, len(changed) * 35 + 40),
+        column_config={
+            "Change (Kg)": st.column_config.NumberColumn("Change (Kg)", format="%+.1f")
+        }
+    )
+
+@st.fragment
+def render_rm_impact(analysis):
+    st.write("### 🔎 RM Impact (Where-Used)")
+    st.caption("Pick an RM to see every FG that uses it, what the plan gives those FGs and the output lost to this RM.")
+    
+    where_used = analysis['where_used']
+    if len(where_used) == 0:
+        st.info("No formulas loaded")
+        return
+    
+    # RMs with shortages first, then every other RM used by a formula
+    shortage_rms = analysis['shortage_table_df']['RM Code'].unique().tolist()
+    listed = set(shortage_rms)
+    rm_options = [rm for rm in shortage_rms if rm in where_used] + [rm for rm in where_used.rms() if rm not in listed]
+    
+    rm_code = st.selectbox("Select RM Code:", rm_options, key="impact_rm_select")
+    if not rm_code:
+        return
+    
+    impact = build_rm_impact(where_used, rm_code, analysis['results'], analysis['shortage_table_df'])
+    short_fgs = impact[impact['RM Shortage (Kg)'] > 0]
+    
+    metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
+    metric_col1.metric("FGs Using RM", len(impact))
+    metric_col2.metric("FGs Short of RM", len(short_fgs))
+    metric_col3.metric("RM Shortage", f"{short_fgs['RM Shortage (Kg)'].sum():,.4f} Kg")
+    metric_col4.metric("Lost Output", f"{impact['Lost Output (Kg)'].sum():,.1f} Kg")
+    
+    st.dataframe(
+        impact,
+        use_container_width=True,
+        height=min(300, len(impact) * 35 + 40),
+        hide_index=True,
+        column_config={
+            "FG Code": st.column_config.TextColumn("FG Code", width="small"),
+            "FIFO Position": st.column_config.NumberColumn("FIFO #", width="small"),
+            "Required per Batch (Kg)": st.column_config.NumberColumn("Req / Batch", format="%.4f"),
+            "Batches": st.column_config.NumberColumn("Batches", width="small"),
+            "Status": st.column_config.TextColumn("Status", width="small"),
+            "RM Shortage (Kg)": st.column_config.NumberColumn("RM Shortage", format="%.4f"),
+            "Lost Output (Kg)": st.column_config.NumberColumn("Lost Output", format="%.1f")
+        }
+    )
+    
+    po_index = analysis['po_index']
+    rm_pos = po_index.schedule(rm_code)
+    if not rm_pos.empty:
+        st.caption(f"Open POs for {rm_code}")
+        st.dataframe(
+            rm_pos.assign(**{'Arrival Date': rm_pos['Arrival Date'].dt.strftime('%d/%m/%Y'),
+                             'Status': po_index.status(analysis['prod_date'], rm_code)}),
+            use_container_width=True,
+            hide_index=True
+        )
+
+@st.fragment
+def render_allocation_ledger(analysis):
+    st.write("### 📒 Allocation Ledger & Residual Stock")
+    st.caption("What each FG consumed from each RM, in the order the plan allocated it, and the pooled stock left "
+               "once the plan is produced.")
+    
+    ledger = analysis['allocation_ledger']
+    residual = analysis['rm_residual']
+    
+    metric_col1, metric_col2, metric_col3 = st.columns(3)
+    metric_col1.metric("Ledger Lines", f"{len(ledger):,}")
+    metric_col2.metric("Kg Consumed", f"{residual['Consumed (Kg)'].sum():,.1f} Kg")
+    metric_col3.metric("Residual Stock", f"{residual['Residual (Kg)'].sum():,.1f} Kg")
+    
+    ledger_col, residual_col = st.columns([3, 2])
+    with ledger_col:
+        fg_filter = st.multiselect("Filter ledger by FG:", ledger['FG Code'].unique().tolist(), key="ledger_fg_filter")
+        shown = ledger[ledger['FG Code'].isin(fg_filter)] if fg_filter else ledger
+        st.dataframe(
+            shown,
+            use_container_width=True,
+            height=min(400, len(shown) * 35 + 40),
+            hide_index=True,
+            column_config={
+                "Consumed (Kg)": st.column_config.NumberColumn("Consumed", format="%.4f"),
+                "Stock Before (Kg)": st.column_config.NumberColumn("Before", format="%.4f"),
+                "Stock After (Kg)": st.column_config.NumberColumn("After", format="%.4f")
+            }
+        )
+    with residual_col:
+        used_only = st.checkbox("Only RMs the plan consumed", value=True, key="residual_used_only")
+        shown = residual[residual['Consumed (Kg)'] > 0] if used_only else residual
+        st.dataframe(
+            shown,
+            use_container_width=True,
+            height=min(400, len(shown) * 35 + 40),
+            hide_index=True,
+            column_config={
+                "Stock (Kg)": st.column_config.NumberColumn("Stock", format="%.4f"),
+                "Consumed (Kg)": st.column_config.NumberColumn("Consumed", format="%.4f"),
+                "Residual (Kg)": st.column_config.NumberColumn("Residual", format="%.4f")
+            }
+        )
+
+def render_location_draws(analysis):
+    st.write("### 🏬 Location Draws")
+    st.caption(f"The plan is sized on stock pooled over all locations; each FG's allocation is then drawn from the "
+               f"locations in this order ({LOCATION_RULES[st.session_state.location_rule].lower()}).")
+    
+    summary = analysis['location_summary']
+    draws = analysis['location_draws']
+    
+    metric_col1, metric_col2, metric_col3 = st.columns(3)
+    metric_col1.metric("Locations Drawn From", int((summary['Drawn (Kg)'] > 0).sum()))
+    metric_col2.metric("Kg Drawn", f"{summary['Drawn (Kg)'].sum():,.1f} Kg")
+    metric_col3.metric("Transfer Cost", f"{summary['Transfer Cost'].sum():,.2f}")
+    
+    st.dataframe(
+        summary,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Stock (Kg)": st.column_config.NumberColumn("Stock (Planned RMs)", format="%.4f"),
+            "Drawn (Kg)": st.column_config.NumberColumn("Drawn", format="%.4f"),
+            "Remaining (Kg)": st.column_config.NumberColumn("Remaining", format="%.4f"),
+            "Transfer Cost": st.column_config.NumberColumn("Transfer Cost", format="%.2f")
+        }
+    )
+    
+    if not draws.empty:
+        with st.expander("Draws per FG and RM", expanded=False):
+            st.dataframe(
+                draws,
+                use_container_width=True,
+                height=min(400, len(draws) * 35 + 40),
+                hide_index=True,
+                column_config={
+                    "Drawn (Kg)": st.column_config.NumberColumn("Drawn (Kg)", format="%.4f"),
+                    "Transfer Cost": st.column_config.NumberColumn("Transfer Cost", format="%.2f")
+                }
+            )
+
+def render_purchase_recommendations(recs):
+    st.write("### 🛒 Procurement Recommendations")
+    st.caption("Shortages netted against open POs arriving by the production date, raised to the MOQ, rounded to "
+               "supplier lots and dated back by the lead time (terms in the Stock & PO tab).")
+    
+    to_order = recs[recs['Suggested Order (Kg)'] > 0]
+    metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
+    metric_col1.metric("Suggested POs", len(to_order))
+    metric_col2.metric("Order Quantity", f"{to_order['Suggested Order (Kg)'].sum():,.1f} Kg")
+    metric_col3.metric("To Expedite", int((recs['Expedite (Kg)'] > 0).sum()))
+    metric_col4.metric("Overdue Orders", int((to_order['Slack (days)'] < 0).sum()))
+    
+    st.dataframe(
+        recs.assign(**{
+            'Need By': recs['Need By'].dt.strftime('%d/%m/%Y'),
+            'Order By': recs['Order By'].dt.strftime('%d/%m/%Y'),
+        }),
+        use_container_width=True,
+        height=min(300, len(recs) * 35 + 40),
+        hide_index=True,
+        column_config={
+            "Shortage (Kg)": st.column_config.NumberColumn("Shortage", format="%.4f"),
+            "On-Time PO (Kg)": st.column_config.NumberColumn("On-Time PO", format="%.4f"),
+            "Late PO (Kg)": st.column_config.NumberColumn("Late PO", format="%.4f"),
+            "Net Requirement (Kg)": st.column_config.NumberColumn("Net Req.", format="%.4f"),
+            "Expedite (Kg)": st.column_config.NumberColumn("Expedite", format="%.4f"),
+            "Suggested Order (Kg)": st.column_config.NumberColumn("Order", format="%.4f"),
+            "Action Required": st.column_config.TextColumn("Action", width="large")
+        }
+    )
+
+EXPIRY_RISK_LAYOUT = [
+    ('At Risk Lots', 'expiry_risk'),
+    ('Lot Draws', 'lot_draws'),
+]
+
+@st.fragment
+def render_expiry_risk(analysis):
+    st.write("### ⏳ Lot Expiry Risk")
+    st.caption("Lots are allocated first-expired-first-out; lots expired by the production date are not planned. "
+               "Lots listed here are expired, or expire within the horizon with stock the plan leaves unused.")
+    
+    horizon_days = st.slider("Horizon (days after production date):", min_value=0, max_value=180, value=30, step=5,
+                             key="expiry_horizon_days")
+    report = expiry_risk_report(analysis['stock_rows'], analysis['lot_queue'], analysis['lot_remaining'],
+                                analysis['prod_date'], horizon_days)
+    expired = report[report['Status'] == 'Expired']
+    at_risk = report[report['Status'] == 'At risk']
+    
+    metric_col1, metric_col2, metric_col3 = st.columns(3)
+    metric_col1.metric("Expired", f"{expired['At Risk (Kg)'].sum():,.1f} Kg", delta=f"{len(expired)} lot(s)", delta_color="off")
+    metric_col2.metric("At Risk in Horizon", f"{at_risk['At Risk (Kg)'].sum():,.1f} Kg", delta=f"{len(at_risk)} lot(s)", delta_color="off")
+    metric_col3.metric("Lots Drawn by Plan", len(analysis['location_draws'].drop_duplicates(subset=['RM Code', 'Location', 'Lot'])))
+    
+    if report.empty:
+        st.success("✅ No lots expire unused within the horizon")
+        return
+    
+    st.dataframe(
+        report.assign(**{'Expiry Date': report['Expiry Date'].dt.strftime('%d/%m/%Y')}),
+        use_container_width=True,
+        height=min(400, len(report) * 35 + 40),
+        hide_index=True,
+        column_config={
+            "At Risk (Kg)": st.column_config.NumberColumn("At Risk (Kg)", format="%.4f")
+        }
+    )
+    
+    parts = {'expiry_risk': report, 'lot_draws': analysis['location_draws']}
+    st.download_button(
+        label="📥 Download Expiry Risk Report (Excel)",
+        data=build_export_workbooks(parts, {'expiry': EXPIRY_RISK_LAYOUT})['expiry'],
+        file_name=f"Expiry_Risk_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+        mime=EXCEL_MIME,
+        key="expiry_risk_download"
+    )
+
+def apply_fifo_order(fg_order, custom):
+    st.session_state.fg_analysis_order = OrderedDict((fg, i) for i, fg in enumerate(fg_order))
+    st.session_state.fifo_order_custom = custom
+    st.session_state.order_search_result = None
+    st.session_state.analysis_completed = False
+
+@st.fragment
+def render_order_search():
+    with st.expander("🔀 Optimize FIFO Order", expanded=st.session_state.order_search_result is not None):
+        st.caption("Searches for a FIFO order with more ready FGs or more total output by moving FGs around the current order. "
+                   "Candidates are scored with the integer-unit planning engine.")
+        
+        if st.session_state.allocation_policy != 'fifo':
+            st.info(f"Order search tunes FIFO allocation; the current policy is {ALLOCATION_POLICIES[st.session_state.allocation_policy]}")
+        
+        current_order = list(st.session_state.fg_analysis_order.keys())
+        objective_label = st.radio("Maximize:", ["Ready FGs", "Total Kg"], horizontal=True, key="order_search_objective")
+        pinned_fgs = st.multiselect("Pinned FGs (keep their position):", current_order, key="order_search_pinned")
+        time_budget = st.slider("Search time (seconds):", min_value=1, max_value=30, value=5, key="order_search_budget")
+        
+        col_search, col_reset = st.columns(2)
+        if col_search.button("🔍 Search Better Order", key="order_search_run", type="primary"):
+            problem = OrderProblem(
+                RequirementMatrix(st.session_state.fg_formulas, current_order, st.session_state.calculation_margin),
+                get_pooled_stock(st.session_state.get('prod_date')),
+                st.session_state.fg_expected_capacity,
+                skip_fgs=blocked_fgs(get_data_quality_report())
+            )
+            with st.spinner("Searching FIFO orders..."):
+                search = search_fifo_order(
+                    problem,
+                    pinned=pinned_fgs,
+                    objective='ready' if objective_label == "Ready FGs" else 'kg',
+                    executor=get_order_search_pool(),
+                    workers=ORDER_SEARCH_WORKERS,
+                    time_budget=time_budget
+                )
+            search['from_order'] = current_order
+            st.session_state.order_search_result = search
+        
+        if st.session_state.fifo_order_custom and col_reset.button("↩️ Reset to Alphabetical", key="order_search_reset"):
+            apply_fifo_order(sorted(current_order), custom=False)
+            st.rerun()
+        
+        search = st.session_state.order_search_result
+        if search is None:
+            return
+        if search['from_order'] != current_order:
+            st.info("The FIFO order changed since the last search; run it again")
+            return
+        
+        start_score, best_score = search['start_score'], search['best_score']
+        if search['objective'] == 'kg':
+            start_score, best_score = start_score[::-1], best_score[::-1]
+        
+        metric_col1, metric_col2, metric_col3 = st.columns(3)
+        metric_col1.metric("Ready FGs", best_score[0], delta=best_score[0] - start_score[0])
+        metric_col2.metric("Total Output", f"{best_score[1] * 25:,.1f} Kg", delta=f"{(best_score[1] - start_score[1]) * 25:+,.1f} Kg")
+        metric_col3.metric("Orders Scored", f"{search['evaluated']:,}")
+        
+        if best_score == start_score:
+            st.info("No better order found within the time budget")
+            return
+        
+        current_position = {fg: i for i, fg in enumerate(current_order, 1)}
+        st.dataframe(
+            pd.DataFrame({
+                'FIFO Position': range(1, len(search['order']) + 1),
+                'FG Code': search['order'],
+                'Current Position': [current_position[fg] for fg in search['order']]
+            }),
+            use_container_width=True,
+            hide_index=True,
+            height=min(300, len(search['order']) * 35 + 40)
+        )
+        
+        if st.button("✅ Apply Proposed Order", key="order_search_apply"):
+            apply_fifo_order(search['order'], custom=True)
+            st.rerun()
+
+def render_data_quality():
+    issues = get_data_quality_report()
+    errors = issues[issues['Severity'] == 'Error']
+    warnings = issues[issues['Severity'] == 'Warning']
+    skipped_fgs = blocked_fgs(issues)
+    
+    title = "🩺 Data Quality: no issues found" if issues.empty else f"🩺 Data Quality: {len(errors)} error(s), {len(warnings)} warning(s)"
+    with st.expander(title, expanded=not errors.empty):
+        if issues.empty:
+            st.success("✅ Stock, PO and formula data passed all checks")
+            return
+        
+        metric_col1, metric_col2, metric_col3 = st.columns(3)
+        metric_col1.metric("Errors", len(errors))
+        metric_col2.metric("Warnings", len(warnings))
+        metric_col3.metric("FGs Skipped by Planner", len(skipped_fgs))
+        
+        if skipped_fgs:
+            st.caption(f"Skipped (invalid formula): {', '.join(sorted(skipped_fgs))}")
+        
+        st.dataframe(
+            issues,
+            use_container_width=True,
+            height=min(400, len(issues) * 35 + 40),
+            hide_index=True
+        )
+        
+        quality_excel = versioned_artefact('data_quality_excel', MASTER_TABLES, lambda: generate_data_quality_excel(issues))
+        st.download_button(
+            label="📥 Download Data Quality Report (Excel)",
+            data=quality_excel,
+            file_name=f"Data_Quality_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+            mime=EXCEL_MIME,
+            key="download_data_quality"
+        )
+
+@st.fragment
+def render_plan_view(prod_date):
+    """Run (or reuse) the background analysis and render everything that depends on it"""
+    # Run the plan in the background; a job for the same inputs is coalesced,
+    # one for outdated inputs (e.g. edited capacities) is cancelled and replaced
+    current_fingerprint = analysis_fingerprint(prod_date)
+    force = st.session_state.analysis_requested
+    st.session_state.analysis_requested = False
+    harvest_analysis_job()
+    job = ensure_analysis_job(prod_date, current_fingerprint, force=force)
+    
+    if job is not None:
+        wait_for_analysis_job(job)
+    if st.session_state.analysis_error:
+        st.error(st.session_state.analysis_error)
+    
+    analysis = st.session_state.analysis_result
+    if analysis is None:
+        return
+    
+    results = analysis['results']
+    shortage_details = analysis['shortage_details']
+    po_status_for_report = analysis['po_status_for_report']
+    delayed_pos = analysis['delayed_pos']
+    ready_fgs = analysis['ready_fgs']
+    total_volume = analysis['total_volume']
+    summary_missing_df = analysis['summary_missing_df']
+    shortage_table_df = analysis['shortage_table_df']
+    workbooks = analysis['workbooks']
+    
+    for error in analysis['errors']:
+        st.error(error)
+    
+    # Display Missing RM Summary if available
+    if summary_missing_df is not None and not summary_missing_df.empty:
+        st.divider()
+        st.write("### 📋 Missing RM Summary (Based on Expected Capacities)")
+        
+        # Display summary table
+        st.dataframe(
+            summary_missing_df,
+            use_container_width=True,
+            height=min(300, len(summary_missing_df) * 35 + 40),
+            hide_index=True,
+            column_config={
+                "RM Code": st.column_config.TextColumn("RM Code", width="small"),
+                "Total Required (Kg)": st.column_config.NumberColumn("Total Required", format="%.4f"),
+                "Total Available (Kg)": st.column_config.NumberColumn("Total Available", format="%.4f"),
+                "Total Shortage (Kg)": st.column_config.NumberColumn("Total Shortage", format="%.4f"),
+                "Affected FG Codes": st.column_config.TextColumn("Affected FGs", width="medium"),
+                "Number of Affected FGs": st.column_config.NumberColumn("Affected Count")
+            }
+        )
+        
+        render_purchase_recommendations(analysis['purchase_recommendations'])
+    
+    render_capacity_editor()
+    
+    st.divider()
+    st.write("### 📊 Production Summary")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Producible FG", len(ready_fgs))
+    col2.metric("Total Volume", f"{total_volume:,.1f} Kg")
+    col3.metric("Total Batches", sum(r['Batches'] for r in results))
+    col4.metric("Delayed POs", delayed_pos)
+    
+    st.divider()
+    render_results_table(results)
+    
+    st.divider()
+    st.write("### 🔍 Shortage Details")
+    
+    shortage_exists = False
+    for fg in shortage_details:
+        if shortage_details[fg]:
+            shortage_exists = True
+            with st.expander(f"❌ {fg} - RM Shortage Breakdown", expanded=False):
+                for item in shortage_details[fg]:
+                    st.write(f"• {item}")
+    
+    if not shortage_exists:
+        st.info("✅ No shortages detected for selected FGs")
+    
+    if po_status_for_report is not None:
+        st.divider()
+        st.write("### ⏰ PO Delay Tracker")
+        
+        po_display = po_status_for_report.copy()
+        po_display['Quantity'] = po_display['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
+        po_display['Arrival Date'] = po_display['Arrival Date'].dt.strftime('%d/%m/%Y')
+        
+        st.dataframe(
+            po_display,
+            use_container_width=True,
+            height=min(300, len(po_display) * 35 + 40),
+            hide_index=True,
+            column_config={
+                "RM Code": st.column_config.TextColumn("RM Code", width="small"),
+                "Quantity": st.column_config.TextColumn("Quantity", width="small"),
+                "Arrival Date": st.column_config.TextColumn("Arrival", width="small"),
+                "Status": st.column_config.TextColumn("Status", width="small")
+            }
+        )
+    
+    st.divider()
+    render_bottlenecks(analysis)
+    
+    st.divider()
+    render_sensitivity_panel(analysis)
+    
+    st.divider()
+    render_rm_impact(analysis)
+    
+    st.divider()
+    render_allocation_ledger(analysis)
+    
+    if len(analysis['location_summary']) > 1:
+        st.divider()
+        render_location_draws(analysis)
+    
+    if analysis['lot_queue'] is not None:
+        st.divider()
+        render_expiry_risk(analysis)
+    
+    st.divider()
+    render_capacity_charts(analysis)
+    
+    st.info(
+        f"**⚙️ Current Settings:**\n"
+        f"• Decimal Precision: {st.session_state.calculation_margin} places\n"
+        f"• Quantity Mode: {'Exact integer units' if st.session_state.fixed_point_mode else 'Floating point'}\n"
+        f"• Allocation Policy: {ALLOCATION_POLICIES[st.session_state.allocation_policy]}\n"
+        f"• Location Draw Rule: {LOCATION_RULES[st.session_state.location_rule]}\n"
+        f"• FIFO Order: {', '.join(st.session_state.fg_analysis_order.keys())}\n"
+        f"• Batch Size: 25 Kg per batch"
+    )
+    
+    # --- EXPORT REPORTS ---
+    st.divider()
+    st.write("### 📤 Export Reports")
+    
+    # Create 3 columns for export buttons
+    if analysis['exports_evicted']:
+        st.info("ℹ️ Some exports were evicted to keep this session within its memory budget.")
+        st.button("🔄 Rebuild Exports", key="rebuild_exports", on_click=build_analysis_exports, args=(analysis,))
+    
+    export_col1, export_col2, export_col3 = st.columns(3)
+    
+    with export_col1:
+        # PDF/HTML Report Button
+        report_data = analysis['report_data']
+        if report_data is not None:
+            if analysis['report_type'] == "pdf":
+                mime_type = "application/pdf"
+                file_name = f"MRP_Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+                btn_label = "⬇️ PDF Report"
+            else:
+                mime_type = "text/html"
+                file_name = f"MRP_Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+                btn_label = "⬇️ HTML Report"
+            
+            st.download_button(
+                label=btn_label,
+                data=report_data,
+                file_name=file_name,
+                mime=mime_type,
+                key="pdf_html_download",
+                on_click=touch_artefact,
+                args=(('export', 'report'),)
+            )
+    
+    with export_col2:
+        # Excel Export Button with Shortage Details only
+        if not results:
+            st.info("No production data")
+        elif 'shortage' in workbooks:
+            st.download_button(
+                label="📈 Shortage Details (Excel)",
+                data=workbooks['shortage'],
+                file_name=f"Shortage_Details_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime=EXCEL_MIME,
+                key="shortage_excel_download",
+                on_click=touch_artefact,
+                args=(('export', 'shortage'),)
+            )
+        elif 'production_summary' in workbooks:
+            # Simple Excel with production results if no shortages
+            st.download_button(
+                label="📈 Production Summary (Excel)",
+                data=workbooks['production_summary'],
+                file_name=f"Production_Summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime=EXCEL_MIME,
+                key="results_excel_download",
+                on_click=touch_artefact,
+                args=(('export', 'production_summary'),)
+            )
+    
+    with export_col3:
+        # Complete Report Button (Missing RM Analysis)
+        if not results:
+            st.info("No production data")
+        elif 'complete' in workbooks:
+            st.download_button(
+                label="🚀 Complete Missing RM Report",
+                data=workbooks['complete'],
+                file_name=f"Complete_Missing_RM_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime=EXCEL_MIME,
+                key="all_missing_download",
+                on_click=touch_artefact,
+                args=(('export', 'complete'),)
+            )
+        elif 'basic' in workbooks:
+            # Basic report even without shortages
+            st.download_button(
+                label="📋 Basic Production Report",
+                data=workbooks['basic'],
+                file_name=f"Production_Report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime=EXCEL_MIME,
+                key="production_report_download",
+                on_click=touch_artefact,
+                args=(('export', 'basic'),)
+            )
+    
+    render_plan_bundle_export(analysis)
+    render_run_history(analysis)
+    
+    # Display the shortage details table that will be exported
+    if not shortage_table_df.empty:
+        st.divider()
+        st.write("### 📊 Shortage Details for Export")
+        
+        # Display the table that will be exported
+        st.dataframe(
+            shortage_table_df,
+            use_container_width=True,
+            height=min(300, len(shortage_table_df) * 35 + 40),
+            hide_index=True,
+            column_config={
+                "FG Code": st.column_config.TextColumn("FG Code", width="small"),
+                "RM Code": st.column_config.TextColumn("RM Code", width="small"),
+                "Required (Kg)": st.column_config.NumberColumn("Required", format="%.4f"),
+                "Available (Kg)": st.column_config.NumberColumn("Available", format="%.4f"),
+                "Shortage (Kg)": st.column_config.NumberColumn("Shortage", format="%.4f")
+            }
+        )
+        st.caption("This table will be exported in the 'Shortage Details (Excel)' download")
+
+# Function to add footer to all tabs
+def add_footer():
+    st.markdown("---")
+    st.markdown(
+        """
+        <div style="text-align: center; color: #666; font-size: 12px; padding: 10px;">
+            <strong>RGI - Supply Chain Department</strong> | MRP Dashboard System
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+
+# --- PAGE 1: STOCK & PO ---
+with tab1:
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.subheader("Raw Material Stock (RM)")
+        
+        if st.button("🔄 Clear RM Stock", key="clear_rm"):
+            commit_master_data("Clear RM stock", rm_stock=pd.DataFrame(columns=['RM Code', 'Location', 'Quantity']))
+            record_ingestion_issues('rm_stock', [], replace=True)
+            st.session_state.analysis_completed = False
+            st.success("RM Stock cleared! (Undo from Master Data Versions in the sidebar)")
+        
+        rm_upload_mode = st.radio(
+            "Upload mode:",
+            ["Replace stock", "Apply delta (receipts/issues)"],
+            horizontal=True,
+            key="rm_upload_mode",
+            help="A delta file holds signed quantity changes per RM Code (and Location); they are added to the current stock in place"
+        )
+        rm_file = st.file_uploader("Upload RM Stock Excel", type=['xlsx', 'xls'], key="rm_up")
+        
+        if rm_file is not None and is_new_upload('rm_up', rm_file):
+            try:
+                df = pd.read_excel(rm_file)
+                upload_issues = []
+                processed_df, missing_cols = normalize_stock_frame(df, upload_issues)
+                
+                if missing_cols:
+                    st.error(f"Missing columns: {', '.join(missing_cols)}. Found columns: {list(df.columns)}")
+                elif processed_df.empty:
+                    st.warning("No valid data found in the uploaded file")
+                elif rm_upload_mode.startswith("Apply delta"):
+                    # Committed versions are never modified; the delta goes into a copy
+                    rm_stock, delta_summary = apply_stock_delta(st.session_state.rm_stock.copy(), processed_df)
+                    commit_master_data(f"Stock delta from {rm_file.name}", rm_stock=rm_stock)
+                    record_ingestion_issues('rm_stock', upload_issues, replace=False)
+                    st.success(f"✅ Applied {len(processed_df)} stock changes: {delta_summary['updated']} RM(s) updated, {delta_summary['added']} added")
+                    if delta_summary['negative']:
+                        st.warning(f"⚠️ {delta_summary['negative']} RM(s) now have negative stock")
+                else:
+                    commit_master_data(f"Stock from {rm_file.name}", rm_stock=processed_df)
+                    record_ingestion_issues('rm_stock', upload_issues, replace=True)
+                    st.success(f"✅ Successfully loaded {len(processed_df)} RM stock records!")
+                    
+            except Exception as e:
+                st.error(f"Error processing RM file: {str(e)}")
+        
+        if not st.session_state.rm_stock.empty:
+            st.write("### 📊 Current Stock Inventory")
+            
+            display_df = versioned_artefact('rm_stock_display', 'rm_stock', lambda: format_quantity_column(st.session_state.rm_stock))
+            
+            st.dataframe(
+                display_df,
+                use_container_width=True,
+                height=min(300, len(display_df) * 35 + 40),
+                hide_index=True
+            )
+            
+            st.write("### 🔍 View RM Details")
+            if not st.session_state.rm_stock.empty:
+                sel_rm = st.selectbox(
+                    "Select RM Code:",
+                    st.session_state.rm_stock['RM Code'].unique(),
+                    key="rm_select"
+                )
+                if sel_rm:
+                    stock = get_pooled_stock()
+                    qty_row = stock[stock['RM Code'] == sel_rm]
+                    if not qty_row.empty:
+                        qty = qty_row['Quantity'].values[0]
+                        st.metric(label=f"Available {sel_rm}", value=f"{qty:,.4f} Kg")
+                    po_index = get_po_index()
+                    if len(po_index.schedule(sel_rm)):
+                        arriving_by = st.date_input("In hand plus POs arriving by:",
+                                                    st.session_state.get('prod_date', datetime.now()),
+                                                    key="rm_available_by")
+                        available = po_index.available_by(stock, [sel_rm], arriving_by)[0]
+                        st.metric(label=f"Available {sel_rm} by {arriving_by.strftime('%d/%m/%Y')}",
+                                  value=f"{available:,.4f} Kg")
+                    by_location = with_location(st.session_state.rm_stock)
+                    by_location = by_location[by_location['RM Code'] == sel_rm].drop_duplicates(subset='Location', keep='last')
+                    if len(by_location) > 1:
+                        st.dataframe(format_quantity_column(by_location[['Location', 'Quantity']]), hide_index=True)
+        else:
+            st.info("📤 No RM stock data loaded yet. Please upload an Excel file with RM Code and Quantity columns "
+                    "(and optionally Location/Warehouse, Lot and Expiry Date columns).")
+
+    with col2:
+        st.subheader("RM in Purchase Orders (PO)")
+        
+        if st.button("🔄 Clear RM PO", key="clear_po"):
+            commit_master_data("Clear RM PO",
+                               rm_po=pd.DataFrame(columns=['RM Code', 'Location', 'Quantity', 'Arrival Date']))
+            record_ingestion_issues('rm_po', [], replace=True)
+            st.session_state.analysis_completed = False
+            st.success("RM PO cleared! (Undo from Master Data Versions in the sidebar)")
+        
+        po_upload_mode = st.radio(
+            "Upload mode:",
+            ["Replace POs", "Apply delta (new/cancelled POs)"],
+            horizontal=True,
+            key="po_upload_mode",
+            help="In a delta file positive quantities add PO lines and negative quantities cancel open POs for the same RM Code and arrival date"
+        )
+        po_file = st.file_uploader("Upload RM PO Excel", type=['xlsx', 'xls'], key="po_up")
+        
+        if po_file is not None and is_new_upload('po_up', po_file):
+            try:
+                df_po = pd.read_excel(po_file)
+                upload_issues = []
+                processed_df, missing_cols = normalize_po_frame(df_po, upload_issues)
+                
+                if missing_cols:
+                    st.error(f"Missing columns: {', '.join(missing_cols)}. Found columns: {list(df_po.columns)}")
+                elif processed_df.empty:
+                    st.warning("No valid data found in the uploaded file")
+                elif po_upload_mode.startswith("Apply delta"):
+                    rm_po, delta_summary = apply_po_delta(st.session_state.rm_po.copy(), processed_df)
+                    commit_master_data(f"PO delta from {po_file.name}", rm_po=rm_po)
+                    record_ingestion_issues('rm_po', upload_issues, replace=False)
+                    st.success(f"✅ Applied PO changes: {delta_summary['added']} PO line(s) added, {delta_summary['cancelled_lines']} cancelled")
+                    if delta_summary['unmatched'] > 0:
+                        st.warning(f"⚠️ {delta_summary['unmatched']:,.4f} Kg of cancellations matched no open PO")
+                else:
+                    commit_master_data(f"POs from {po_file.name}", rm_po=processed_df)
+                    record_ingestion_issues('rm_po', upload_issues, replace=True)
+                    st.success(f"✅ Successfully loaded {len(processed_df)} PO records!")
+                    
+            except Exception as e:
+                st.error(f"Error processing PO file: {str(e)}")
+        
+        if not st.session_state.rm_po.empty:
+            st.write("### 📅 PO Schedule")
+            
+            def build_po_display():
+                display_po = format_quantity_column(st.session_state.rm_po.sort_values(by='Arrival Date'))
+                display_po['Arrival Date'] = display_po['Arrival Date'].dt.strftime('%d/%m/%Y')
+                return display_po
+            
+            display_po = versioned_artefact('rm_po_display', 'rm_po', build_po_display)
+            
+            st.dataframe(
+                display_po,
+                use_container_width=True,
+                height=min(300, len(display_po) * 35 + 40),
+                hide_index=True
+            )
+            
+            st.write("### 📊 Total RM in PO by Code")
+            if not st.session_state.rm_po.empty:
+                total_po = versioned_artefact(
+                    'rm_po_totals', 'rm_po',
+                    lambda: format_quantity_column(st.session_state.rm_po.groupby('RM Code')['Quantity'].sum().reset_index())
+                )
+                
+                st.dataframe(
+                    total_po,
+                    use_container_width=True,
+                    hide_index=True
+                )
+        else:
+            st.info("📤 No PO data loaded yet. Please upload an Excel file with RM Code, Quantity, and Arrival Date columns.")
+    
+    st.divider()
+    st.subheader("🚚 Supplier Terms")
+    st.caption("Minimum order quantity, order lot size and lead time per RM, used for the procurement recommendations. "
+               "RMs without terms (or with a blank term) use the defaults.")
+    
+    terms_col1, terms_col2 = st.columns([2, 1])
+    with terms_col2:
+        defaults = st.session_state.procurement_defaults
+        defaults['MOQ (Kg)'] = st.number_input("Default MOQ (Kg)", min_value=0.0, value=float(defaults['MOQ (Kg)']),
+                                               step=25.0, key="default_moq")
+        defaults['Lot Size (Kg)'] = st.number_input("Default lot size (Kg, 0 = no rounding)", min_value=0.0,
+                                                    value=float(defaults['Lot Size (Kg)']), step=25.0, key="default_lot_size")
+        defaults['Lead Time (days)'] = st.number_input("Default lead time (days)", min_value=0,
+                                                       value=int(defaults['Lead Time (days)']), step=1, key="default_lead_time")
+    
+    with terms_col1:
+        terms_file = st.file_uploader("Upload Supplier Terms Excel", type=['xlsx', 'xls'], key="terms_up")
+        if terms_file is not None and is_new_upload('terms_up', terms_file):
+            try:
+                processed_df, missing_cols = normalize_supplier_terms_frame(pd.read_excel(terms_file))
+                if missing_cols:
+                    st.error(f"Missing columns: {', '.join(missing_cols)}")
+                else:
+                    commit_master_data(f"Supplier terms from {terms_file.name}", supplier_terms=processed_df)
+                    st.success(f"✅ Loaded supplier terms for {len(processed_df)} RM(s)")
+            except Exception as e:
+                st.error(f"Error processing supplier terms file: {str(e)}")
+        
+        if not st.session_state.supplier_terms.empty:
+            st.dataframe(st.session_state.supplier_terms, use_container_width=True, hide_index=True,
+                         height=min(300, len(st.session_state.supplier_terms) * 35 + 40))
+            if st.button("🔄 Clear Supplier Terms", key="clear_terms"):
+                commit_master_data("Clear supplier terms", supplier_terms=pd.DataFrame(columns=SUPPLIER_TERMS_COLUMNS))
+                st.rerun()
+        else:
+            st.info("📤 Upload an Excel file with RM Code and any of MOQ, Lot Size and Lead Time columns.")
+    
+    add_footer()
+
+# --- PAGE 2: FG FORMULAS & SETTINGS ---
+with tab2:
+    col1, col2 = st.columns([2, 1])
+    
+    with col1:
+        st.subheader("Finished Goods Formula Management")
+        
+        fg_files = st.file_uploader(
+            "Upload FG Formulas (Multiple allowed)", 
+            type=['xlsx', 'xls'], 
+            accept_multiple_files=True,
+            key="fg_uploader"
+        )
+        
+        if fg_files:
+            total_loaded = 0
+            formula_book = st.session_state.master_data.head.tables['fg_formulas']
+            loaded_files = []
+            for f in fg_files:
+                if not is_new_upload('fg_uploader', f):
+                    continue
+                try:
+                    new_fg = pd.read_excel(f)
+                    upload_issues = []
+                    processed_fg, missing_cols = normalize_formula_frame(new_fg, upload_issues)
+                    
+                    if missing_cols:
+                        st.error(f"{f.name}: Missing columns {', '.join(missing_cols)}. Found: {list(new_fg.columns)}")
+                    elif not processed_fg.empty:
+                        formula_book = formula_book.merged(processed_fg, upload_issues)
+                        loaded_files.append(f.name)
+                        record_ingestion_issues('fg_formulas', upload_issues, replace=False)
+                        
+                        for fg_code in processed_fg['FG Code'].unique():
+                            if fg_code not in st.session_state.fg_colors:
+                                get_fg_color(fg_code)
+                        
+                        total_loaded += len(processed_fg['FG Code'].unique())
+                        st.success(f"✅ Loaded {len(processed_fg['FG Code'].unique())} FG formulas from {f.name}")
+                    else:
+                        st.warning(f"No valid data found in {f.name}")
+                        
+                except Exception as e:
+                    st.error(f"Error reading {f.name}: {str(e)}")
+            
+            # Only a real change of the formulas makes a new version and invalidates the analysis
+            if total_loaded > 0 and formula_book is not st.session_state.master_data.head.tables['fg_formulas']:
+                commit_master_data(f"Formulas from {', '.join(loaded_files)}", fg_formulas=formula_book)
+                st.session_state.analysis_completed = False
+        
+        if not st.session_state.fg_formulas.empty:
+            st.divider()
+            st.write("### 📋 Current FG Formulas")
+            
+            display_fg = versioned_artefact('fg_formulas_display', 'fg_formulas', lambda: format_quantity_column(st.session_state.fg_formulas))
+            
+            st.dataframe(
+                display_fg,
+                use_container_width=True,
+                height=min(400, len(display_fg) * 35 + 40),
+                hide_index=True
+            )
+            
+            st.divider()
+            st.write("### 🔍 Analyze FG Formula")
+            
+            fg_codes = sorted(st.session_state.fg_formulas['FG Code'].unique().tolist())
+            
+            # FIXED SELECT ALL FUNCTIONALITY
+            # Create two columns for layout
+            col_select, col_button = st.columns([4, 1])
+            
+            with col_select:
+                # Get current selection
+                if st.session_state.select_all_trigger:
+                    current_selection = fg_codes.copy()
+                else:
+                    current_selection = list(st.session_state.fg_analysis_order.keys())
+                
+                # Create the multiselect widget with dynamic key
+                selected_fgs = st.multiselect(
+                    "Select FG Codes for analysis (Order determines FIFO priority):",
+                    options=fg_codes,
+                    default=current_selection,
+                    key=f"fg_analysis_select_{st.session_state.multiselect_key}"
+                )
+            
+            with col_button:
+                st.write("")  # Spacing
+                st.write("")  # Spacing
+                if st.button("📋 Select All", key="select_all_fg_button", type="secondary"):
+                    # Set the trigger and force widget refresh
+                    st.session_state.select_all_trigger = True
+                    st.session_state.multiselect_key += 1
+                    st.rerun()
+            
+            # Update the analysis order based on current selection
+            if selected_fgs:
+                if st.session_state.fifo_order_custom:
+                    # Keep an applied custom order; newly selected FGs go last
+                    kept_fgs = [fg for fg in st.session_state.fg_analysis_order if fg in set(selected_fgs)]
+                    sorted_selected_fgs = kept_fgs + sorted(set(selected_fgs) - set(kept_fgs))
+                else:
+                    # Sort selected FGs alphabetically/numerically
+                    sorted_selected_fgs = sorted(selected_fgs)
+                
+                # Create new order preserving sorted order
+                new_order = OrderedDict()
+                for i, fg in enumerate(sorted_selected_fgs):
+                    new_order[fg] = i
+                
+                # Update session state only when the selection really changed,
+                # so ordinary reruns don't discard a finished analysis
+                if list(new_order) != list(st.session_state.fg_analysis_order):
+                    st.session_state.fg_analysis_order = new_order
+                    st.session_state.analysis_completed = False
+                
+                # Reset select_all_trigger if not all are selected
+                if set(selected_fgs) != set(fg_codes):
+                    st.session_state.select_all_trigger = False
+            else:
+                # Clear if nothing selected
+                if st.session_state.fg_analysis_order:
+                    st.session_state.fg_analysis_order = OrderedDict()
+                    st.session_state.analysis_completed = False
+                st.session_state.fifo_order_custom = False
+                st.session_state.select_all_trigger = False
+            
+            # Display the current FIFO order
+            if st.session_state.fg_analysis_order:
+                st.write("**🎯 FIFO Order (First to Last):**")
+                for i, (fg, _) in enumerate(st.session_state.fg_analysis_order.items(), 1):
+                    st.write(f"{i}. {fg}")
+                
+                render_order_search()
+                
+                st.write("### 📊 View Formula Details")
+                sel_fg_view = st.selectbox(
+                    "Select FG to view details:",
+                    list(st.session_state.fg_analysis_order.keys()),
+                    key="fg_view_select"
+                )
+                
+                if sel_fg_view:
+                    formula_view = st.session_state.fg_formulas[
+                        st.session_state.fg_formulas['FG Code'] == sel_fg_view
+                    ].copy()
+                    formula_view['Quantity'] = formula_view['Quantity'].apply(lambda x: f"{x:,.4f} Kg")
+                    
+                    st.dataframe(
+                        formula_view,
+                        use_container_width=True,
+                        height=min(300, len(formula_view) * 35 + 40),
+                        hide_index=True
+                    )
+            else:
+                if fg_codes:  # Only show if there are FGs available
+                    st.info("Select FG codes above to analyze production planning in Tab 3")
+        
+        else:
+            st.info("🧪 No FG formulas loaded yet. Please upload Excel files with FG Code, RM Code, and Quantity columns.")
+    
+    with col2:
+        st.subheader("⚙️ Calculation Settings")
+        
+        st.write("### 🔢 Decimal Precision")
+        margin = st.number_input(
+            "Decimal places for calculations:",
+            min_value=0,
+            max_value=6,
+            value=st.session_state.calculation_margin,
+            help="Controls rounding precision for all calculations",
+            key="decimal_precision"
+        )
+        
+        if margin != st.session_state.calculation_margin:
+            st.session_state.calculation_margin = int(margin)
+        
+        st.write("### 🎯 Quantity Mode")
+        quantity_mode = st.radio(
+            "Engine arithmetic:",
+            ["Floating point", "Exact integer units"],
+            index=1 if st.session_state.fixed_point_mode else 0,
+            help="Exact mode converts stock and requirements once to integer units of the chosen decimal precision, "
+                 "so allocations never drift below zero",
+            key="quantity_mode"
+        )
+        st.session_state.fixed_point_mode = quantity_mode == "Exact integer units"
+        
+        st.write("### ⚖️ Allocation Policy")
+        policy_keys = list(ALLOCATION_POLICIES)
+        st.session_state.allocation_policy = st.selectbox(
+            "When FGs compete for a scarce RM:",
+            policy_keys,
+            index=policy_keys.index(st.session_state.allocation_policy),
+            format_func=ALLOCATION_POLICIES.get,
+            help="FIFO serves FGs in the order above. Fair-share splits a scarce RM in proportion to demand, "
+                 "priority classes weight that split, and max-min raises every FG's fill level together.",
+            key="allocation_policy_select"
+        )
+        
+        if st.session_state.allocation_policy == 'priority':
+            ordered_fgs = list(st.session_state.fg_analysis_order.keys())
+            priority_class = st.session_state.fg_priority_class
+            high_fgs = st.multiselect(
+                "High priority FGs:",
+                ordered_fgs,
+                default=[fg for fg in ordered_fgs if priority_class.get(fg) == 'High'],
+                key="priority_high_fgs"
+            )
+            low_fgs = st.multiselect(
+                "Low priority FGs:",
+                [fg for fg in ordered_fgs if fg not in high_fgs],
+                default=[fg for fg in ordered_fgs if priority_class.get(fg) == 'Low' and fg not in high_fgs],
+                key="priority_low_fgs"
+            )
+            st.session_state.fg_priority_class = {
+                **{fg: 'High' for fg in high_fgs},
+                **{fg: 'Low' for fg in low_fgs}
+            }
+            st.caption("Other FGs are Medium. Weights: " + ", ".join(f"{name} {weight}" for name, weight in PRIORITY_CLASS_WEIGHTS.items()))
+        
+        locations = stock_locations()
+        if len(locations) > 1:
+            st.write("### 🏬 Stock Locations")
+            rule_keys = list(LOCATION_RULES)
+            st.session_state.location_rule = st.selectbox(
+                "Draw stock from:",
+                rule_keys,
+                index=rule_keys.index(st.session_state.location_rule),
+                format_func=LOCATION_RULES.get,
+                help="The plan uses stock pooled over all locations; this rule decides which location each allocation is taken from",
+                key="location_rule_select"
+            )
+            settings = st.session_state.location_settings
+            edited_locations = st.data_editor(
+                pd.DataFrame({
+                    'Location': locations,
+                    'Priority': [settings.get(loc, {}).get('Priority', i + 1) for i, loc in enumerate(locations)],
+                    'Transfer Cost (per Kg)': [settings.get(loc, {}).get('Transfer Cost (per Kg)', 0.0) for loc in locations],
+                }),
+                disabled=['Location'],
+                hide_index=True,
+                use_container_width=True,
+                key="location_settings_editor"
+            )
+            st.session_state.location_settings = {
+                row['Location']: {'Priority': int(row['Priority']), 'Transfer Cost (per Kg)': float(row['Transfer Cost (per Kg)'])}
+                for row in edited_locations.fillna({'Priority': len(locations), 'Transfer Cost (per Kg)': 0.0}).to_dict('records')
+            }
+        
+        st.divider()
+        
+        st.write("### 🗑️ Data Management")
+        
+        if st.button("🗑️ Clear All FG Formulas", type="secondary", key="clear_all_fg"):
+            commit_master_data("Clear all FG formulas",
+                               fg_formulas=pd.DataFrame(columns=['FG Code', 'RM Code', 'Quantity']))
+            record_ingestion_issues('fg_formulas', [], replace=True)
+            st.session_state.fg_analysis_order = OrderedDict()
+            st.session_state.fifo_order_custom = False
+            st.session_state.fg_expected_capacity = {}
+            st.session_state.fg_colors = {}
+            st.session_state.analysis_completed = False
+            st.session_state.select_all_trigger = False
+            st.session_state.multiselect_key = 0
+            st.success("All FG formulas cleared! (Undo from Master Data Versions in the sidebar)")
+        
+        st.divider()
+        
+        if not st.session_state.fg_formulas.empty:
+            st.write("### 🎯 Delete Specific FG")
+            fg_codes = st.session_state.fg_formulas['FG Code'].unique().tolist()
+            to_delete = st.multiselect("Select FG to delete:", fg_codes, key="fg_delete_select")
+            
+            if st.button("🗑️ Delete Selected FG", type="primary", key="delete_fg") and to_delete:
+                # The new version shares every other FG's lines with the current one
+                formula_book = st.session_state.master_data.head.tables['fg_formulas']
+                commit_master_data(f"Delete {len(to_delete)} FG(s)", fg_formulas=formula_book.without(to_delete))
+                
+                for fg in to_delete:
+                    if fg in st.session_state.fg_analysis_order:
+                        del st.session_state.fg_analysis_order[fg]
+                
+                for fg in to_delete:
+                    if fg in st.session_state.fg_expected_capacity:
+                        del st.session_state.fg_expected_capacity[fg]
+                
+                for fg in to_delete:
+                    if fg in st.session_state.fg_colors:
+                        del st.session_state.fg_colors[fg]
+                
+                # Update analysis flag
+                if not st.session_state.fg_analysis_order:
+                    st.session_state.analysis_completed = False
+                
+                # Reset select all trigger
+                st.session_state.select_all_trigger = False
+                st.session_state.multiselect_key += 1
+                
+                st.success(f"✅ Deleted {len(to_delete)} FG(s): {', '.join(to_delete)}")
+                st.rerun()
+    
+    add_footer()
+
+# --- PAGE 3: PRODUCTION PLANNING ---
+with tab3:
+    col_date, col_export = st.columns([2, 1])
+    
+    with col_date:
+        st.subheader("Production Planning Summary")
+        prod_date = st.date_input("Select Planned Production Date", datetime.now(), key="prod_date")
+    
+    with col_export:
+        st.write("")
+        st.write("")
+        if st.button("📊 Generate Production Analysis", type="primary", key="generate_analysis", on_click=request_analysis):
+            if st.session_state.fg_analysis_order:
+                st.success("✅ Production analysis started! Results appear below when ready.")
+            else:
+                st.warning("⚠️ Please select FG codes in Tab 2 first.")
+    
+    data_ready = True
+    warning_messages = []
+    
+    if st.session_state.rm_stock.empty:
+        warning_messages.append("📦 RM Stock")
+        data_ready = False
+    
+    if st.session_state.fg_formulas.empty:
+        warning_messages.append("🧪 FG Formulas")
+        data_ready = False
+    
+    if not st.session_state.fg_analysis_order:
+        warning_messages.append("🎯 FG selection for analysis")
+        data_ready = False
+    
+    if not st.session_state.rm_stock.empty or not st.session_state.fg_formulas.empty:
+        render_data_quality()
+    
+    if not data_ready:
+        cancel_analysis_job()
+        st.warning(f"⚠️ Please complete the following in previous tabs:")
+        for msg in warning_messages:
+            st.write(f"- {msg}")
+    elif st.session_state.analysis_completed:
+        render_plan_view(prod_date)
+    else:
+        cancel_analysis_job()
+        st.session_state.analysis_result = None
+        st.info("👆 Click 'Generate Production Analysis' button above to see production planning results.")
+    
+    add_footer()
+
+with st.sidebar:
+    render_master_data_versions()
+    render_memory_diagnostics()
@@ -0,0 +1,401 @@
+"""Local HTTP planning API for the MRP dashboard.
+
+Loads the stock, PO and formula workbooks once and keeps the planning model
+warm: the requirement matrix over every FG, the pooled stock vector and the
+PO index. Other tools then ask batched JSON questions over plain HTTP:
+
+    POST /feasibility  {"requests": [{"fg": "FG-1234", "kg": 500, "date": "2026-10-20"}, ...]}
+    POST /plan         {"requests": [{"fg_order": ["FG-1", "FG-2"], "capacities": {"FG-1": 500}}, ...]}
+    POST /stock        {"rows": [{"RM Code": "RM-1", "Quantity": 120.5}, ...], "mode": "replace" | "delta"}
+    GET  /health
+
+Feasibility checks one FG at a time against the stock in hand (plus the POs
+arriving by ``date`` when one is given); plan requests run the dashboard's
+plan over an FG order. A stock refresh builds a new model next to the live
+one and swaps it in with a single reference assignment, so requests being
+served keep the snapshot they started with.
+
+    python mrp_api.py --stock stock.xlsx --po po.xlsx --formulas formulas.xlsx --port 8765
+
+``LocalPlanningClient`` talks to a ``PlanningService`` in-process and
+``PlanningClient`` to a running server; both return the same JSON bodies.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from mrp_engine import (
+    ALLOCATION_POLICIES, BATCH_SIZE_KG, POIndex, RequirementMatrix, apply_stock_delta, compute_production_plan,
+    merge_formula_frames, normalize_formula_frame, normalize_po_frame, normalize_stock_frame, pooled_stock,
+    usable_stock
+)
+
+
+class APIError(Exception):
+    """A request the service can't answer; ``status`` is the HTTP status to reply with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class PlanningModel:
+    """Immutable snapshot of the master data with its planning indexes built.
+
+    ``rm_stock`` keeps the raw stock rows (for delta refreshes); the planner
+    and feasibility checks read the pooled stock, without lots expired by the
+    day the model was built.
+    """
+
+    def __init__(self, rm_stock, rm_po, fg_formulas, decimal_places=3, version=1,
+                 matrix=None, po_index=None):
+        self.rm_stock = rm_stock
+        self.rm_po = rm_po
+        self.fg_formulas = fg_formulas
+        self.decimal_places = decimal_places
+        self.version = version
+        self.loaded_at = pd.Timestamp.now()
+
+        fg_codes = fg_formulas['FG Code'].drop_duplicates().to_numpy()
+        self.matrix = matrix if matrix is not None else RequirementMatrix(fg_formulas, fg_codes, decimal_places)
+        self.po_index = po_index if po_index is not None else POIndex(rm_po)
+        self.fg_positions = pd.Index(self.matrix.fg_codes)
+
+        self.pooled = pooled_stock(usable_stock(rm_stock, date.today()))
+        self.stock, _ = self.matrix.stock_vector(self.pooled)
+
+    def with_stock(self, rm_stock):
+        """A new model on ``rm_stock`` sharing this one's formulas, matrix and PO index"""
+        return PlanningModel(rm_stock, self.rm_po, self.fg_formulas, self.decimal_places, self.version + 1,
+                             matrix=self.matrix, po_index=self.po_index)
+
+    def stock_by(self, as_of):
+        """Pooled stock (RM Code / Quantity) plus the POs arriving by ``as_of``"""
+        rm_codes = pd.Index(self.pooled['RM Code']).union(pd.Index(self.po_index.rm_codes))
+        quantities = self.po_index.available_by(self.pooled, rm_codes.to_numpy(dtype=object), as_of)
+        return pd.DataFrame({'RM Code': rm_codes.to_numpy(dtype=object), 'Quantity': quantities})
+
+    def feasibility(self, fg_codes, kgs, dates):
+        """Can each FG make its Kg (in whole batches) from stock, plus POs by its date (NaT = none)?
+
+        Every query is checked on its own against the same stock. The formula
+        lines of all queries are gathered into one flat array, so the batch is
+        a handful of vectorised operations whatever its size.
+        """
+        fg_pos = self.fg_positions.get_indexer(np.asarray(fg_codes, dtype=object))
+        batches = np.maximum(1, np.asarray(kgs, dtype=float) // BATCH_SIZE_KG).astype(np.int64)
+        known = fg_pos >= 0
+        starts = np.where(known, self.matrix.indptr[np.where(known, fg_pos, 0)], 0)
+        counts = np.where(known, self.matrix.indptr[np.where(known, fg_pos, 0) + 1] - starts, 0)
+
+        first_line = np.cumsum(counts) - counts
+        query = np.repeat(np.arange(len(fg_pos)), counts)
+        lines = starts[query] + np.arange(counts.sum()) - first_line[query]
+
+        rm_idx = self.matrix.rm_idx[lines]
+        req = self.matrix.quantities[lines]
+        line_dates = np.asarray(dates, dtype='datetime64[D]')[query]
+        arriving = self.po_index.arriving_by(self.matrix.rm_codes[rm_idx], line_dates)
+        avail = np.round(self.stock[rm_idx] + arriving, self.decimal_places)
+        required = np.round(req * batches[query], self.decimal_places)
+        short = (req <= 0) | (avail < required)
+        covered = np.where((req > 0) & (avail > 0), avail // np.where(req > 0, req, 1), 0)
+
+        n = len(fg_pos)
+        has_lines = counts > 0
+        max_batches = np.zeros(n, dtype=np.int64)
+        limiting = np.full(n, -1)
+        if len(lines):
+            max_batches[has_lines] = np.minimum.reduceat(covered, first_line[has_lines]).astype(np.int64)
+            # First line reaching the minimum is the limiting RM
+            at_min = covered == max_batches[query]
+            first = np.full(n, len(lines))
+            np.minimum.at(first, query[at_min], np.flatnonzero(at_min))
+            limiting[has_lines] = first[has_lines]
+        feasible = has_lines & (np.bincount(query, weights=short, minlength=n) == 0)
+
+        replies = []
+        for i in range(n):
+            if not known[i]:
+                replies.append({'fg': fg_codes[i], 'error': "Unknown FG code"})
+                continue
+            window = slice(first_line[i], first_line[i] + counts[i])
+            shortages = [
+                {'rm': self.matrix.rm_codes[rm], 'required_kg': float(need), 'available_kg': float(have),
+                 'shortage_kg': float(round(max(need - have, 0.0), self.decimal_places))}
+                for rm, need, have in zip(rm_idx[window][short[window]], required[window][short[window]],
+                                          avail[window][short[window]])
+            ]
+            replies.append({
+                'fg': fg_codes[i],
+                'kg': float(batches[i] * BATCH_SIZE_KG),
+                'batches': int(batches[i]),
+                'feasible': bool(feasible[i]),
+                'max_batches': int(max_batches[i]),
+                'max_kg': float(max_batches[i] * BATCH_SIZE_KG),
+                'limiting_rm': self.matrix.rm_codes[rm_idx[limiting[i]]] if limiting[i] >= 0 else None,
+                'shortages': shortages,
+            })
+        return replies
+
+
+class PlanningService:
+    """Request handling over the live ``PlanningModel``; safe to call from many threads.
+
+    Readers take ``self.model`` once per request and work on that snapshot.
+    Refreshes are serialized by a lock and publish the new model with one
+    assignment, so a reader sees either the old model or the new one, never a
+    mix.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._refresh_lock = threading.Lock()
+
+    def handle(self, method, path, payload=None):
+        """Dispatch one request; returns ``(status, body)``"""
+        routes = {
+            ('GET', '/health'): self.health,
+            ('POST', '/feasibility'): self.feasibility,
+            ('POST', '/plan'): self.plan,
+            ('POST', '/stock'): self.refresh_stock,
+        }
+        route = routes.get((method, path.rstrip('/') or '/'))
+        if route is None:
+            return 404, {'error': f"No route for {method} {path}"}
+        if payload is not None and not isinstance(payload, dict):
+            return 400, {'error': "Expected a JSON object"}
+        started = time.perf_counter()
+        try:
+            body = route(payload or {})
+        except APIError as e:
+            return e.status, {'error': str(e)}
+        except (KeyError, TypeError, ValueError) as e:
+            return 400, {'error': f"Bad request: {e}"}
+        except Exception as e:
+            # Every request gets a reply; an unexpected failure must not drop the connection
+            return 500, {'error': f"Internal error: {type(e).__name__}: {e}"}
+        body['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return 200, body
+
+    def health(self, payload):
+        model = self.model
+        return {
+            'status': 'ok',
+            'model_version': model.version,
+            'loaded_at': model.loaded_at.isoformat(timespec='seconds'),
+            'fgs': len(model.matrix),
+            'rms': len(model.pooled),
+            'po_lines': len(model.po_index),
+        }
+
+    @staticmethod
+    def _requests(payload):
+        requests = payload.get('requests')
+        if not isinstance(requests, list):
+            raise APIError("Expected a JSON object with a 'requests' list")
+        if not all(isinstance(request, dict) for request in requests):
+            raise APIError("Each request must be a JSON object")
+        return requests
+
+    @staticmethod
+    def _object(request, key):
+        value = request.get(key)
+        if value is not None and not isinstance(value, dict):
+            raise APIError(f"'{key}' must be a JSON object")
+        return value
+
+    @staticmethod
+    def _date(value):
+        return pd.Timestamp(value).normalize() if value else pd.NaT
+
+    def feasibility(self, payload):
+        model = self.model
+        requests = self._requests(payload)
+        fg_codes = [str(request['fg']).strip() for request in requests]
+        kgs = [float(request['kg']) for request in requests]
+        dates = [self._date(request.get('date')) for request in requests]
+        results = model.feasibility(fg_codes, kgs, pd.DatetimeIndex(dates).to_numpy())
+        return {'model_version': model.version, 'results': results}
+
+    def plan(self, payload):
+        model = self.model
+        results = []
+        for request in self._requests(payload):
+            fg_order = [str(fg).strip() for fg in request['fg_order']]
+            unknown = [fg for fg in fg_order if fg not in model.fg_positions]
+            if unknown:
+                raise APIError(f"Unknown FG code(s): {', '.join(unknown)}")
+            policy = request.get('policy', 'fifo')
+            if policy not in ALLOCATION_POLICIES:
+                raise APIError(f"Unknown policy '{policy}'; expected one of {', '.join(ALLOCATION_POLICIES)}")
+            as_of = self._date(request.get('date'))
+            stock = model.pooled if pd.isna(as_of) else model.stock_by(as_of)
+            capacities = {str(fg).strip(): float(kg) for fg, kg in (self._object(request, 'capacities') or {}).items()}
+
+            rows, shortage_details = compute_production_plan(
+                stock, model.fg_formulas, fg_order, capacities, model.decimal_places,
+                policy=policy, fg_weights=self._object(request, 'weights')
+            )
+            fgs = [{
+                'fg': row['FG'],
+                'batches': int(row['Batches']),
+                'kg': float(row['Batches'] * BATCH_SIZE_KG),
+                'ready': row['Batches'] > 0,
+                'shortages': shortage_details.get(row['FG'], []),
+            } for row in rows]
+            results.append({'fgs': fgs, 'total_kg': float(sum(fg['kg'] for fg in fgs))})
+        return {'model_version': model.version, 'results': results}
+
+    def refresh_stock(self, payload):
+        rows = payload.get('rows')
+        if not isinstance(rows, list) or not rows:
+            raise APIError("Expected a JSON object with a non-empty 'rows' list")
+        stock, missing_cols = normalize_stock_frame(pd.DataFrame(rows))
+        if missing_cols:
+            raise APIError(f"Missing columns: {', '.join(missing_cols)}")
+        mode = payload.get('mode', 'replace')
+        if mode not in ('replace', 'delta'):
+            raise APIError("'mode' must be 'replace' or 'delta'")
+
+        with self._refresh_lock:
+            current = self.model
+            if mode == 'delta':
+                stock, _ = apply_stock_delta(current.rm_stock.copy(), stock)
+            # Build fully before publishing; readers keep whichever model they already hold
+            self.model = current.with_stock(stock)
+        return {'model_version': self.model.version, 'rows': len(stock)}
+
+
+class PlanningRequestHandler(BaseHTTPRequestHandler):
+    service = None
+    quiet = False
+
+    def _reply(self, status, body):
+        data = json.dumps(body, separators=(',', ':'), default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._reply(*self.service.handle('GET', self.path))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            self._reply(400, {'error': f"Invalid JSON: {e}"})
+            return
+        self._reply(*self.service.handle('POST', self.path, payload))
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=8765, quiet=False):
+    """A threading HTTP server answering for ``service`` (call ``serve_forever()`` on it)"""
+    handler = type('Handler', (PlanningRequestHandler,), {'service': service, 'quiet': quiet})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class LocalPlanningClient:
+    """In-process stand-in for ``PlanningClient``: same calls, no sockets"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def _call(self, method, path, payload=None):
+        # Round-trip through JSON so callers see exactly what the server would send
+        status, body = self.service.handle(method, path, json.loads(json.dumps(payload)) if payload else None)
+        body = json.loads(json.dumps(body, default=str))
+        if status >= 400:
+            raise APIError(body['error'], status)
+        return body
+
+    def health(self):
+        return self._call('GET', '/health')
+
+    def feasibility(self, requests):
+        return self._call('POST', '/feasibility', {'requests': requests})['results']
+
+    def plan(self, requests):
+        return self._call('POST', '/plan', {'requests': requests})['results']
+
+    def refresh_stock(self, rows, mode='replace'):
+        return self._call('POST', '/stock', {'rows': rows, 'mode': mode})
+
+
+class PlanningClient(LocalPlanningClient):
+    """Client for a running planning server, e.g. ``PlanningClient('http://127.0.0.1:8765')``"""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise APIError(json.loads(e.read()).get('error', str(e)), e.code) from None
+
+
+def load_model(stock_path, po_path, formula_paths, decimal_places=3):
+    """Read and normalize the master-data workbooks the way the dashboard's uploads do"""
+    def read(path, normalize, label):
+        frame, missing_cols = normalize(pd.read_excel(path))
+        if missing_cols:
+            raise SystemExit(f"{label} {path}: missing columns {', '.join(missing_cols)}")
+        return frame
+
+    rm_stock = read(stock_path, normalize_stock_frame, "Stock")
+    rm_po = (read(po_path, normalize_po_frame, "PO") if po_path
+             else pd.DataFrame(columns=['RM Code', 'Location', 'Quantity', 'Arrival Date']))
+    fg_formulas = pd.DataFrame(columns=['FG Code', 'RM Code', 'Quantity'])
+    for path in formula_paths:
+        fg_formulas = merge_formula_frames(fg_formulas, read(path, normalize_formula_frame, "Formulas"))
+    return PlanningModel(rm_stock, rm_po, fg_formulas, decimal_places)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--stock', required=True, help="RM stock workbook")
+    parser.add_argument('--po', help="RM PO workbook")
+    parser.add_argument('--formulas', nargs='+', required=True, help="FG formula workbook(s)")
+    parser.add_argument('--decimals', type=int, default=3, help="decimal places the plan rounds to")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--quiet', action='store_true', help="don't log every request")
+    args = parser.parse_args(argv)
+
+    service = PlanningService(load_model(args.stock, args.po, args.formulas, args.decimals))
+    server = make_server(service, args.host, args.port, args.quiet)
+    health = service.health({})
+    print(f"Planning API on http://{args.host}:{args.port} "
+          f"({health['fgs']} FGs, {health['rms']} RMs, {health['po_lines']} PO lines)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2376 @@
+"""Planning engine for the MRP dashboard.
+
+Everything in this module is free of Streamlit so it can run on worker
+threads (or processes) and be reused outside the dashboard. Inputs are plain
+DataFrames/dicts snapshotted from the session; outputs keep the same shapes
+the dashboard has always rendered.
+"""
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+BATCH_SIZE_KG = 25
+STOCK_COLUMNS = ['RM Code', 'Quantity']
+DEFAULT_LOCATION = 'Main'
+PO_COLUMNS = ['RM Code', 'Quantity', 'Arrival Date']
+FORMULA_COLUMNS = ['FG Code', 'RM Code', 'Quantity']
+SUPPLIER_TERMS_COLUMNS = ['RM Code', 'MOQ (Kg)', 'Lot Size (Kg)', 'Lead Time (days)']
+DEFAULT_SUPPLIER_TERMS = {'MOQ (Kg)': 0.0, 'Lot Size (Kg)': 0.0, 'Lead Time (days)': 14}
+ISSUE_COLUMNS = ['Severity', 'Table', 'Check', 'FG Code', 'RM Code', 'Detail']
+SEVERITY_ORDER = ['Error', 'Warning', 'Info']
+
+
+class PlanCancelled(Exception):
+    """Raised when a running plan is cancelled by a newer request"""
+
+
+def _skipped_fg(fg, rm_codes, quantities, expected_capacity, decimal_places):
+    """Result row and shortage lines of an FG the validation stage blocked.
+
+    Such an FG has a non-positive requirement, so it can't make a batch
+    whatever the stock; only the offending lines are reported.
+    """
+    shortage_breakdown = [
+        f"{rm}: Invalid requirement ({qty:.{decimal_places}f} Kg per batch)"
+        for rm, qty in zip(rm_codes, quantities) if qty <= 0
+    ]
+    result = {
+        "FG": fg,
+        "Expected": f"{expected_capacity:,.1f} Kg" if expected_capacity > 0 else "Auto",
+        "Max": f"{0:,.1f} Kg",
+        "Actual": f"{0:,.1f} Kg",
+        "Status": "❌ Shortage",
+        "Missing": "Invalid formula",
+        "Batches": 0
+    }
+    return result, shortage_breakdown
+
+
+def compute_production_plan(rm_stock, fg_formulas, fg_order, fg_expected_capacity, decimal_places,
+                            progress=None, cancel_event=None, fixed_point=False, skip_fgs=(),
+                            policy='fifo', fg_weights=None, ledger=None):
+    """Run the FIFO production plan.
+
+    FGs are processed in ``fg_order``; each one is sized against the stock left
+    over by the FGs before it. Returns ``(results, shortage_details)``.
+
+    ``progress(done, total)`` is called after every FG and ``cancel_event`` (a
+    ``threading.Event``) is checked before every FG; when it is set the plan
+    stops with ``PlanCancelled``.
+
+    With ``fixed_point`` the plan runs on integer quantities instead (see
+    :func:`compute_fixed_point_plan`). FGs in ``skip_fgs`` (blocked by the
+    validation stage) get a zero-batch result without any stock work.
+    Any ``policy`` other than ``'fifo'`` shares scarce RMs between FGs instead
+    (see :func:`compute_policy_plan`); ``fg_weights`` feeds the priority policy.
+    An :class:`AllocationLedger` passed as ``ledger`` records every allocation.
+    """
+    if policy != 'fifo':
+        return compute_policy_plan(rm_stock, fg_formulas, fg_order, fg_expected_capacity, decimal_places, policy,
+                                   fg_weights=fg_weights, progress=progress, cancel_event=cancel_event,
+                                   skip_fgs=skip_fgs, ledger=ledger)
+    if fixed_point:
+        return compute_fixed_point_plan(rm_stock, fg_formulas, fg_order, fg_expected_capacity, decimal_places,
+                                        progress=progress, cancel_event=cancel_event, skip_fgs=skip_fgs,
+                                        ledger=ledger)
+
+    stock_dict = rm_stock.set_index('RM Code')['Quantity'].to_dict()
+    stock_dict = {k: round(float(v), decimal_places) for k, v in stock_dict.items()}
+
+    # Create a copy for calculation (won't be modified for max capacity calculation)
+    initial_stock = stock_dict.copy()
+    allocated_stock = stock_dict.copy()
+    if ledger is not None:
+        ledger.start(rm_stock)
+
+    # Group formulas once instead of filtering the whole table per FG
+    formulas_by_fg = {fg: formula for fg, formula in fg_formulas.groupby('FG Code', sort=False)}
+
+    fg_order = list(fg_order)
+    total_fgs = len(fg_order)
+    results = []
+    shortage_details = {}
+
+    for done, fg in enumerate(fg_order, 1):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PlanCancelled()
+
+        formula = formulas_by_fg.get(fg)
+
+        if formula is None or formula.empty:
+            if progress is not None:
+                progress(done, total_fgs)
+            continue
+
+        expected_capacity = fg_expected_capacity.get(fg, 0)
+
+        if fg in skip_fgs:
+            result, shortage_details[fg] = _skipped_fg(
+                fg, formula['RM Code'].astype(str).str.strip(),
+                [round(float(q), decimal_places) for q in formula['Quantity']], expected_capacity, decimal_places
+            )
+            results.append(result)
+            if progress is not None:
+                progress(done, total_fgs)
+            continue
+
+        # Calculate MAX capacity first (using initial stock, not allocated stock)
+        max_possible_batches_list = []
+        max_shortage_breakdown = []
+
+        for _, row in formula.iterrows():
+            rm = str(row['RM Code']).strip()
+            req_per_batch = round(float(row['Quantity']), decimal_places)
+            avail = initial_stock.get(rm, 0)  # Use initial stock for max calculation
+
+            if req_per_batch <= 0 or avail <= 0:
+                max_possible_batches_list.append(0)
+                if avail <= 0:
+                    max_shortage_breakdown.append(f"{rm}: Available 0.0000 Kg")
+            else:
+                max_batches_for_rm = int(avail // req_per_batch)
+                max_possible_batches_list.append(max_batches_for_rm)
+
+        max_possible_batches = min(max_possible_batches_list) if max_possible_batches_list else 0
+        max_capacity = max_possible_batches * BATCH_SIZE_KG
+
+        # Now calculate ACTUAL capacity based on expected and allocated stock
+        possible_batches = []
+        missing_rms = []
+        shortage_breakdown = []
+
+        # Calculate based on expected capacity
+        if expected_capacity > 0:
+            # Calculate required batches based on expected capacity
+            expected_batches = max(1, int(expected_capacity // BATCH_SIZE_KG))
+
+            for _, row in formula.iterrows():
+                rm = str(row['RM Code']).strip()
+                req_per_batch = round(float(row['Quantity']), decimal_places)
+                avail = allocated_stock.get(rm, 0)
+
+                # Calculate total required for expected batches
+                total_required = req_per_batch * expected_batches
+
+                if total_required <= 0:
+                    shortage_breakdown.append(f"{rm}: Invalid requirement ({req_per_batch:.{decimal_places}f} Kg per batch)")
+                    possible_batches.append(0)
+                elif avail <= 0:
+                    possible_batches.append(0)
+                    missing_rms.append(rm)
+                    shortage_breakdown.append(f"{rm}: Required {total_required:.{decimal_places}f} Kg, Available 0.0000 Kg")
+                else:
+                    # Check if we have enough for expected batches
+                    if avail >= total_required:
+                        max_batches_for_rm = expected_batches
+                        possible_batches.append(max_batches_for_rm)
+                    else:
+                        # Calculate how many batches we can make
+                        max_batches_for_rm = int(avail // req_per_batch)
+                        possible_batches.append(max_batches_for_rm)
+
+                        if max_batches_for_rm < expected_batches:
+                            missing_rms.append(rm)
+                            shortage = total_required - avail
+                            shortage_breakdown.append(f"{rm}: Required {total_required:.{decimal_places}f} Kg for {expected_batches} batches, Available {avail:.{decimal_places}f} Kg, Shortage {shortage:.{decimal_places}f} Kg")
+        else:
+            # If no expected capacity, calculate maximum possible
+            for _, row in formula.iterrows():
+                rm = str(row['RM Code']).strip()
+                req_per_batch = round(float(row['Quantity']), decimal_places)
+                avail = allocated_stock.get(rm, 0)
+
+                if req_per_batch <= 0:
+                    possible_batches.append(0)
+                    shortage_breakdown.append(f"{rm}: Invalid requirement ({req_per_batch:.{decimal_places}f} Kg)")
+                elif avail <= 0:
+                    possible_batches.append(0)
+                    missing_rms.append(rm)
+                    shortage_breakdown.append(f"{rm}: Required {req_per_batch:.{decimal_places}f} Kg per batch, Available 0.0000 Kg")
+                else:
+                    max_batches_for_rm = int(avail // req_per_batch)
+                    possible_batches.append(max_batches_for_rm)
+
+                    if max_batches_for_rm == 0:
+                        missing_rms.append(rm)
+                        shortage = req_per_batch - avail
+                        shortage_breakdown.append(f"{rm}: Required {req_per_batch:.{decimal_places}f} Kg per batch, Available {avail:.{decimal_places}f} Kg, Shortage {shortage:.{decimal_places}f} Kg")
+
+        if expected_capacity > 0:
+            # For expected capacity mode, use minimum of possible batches
+            max_possible_for_actual = min(possible_batches) if possible_batches else 0
+            actual_batches = min(expected_batches, max_possible_for_actual)
+            actual_capacity = actual_batches * BATCH_SIZE_KG
+        else:
+            # For auto mode
+            max_possible_for_actual = min(possible_batches) if possible_batches else 0
+            actual_batches = max_possible_for_actual
+            actual_capacity = max_possible_for_actual * BATCH_SIZE_KG
+
+        if actual_capacity >= BATCH_SIZE_KG:
+            status = "✅ Ready"
+        else:
+            status = "❌ Shortage"
+
+        shortage_details[fg] = shortage_breakdown
+
+        if missing_rms:
+            missing_display = f"{len(missing_rms)} RM(s)"
+        else:
+            missing_display = "None"
+
+        # Allocate stock for production
+        if actual_batches > 0 and status == "✅ Ready":
+            drawn_rms, drawn_kg, stock_before = [], [], []
+            for _, row in formula.iterrows():
+                rm = str(row['RM Code']).strip()
+                req_total = round(row['Quantity'] * actual_batches, decimal_places)
+                if rm in allocated_stock:
+                    drawn_rms.append(rm)
+                    drawn_kg.append(req_total)
+                    stock_before.append(allocated_stock[rm])
+                    allocated_stock[rm] = round(allocated_stock[rm] - req_total, decimal_places)
+            if ledger is not None:
+                ledger.record(done, fg, drawn_rms, actual_batches, drawn_kg, stock_before)
+
+        results.append({
+            "FG": fg,
+            "Expected": f"{expected_capacity:,.1f} Kg" if expected_capacity > 0 else "Auto",
+            "Max": f"{max_capacity:,.1f} Kg",  # This is the TRUE max based on initial stock
+            "Actual": f"{actual_capacity:,.1f} Kg",
+            "Status": status,
+            "Missing": missing_display,
+            "Batches": actual_batches
+        })
+
+        if progress is not None:
+            progress(done, total_fgs)
+
+    return results, shortage_details
+
+
+# --- Allocation ledger ---
+# The planners used to subtract each FG's allocation from a working copy of
+# the stock and throw the copy away. A ledger passed to the plan collects,
+# while the plan allocates, one block of arrays per FG that gets batches:
+# the RMs it drew, the Kg consumed and the stock before and after.
+
+LEDGER_COLUMNS = ['Order', 'FG Code', 'RM Code', 'Batches', 'Consumed (Kg)', 'Stock Before (Kg)', 'Stock After (Kg)']
+RESIDUAL_COLUMNS = ['RM Code', 'Stock (Kg)', 'Consumed (Kg)', 'Residual (Kg)']
+
+
+class AllocationLedger:
+    """Columnar record of the stock each FG consumed during a plan.
+
+    A planner calls :meth:`start` with the pooled stock it plans on and
+    :meth:`record` once per allocating FG (or once for a whole shared
+    allocation) with arrays of lines. :meth:`frame` is the ledger and
+    :meth:`residual` the stock left per RM, RMs no FG uses included.
+    """
+
+    def __init__(self, decimal_places=3):
+        self.decimal_places = decimal_places
+        self.rm_codes = np.array([], dtype=object)
+        self.stock = np.zeros(0)
+        self._blocks = []
+
+    def start(self, rm_stock):
+        """Reset the ledger for a plan on the pooled ``rm_stock`` (one row per RM)"""
+        stock = rm_stock.drop_duplicates('RM Code', keep='last')
+        self.rm_codes = stock['RM Code'].to_numpy(dtype=object)
+        self.stock = np.round(stock['Quantity'].to_numpy(dtype=float), self.decimal_places)
+        self._blocks = []
+
+    def record(self, order, fg, rm_codes, batches, consumed, before):
+        """Lines drawn by one allocation; scalars are repeated over the lines"""
+        rm_codes = np.asarray(rm_codes, dtype=object)
+        n = len(rm_codes)
+        if n:
+            self._blocks.append((np.broadcast_to(order, n), np.broadcast_to(np.asarray(fg, dtype=object), n), rm_codes,
+                                 np.broadcast_to(batches, n), np.asarray(consumed, dtype=float),
+                                 np.asarray(before, dtype=float)))
+
+    def __len__(self):
+        return sum(len(block[2]) for block in self._blocks)
+
+    def frame(self):
+        """The ledger, one row per (FG, formula line) in allocation order"""
+        if not self._blocks:
+            return pd.DataFrame({
+                'Order': np.zeros(0, dtype=np.int64), 'FG Code': np.array([], dtype=object),
+                'RM Code': np.array([], dtype=object), 'Batches': np.zeros(0, dtype=np.int64),
+                'Consumed (Kg)': np.zeros(0), 'Stock Before (Kg)': np.zeros(0), 'Stock After (Kg)': np.zeros(0),
+            }, columns=LEDGER_COLUMNS)
+        order, fgs, rms, batches, consumed, before = (np.concatenate(column) for column in zip(*self._blocks))
+        return pd.DataFrame({
+            'Order': order.astype(np.int64),
+            'FG Code': fgs,
+            'RM Code': rms,
+            'Batches': batches.astype(np.int64),
+            'Consumed (Kg)': np.round(consumed, self.decimal_places),
+            'Stock Before (Kg)': np.round(before, self.decimal_places),
+            'Stock After (Kg)': np.round(before - consumed, self.decimal_places),
+        }, columns=LEDGER_COLUMNS)
+
+    def consumed(self):
+        """Kg consumed per RM, aligned with ``rm_codes``"""
+        if not self._blocks:
+            return np.zeros(len(self.rm_codes))
+        rms = np.concatenate([block[2] for block in self._blocks])
+        consumed = np.concatenate([block[4] for block in self._blocks])
+        idx = pd.Index(self.rm_codes).get_indexer(rms)
+        return np.bincount(idx[idx >= 0], weights=consumed[idx >= 0], minlength=len(self.rm_codes))
+
+    def residual(self):
+        """Stock, consumed and residual Kg per RM after the plan"""
+        consumed = self.consumed()
+        return pd.DataFrame({
+            'RM Code': self.rm_codes,
+            'Stock (Kg)': np.round(self.stock, self.decimal_places),
+            'Consumed (Kg)': np.round(consumed, self.decimal_places),
+            'Residual (Kg)': np.round(self.stock - consumed, self.decimal_places),
+        }, columns=RESIDUAL_COLUMNS)
+
+
+def frame_fingerprint(df):
+    """Cheap, order-sensitive content fingerprint of a DataFrame"""
+    if df is None or df.empty:
+        return (0, ())
+    return (len(df), tuple(df.columns), int(pd.util.hash_pandas_object(df, index=False).sum()))
+
+
+def estimate_nbytes(obj, seen=None):
+    """Approximate bytes held by ``obj`` and everything it references.
+
+    DataFrames and arrays report their buffers (object columns deeply),
+    containers and plain objects are walked. Objects already in ``seen`` are
+    not counted again, so passing one set across calls attributes shared
+    data (e.g. a table referenced by several artefacts) only once.
+    """
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if item is None or id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, pd.DataFrame):
+            total += int(item.memory_usage(index=True, deep=True).sum())
+        elif isinstance(item, pd.Series):
+            total += int(item.memory_usage(index=True, deep=True))
+        elif isinstance(item, np.ndarray):
+            total += item.nbytes
+        elif isinstance(item, io.BytesIO):
+            total += item.getbuffer().nbytes
+        elif isinstance(item, (str, bytes, bytearray, int, float, bool)):
+            total += sys.getsizeof(item)
+        elif isinstance(item, dict):
+            total += sys.getsizeof(item)
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            total += sys.getsizeof(item)
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, type):
+            total += sys.getsizeof(item)
+            stack.append(vars(item))
+        else:
+            total += sys.getsizeof(item)
+    return total
+
+
+# --- Ingestion ---
+
+def _find_column(columns, predicate):
+    for col in columns:
+        if predicate(str(col).lower()):
+            return col
+    return None
+
+
+def _is_rm_code(col_lower):
+    return 'rm' in col_lower and ('code' in col_lower or 'id' in col_lower)
+
+
+def _is_quantity(col_lower):
+    return 'quantity' in col_lower or 'qty' in col_lower or 'amount' in col_lower
+
+
+def _is_arrival_date(col_lower):
+    return 'arrival' in col_lower or 'date' in col_lower or 'delivery' in col_lower
+
+
+def _is_location(col_lower):
+    return 'location' in col_lower or 'warehouse' in col_lower or 'site' in col_lower
+
+
+def _is_lot(col_lower):
+    return 'lot' in col_lower
+
+
+def _is_expiry(col_lower):
+    return 'expir' in col_lower or 'best before' in col_lower or 'use by' in col_lower
+
+
+def _is_fg_code(col_lower):
+    return 'fg' in col_lower and ('code' in col_lower or 'id' in col_lower)
+
+
+def _is_formula_quantity(col_lower):
+    return 'quantity' in col_lower or 'qty' in col_lower
+
+
+def issue_frame(severity, table, check, detail, fg_codes=None, rm_codes=None):
+    """Rows of the data-quality report for one check; ``detail`` and the codes may be arrays"""
+    detail = pd.Series(detail, dtype=object) if not isinstance(detail, str) else detail
+    if not isinstance(detail, str):
+        size = len(detail)
+    else:
+        codes = fg_codes if fg_codes is not None else rm_codes
+        size = 1 if codes is None else len(codes)
+    frame = pd.DataFrame({
+        'Severity': [severity] * size,
+        'Table': [table] * size,
+        'Check': [check] * size,
+        'FG Code': np.asarray(fg_codes, dtype=object) if fg_codes is not None else [''] * size,
+        'RM Code': np.asarray(rm_codes, dtype=object) if rm_codes is not None else [''] * size,
+    })
+    frame['Detail'] = detail if isinstance(detail, str) else detail.to_numpy()
+    return frame
+
+
+def _reject_rows(processed_df, raw_quantity, table, issues, code_columns=('RM Code',)):
+    """Record blank codes and unparseable quantities of an upload, then drop the blank-code rows"""
+    excel_rows = 'Excel row ' + pd.Series(processed_df.index + 2, index=processed_df.index).astype(str)
+
+    blank = pd.Series(False, index=processed_df.index)
+    for col in code_columns:
+        blank_col = processed_df[col].isin(['', 'nan'])
+        if issues is not None and blank_col.any():
+            issues.append(issue_frame('Warning', table, f'Missing {col}', excel_rows[blank_col] + ' dropped'))
+        blank |= blank_col
+
+    bad_qty = raw_quantity.notna() & processed_df['Quantity'].isna() & ~blank
+    if issues is not None and bad_qty.any():
+        rm_codes = processed_df.loc[bad_qty, 'RM Code']
+        fg_codes = processed_df.loc[bad_qty, 'FG Code'] if 'FG Code' in processed_df else None
+        detail = excel_rows[bad_qty] + ': "' + raw_quantity[bad_qty].astype(str) + '" read as 0'
+        issues.append(issue_frame('Warning', table, 'Unparseable quantity', detail, fg_codes, rm_codes))
+
+    processed_df['Quantity'] = processed_df['Quantity'].fillna(0)
+    return processed_df[~blank]
+
+
+def _read_location(df):
+    """Optional location column of an upload; rows without one are held at ``DEFAULT_LOCATION``"""
+    column = _find_column(df.columns, _is_location)
+    if column is None:
+        return DEFAULT_LOCATION
+    location = df[column].astype(str).str.strip()
+    return location.where(~location.isin(['', 'nan']), DEFAULT_LOCATION)
+
+
+def _read_lots(df, processed_df, issues):
+    """Optional lot and expiry columns of a stock upload, added to ``processed_df`` when present"""
+    lot_column = _find_column(df.columns, _is_lot)
+    expiry_column = _find_column(df.columns, _is_expiry)
+    if lot_column is None and expiry_column is None:
+        return
+    if lot_column is not None:
+        lot = df[lot_column].astype(str).str.strip()
+        processed_df['Lot'] = lot.where(~lot.isin(['', 'nan']), '')
+    else:
+        processed_df['Lot'] = ''
+    if expiry_column is not None:
+        expiry = pd.to_datetime(df[expiry_column], dayfirst=True, errors='coerce')
+        bad_expiry = expiry.isna() & df[expiry_column].notna()
+        if issues is not None and bad_expiry.any():
+            detail = ('Excel row ' + pd.Series(df.index[bad_expiry] + 2).astype(str) + ': "'
+                      + df.loc[bad_expiry, expiry_column].astype(str).to_numpy() + '" read as no expiry')
+            issues.append(issue_frame('Warning', 'RM Stock', 'Unparseable expiry date', detail,
+                                      rm_codes=processed_df.loc[bad_expiry, 'RM Code']))
+        processed_df['Expiry Date'] = expiry
+    else:
+        processed_df['Expiry Date'] = pd.NaT
+
+
+def stock_key_columns(df):
+    """Columns identifying one stock row: RM and location, plus the lot for lot-level stock"""
+    return ['RM Code', 'Location', 'Lot'] if 'Lot' in df.columns else ['RM Code', 'Location']
+
+
+def with_location(df):
+    """``df`` with a Location column (tables loaded before locations existed hold everything at the default)"""
+    if 'Location' in df.columns:
+        return df
+    df = df.copy()
+    df.insert(1, 'Location', DEFAULT_LOCATION)
+    return df
+
+
+def normalize_stock_frame(df, issues=None):
+    """Map an uploaded stock sheet onto the RM Code / Location / Quantity layout.
+
+    Returns ``(processed_df, missing_columns)``; ``processed_df`` is None when a
+    required column could not be detected. The location (warehouse, site),
+    lot and expiry date columns are optional; with a lot or expiry column the
+    stock is kept per lot (Lot / Expiry Date columns). Rows dropped or
+    repaired on the way are appended to ``issues`` (a list) as data-quality
+    report rows.
+    """
+    df.columns = df.columns.str.strip()
+    column_mapping = {
+        'RM Code': _find_column(df.columns, _is_rm_code),
+        'Quantity': _find_column(df.columns, _is_quantity),
+    }
+    missing_cols = [col for col in STOCK_COLUMNS if column_mapping[col] is None]
+    if missing_cols:
+        return None, missing_cols
+
+    processed_df = pd.DataFrame()
+    processed_df['RM Code'] = df[column_mapping['RM Code']].astype(str).str.strip()
+    processed_df['Location'] = _read_location(df)
+    _read_lots(df, processed_df, issues)
+    processed_df['Quantity'] = pd.to_numeric(df[column_mapping['Quantity']], errors='coerce')
+
+    processed_df = _reject_rows(processed_df, df[column_mapping['Quantity']], 'RM Stock', issues)
+    return processed_df, []
+
+
+def normalize_po_frame(df, issues=None):
+    """Map an uploaded PO sheet onto the RM Code / Location / Quantity / Arrival Date layout.
+
+    Returns ``(processed_df, missing_columns)`` like ``normalize_stock_frame``;
+    the location is where the PO is received. Rows whose arrival date can't be
+    parsed are dropped and reported.
+    """
+    df.columns = df.columns.str.strip()
+    column_mapping = {
+        'RM Code': _find_column(df.columns, _is_rm_code),
+        'Quantity': _find_column(df.columns, _is_quantity),
+        'Arrival Date': _find_column(df.columns, _is_arrival_date),
+    }
+    missing_cols = [col for col in PO_COLUMNS if column_mapping[col] is None]
+    if missing_cols:
+        return None, missing_cols
+
+    processed_df = pd.DataFrame()
+    processed_df['RM Code'] = df[column_mapping['RM Code']].astype(str).str.strip()
+    processed_df['Location'] = _read_location(df)
+    processed_df['Quantity'] = pd.to_numeric(df[column_mapping['Quantity']], errors='coerce')
+
+    date_col = df[column_mapping['Arrival Date']]
+    try:
+        processed_df['Arrival Date'] = pd.to_datetime(date_col, dayfirst=True, errors='coerce')
+    except (TypeError, ValueError):
+        try:
+            processed_df['Arrival Date'] = pd.to_datetime(date_col, errors='coerce')
+        except (TypeError, ValueError):
+            processed_df['Arrival Date'] = pd.NaT
+
+    processed_df = _reject_rows(processed_df, df[column_mapping['Quantity']], 'RM PO', issues)
+
+    bad_date = processed_df['Arrival Date'].isna()
+    if issues is not None and bad_date.any():
+        detail = ('Excel row ' + pd.Series(processed_df.index[bad_date] + 2).astype(str) + ': "'
+                  + date_col[processed_df.index[bad_date]].astype(str).to_numpy() + '" dropped')
+        issues.append(issue_frame('Warning', 'RM PO', 'Unparseable date', detail,
+                                  rm_codes=processed_df.loc[bad_date, 'RM Code']))
+    processed_df = processed_df[~bad_date]
+    return processed_df, []
+
+
+def normalize_formula_frame(df, issues=None):
+    """Map an uploaded formula sheet onto the FG Code / RM Code / Quantity layout.
+
+    Returns ``(processed_df, missing_columns)`` like ``normalize_stock_frame``.
+    """
+    df.columns = df.columns.str.strip()
+    column_mapping = {
+        'FG Code': _find_column(df.columns, _is_fg_code),
+        'RM Code': _find_column(df.columns, _is_rm_code),
+        'Quantity': _find_column(df.columns, _is_formula_quantity),
+    }
+    missing_cols = [col for col in FORMULA_COLUMNS if column_mapping[col] is None]
+    if missing_cols:
+        return None, missing_cols
+
+    processed_df = pd.DataFrame()
+    processed_df['FG Code'] = df[column_mapping['FG Code']].astype(str).str.strip()
+    processed_df['RM Code'] = df[column_mapping['RM Code']].astype(str).str.strip()
+    processed_df['Quantity'] = pd.to_numeric(df[column_mapping['Quantity']], errors='coerce')
+
+    processed_df = _reject_rows(processed_df, df[column_mapping['Quantity']], 'FG Formulas', issues,
+                                code_columns=('FG Code', 'RM Code'))
+    return processed_df, []
+
+
+def normalize_supplier_terms_frame(df, issues=None):
+    """Map an uploaded supplier-terms sheet onto the RM Code / MOQ / Lot Size / Lead Time layout.
+
+    Only the RM code is required; a missing or blank term is left empty and
+    falls back to the default terms when recommending purchases. Returns
+    ``(processed_df, missing_columns)`` like ``normalize_stock_frame``.
+    """
+    df.columns = df.columns.str.strip()
+    rm_column = _find_column(df.columns, _is_rm_code)
+    if rm_column is None:
+        return None, ['RM Code']
+
+    term_columns = {
+        'MOQ (Kg)': _find_column(df.columns, lambda c: 'moq' in c or 'minimum' in c),
+        'Lot Size (Kg)': _find_column(df.columns, lambda c: 'lot' in c or 'multiple' in c or 'pack' in c),
+        'Lead Time (days)': _find_column(df.columns, lambda c: 'lead' in c),
+    }
+    processed_df = pd.DataFrame()
+    processed_df['RM Code'] = df[rm_column].astype(str).str.strip()
+    for name, column in term_columns.items():
+        processed_df[name] = pd.to_numeric(df[column], errors='coerce') if column is not None else np.nan
+
+    blank = processed_df['RM Code'].isin(['', 'nan'])
+    if issues is not None and blank.any():
+        excel_rows = 'Excel row ' + pd.Series(processed_df.index[blank] + 2).astype(str)
+        issues.append(issue_frame('Warning', 'Supplier Terms', 'Missing RM Code', excel_rows + ' dropped'))
+    processed_df = processed_df[~blank]
+    return processed_df.drop_duplicates(subset='RM Code', keep='last').reset_index(drop=True), []
+
+
+def merge_formula_frames(fg_formulas, new_formulas, issues=None):
+    """Add uploaded formula lines to the formula table, first (FG, RM) line wins.
+
+    Dropped duplicates are reported: same quantity as the kept line is a plain
+    duplicate, a different quantity is a conflict.
+    """
+    combined = pd.concat([fg_formulas, new_formulas]) if not fg_formulas.empty else new_formulas
+    dropped = combined.duplicated(subset=['FG Code', 'RM Code'], keep='first').to_numpy()
+    merged = combined[~dropped].reset_index(drop=True)
+
+    if issues is not None and dropped.any():
+        duplicates = combined[dropped]
+        kept = merged.set_index(['FG Code', 'RM Code'])['Quantity']
+        kept_qty = kept.reindex(pd.MultiIndex.from_frame(duplicates[['FG Code', 'RM Code']])).to_numpy()
+        conflict = ~np.isclose(kept_qty, duplicates['Quantity'].to_numpy())
+        detail = ('Kept ' + pd.Series(kept_qty).map('{:,.4f}'.format) + ' Kg, dropped '
+                  + pd.Series(duplicates['Quantity'].to_numpy()).map('{:,.4f}'.format) + ' Kg')
+        for check, mask in (('Conflicting quantity', conflict), ('Duplicate line', ~conflict)):
+            if mask.any():
+                issues.append(issue_frame('Warning' if check == 'Conflicting quantity' else 'Info', 'FG Formulas', check,
+                                          detail[mask], duplicates['FG Code'][mask], duplicates['RM Code'][mask]))
+    return merged
+
+
+# --- Delta updates ---
+# Intra-day receipt/issue files are small compared to the stock and PO tables,
+# so they are applied to the keyed rows in place instead of rebuilding them.
+
+def apply_stock_delta(rm_stock, delta):
+    """Add signed quantity changes to the stock, keyed by RM Code and Location (and Lot).
+
+    Existing rows are updated in place (on their last row, the one the planner
+    reads); unknown keys are appended, with the expiry date given in the
+    delta. Lots are only matched when both tables are kept per lot. Returns
+    ``(rm_stock, summary)``.
+    """
+    rm_stock, delta = with_location(rm_stock), with_location(delta)
+    key_columns = stock_key_columns(rm_stock) if 'Lot' in delta.columns else ['RM Code', 'Location']
+    changes = delta.groupby(key_columns, sort=False)['Quantity'].sum()
+
+    if not pd.api.types.is_float_dtype(rm_stock['Quantity']):
+        rm_stock['Quantity'] = rm_stock['Quantity'].astype(float)
+
+    keys = pd.MultiIndex.from_frame(rm_stock[key_columns])
+    is_key_row = ~keys.duplicated(keep='last')
+    key_index = keys[is_key_row]
+    key_rows = np.flatnonzero(is_key_row)
+
+    positions = key_index.get_indexer(changes.index)
+    existing = positions >= 0
+
+    if existing.any():
+        rows = key_rows[positions[existing]]
+        qty_col = rm_stock.columns.get_loc('Quantity')
+        rm_stock.iloc[rows, qty_col] = rm_stock['Quantity'].to_numpy()[rows] + changes.to_numpy()[existing]
+
+    new_rms = changes[~existing]
+    if len(new_rms):
+        new_rows = new_rms.reset_index()
+        if 'Expiry Date' in delta.columns:
+            expiry = delta.drop_duplicates(subset=key_columns, keep='last').set_index(key_columns)['Expiry Date']
+            new_rows['Expiry Date'] = expiry.reindex(new_rms.index).to_numpy()
+        rm_stock = pd.concat([rm_stock, new_rows[[col for col in rm_stock.columns if col in new_rows.columns]]],
+                             ignore_index=True)
+
+    summary = {
+        'updated': int(existing.sum()),
+        'added': int(len(new_rms)),
+        'negative': int((rm_stock['Quantity'] < 0).sum()),
+    }
+    return rm_stock, summary
+
+
+def pooled_stock(rm_stock):
+    """Stock per RM summed over its locations and lots (RM Code / Quantity, first-seen order).
+
+    This is the table the planner reads: stock can be moved between
+    locations, so feasibility only depends on the total. Pass the
+    :func:`usable_stock` rows to leave expired lots out. Per-location and
+    per-lot draws come afterwards from :func:`location_draws` /
+    :func:`fefo_draws`.
+    """
+    latest = latest_stock_rows(rm_stock)
+    if latest['Location'].nunique() <= 1 and 'Lot' not in latest.columns:
+        return latest[STOCK_COLUMNS].reset_index(drop=True)
+    return latest.groupby('RM Code', sort=False)['Quantity'].sum().reset_index()
+
+
+def latest_stock_rows(rm_stock):
+    """One row per stock key (RM, location, lot), the last one when a key is repeated"""
+    rm_stock = with_location(rm_stock)
+    return rm_stock.drop_duplicates(subset=stock_key_columns(rm_stock), keep='last')
+
+
+def usable_stock(rm_stock, as_of=None):
+    """Stock rows that can still be used on ``as_of``: lots expired before that day are left out"""
+    latest = latest_stock_rows(rm_stock)
+    if as_of is None or 'Expiry Date' not in latest.columns:
+        return latest
+    expiry = pd.to_datetime(latest['Expiry Date'])
+    return latest[~(expiry < pd.Timestamp(as_of))]
+
+
+def apply_po_delta(rm_po, delta):
+    """Apply PO additions (positive quantity) and cancellations (negative quantity).
+
+    Cancellations are matched on (RM Code, arrival day) and reduce the matching
+    PO lines in file order; lines reduced to zero are removed. Returns
+    ``(rm_po, summary)``; ``summary['unmatched']`` is the cancelled quantity
+    that had no open PO to cancel.
+    """
+    delta = delta.assign(**{'Arrival Day': delta['Arrival Date'].dt.normalize()})
+    additions = delta.loc[delta['Quantity'] > 0, delta.columns.drop('Arrival Day')]
+    cancels = (-delta.loc[delta['Quantity'] < 0]
+               .groupby(['RM Code', 'Arrival Day'], sort=False)['Quantity'].sum())
+
+    cancelled_lines = 0
+    unmatched = float(cancels.sum()) if len(cancels) else 0.0
+
+    if len(cancels) and not rm_po.empty:
+        if not pd.api.types.is_float_dtype(rm_po['Quantity']):
+            rm_po['Quantity'] = rm_po['Quantity'].astype(float)
+
+        keys = pd.MultiIndex.from_arrays([rm_po['RM Code'].to_numpy(), rm_po['Arrival Date'].dt.normalize()])
+        to_cancel = cancels.reindex(keys).to_numpy(dtype=float)
+        rows = np.flatnonzero(~np.isnan(to_cancel))
+
+        if len(rows):
+            qty = rm_po['Quantity'].to_numpy(dtype=float)[rows]
+            group = pd.factorize(keys[rows])[0]
+            consumed_before = pd.Series(qty).groupby(group).cumsum().to_numpy() - qty
+            take = np.clip(to_cancel[rows] - consumed_before, 0, qty)
+
+            qty_col = rm_po.columns.get_loc('Quantity')
+            rm_po.iloc[rows, qty_col] = qty - take
+            unmatched -= float(take.sum())
+
+            emptied = rows[(take > 0) & (qty - take <= 0)]
+            cancelled_lines = int(len(emptied))
+            if cancelled_lines:
+                rm_po = rm_po.drop(index=rm_po.index[emptied])
+
+    if len(additions):
+        rm_po = pd.concat([rm_po, additions], ignore_index=True)
+
+    summary = {
+        'added': int(len(additions)),
+        'cancelled_lines': cancelled_lines,
+        'unmatched': unmatched,
+    }
+    return rm_po, summary
+
+
+# --- Master-data versions ---
+# Master data is kept as a timeline of immutable versions instead of tables
+# that are overwritten in place. A version references its parent's tables
+# except the ones a change replaced, and formulas are held per FG, so deleting
+# a few FGs shares every other FG's lines with the previous version. Each
+# table carries the ID of the version that last changed it; caches key on
+# those IDs, so undoing or restoring brings the old cache keys back too.
+
+VERSIONED_TABLES = ('rm_stock', 'rm_po', 'fg_formulas', 'supplier_terms')
+
+
+class FormulaBook:
+    """Immutable FG formulas: FG Code -> (RM codes, quantities) arrays, in upload order.
+
+    Changes return a new book sharing the lines of every FG they don't touch.
+    :meth:`frame` builds the flat FG Code / RM Code / Quantity table once per
+    book; :meth:`release` drops it again.
+    """
+
+    def __init__(self, lines=None):
+        self.lines = lines if lines is not None else {}
+        self._frame = None
+
+    @classmethod
+    def from_frame(cls, fg_formulas):
+        if fg_formulas.empty:
+            return cls()
+        codes, first, inverse = np.unique(fg_formulas['FG Code'].to_numpy(dtype=object),
+                                          return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(codes) + 1))
+        rm_codes = fg_formulas['RM Code'].to_numpy(dtype=object)
+        quantities = fg_formulas['Quantity'].to_numpy(dtype=float)
+        lines = {}
+        for i in np.argsort(first):
+            rows = order[bounds[i]:bounds[i + 1]]
+            lines[codes[i]] = (rm_codes[rows], quantities[rows])
+        return cls(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def frame(self):
+        if self._frame is None:
+            rm_codes = [rms for rms, _ in self.lines.values()]
+            self._frame = pd.DataFrame({
+                'FG Code': np.repeat(np.array(list(self.lines), dtype=object), [len(rms) for rms in rm_codes]),
+                'RM Code': np.concatenate(rm_codes) if rm_codes else np.array([], dtype=object),
+                'Quantity': np.concatenate([qty for _, qty in self.lines.values()]) if rm_codes else np.zeros(0),
+            }, columns=FORMULA_COLUMNS)
+        return self._frame
+
+    def release(self):
+        self._frame = None
+
+    def without(self, fg_codes):
+        """Book without ``fg_codes``"""
+        drop = set(fg_codes)
+        return FormulaBook({fg: lines for fg, lines in self.lines.items() if fg not in drop})
+
+    def merged(self, new_formulas, issues=None):
+        """Book with uploaded lines added (see :func:`merge_formula_frames`); ``self`` when nothing was added"""
+        touched = FormulaBook({fg: self.lines[fg] for fg in pd.unique(new_formulas['FG Code']) if fg in self.lines})
+        merged = FormulaBook.from_frame(merge_formula_frames(touched.frame(), new_formulas, issues))
+        # First (FG, RM) line wins, so an FG changed only if it gained lines
+        changed = {fg: lines for fg, lines in merged.lines.items()
+                   if fg not in self.lines or len(lines[0]) != len(self.lines[fg][0])}
+        return FormulaBook({**self.lines, **changed}) if changed else self
+
+
+class MasterDataVersion:
+    """One immutable state of the master data"""
+
+    def __init__(self, version_id, label, tables, table_ids, changed):
+        self.id = version_id
+        self.label = label
+        self.tables = tables
+        self.table_ids = table_ids
+        self.changed = changed
+        self.created = pd.Timestamp.now()
+
+    def table(self, name):
+        table = self.tables[name]
+        return table.frame() if isinstance(table, FormulaBook) else table
+
+
+class MasterDataHistory:
+    """Undo/redo timeline of master-data versions.
+
+    :meth:`commit` appends a version that replaces some tables and shares the
+    rest; committing after an undo drops the undone versions. :meth:`restore`
+    commits an older version's tables again, so a restore can be undone too.
+    The oldest versions are dropped beyond ``limit``. Tables are never
+    modified once committed: pass changed tables as new objects.
+    """
+
+    def __init__(self, tables, limit=30):
+        self.limit = limit
+        tables = self._wrap(tables)
+        self.timeline = [MasterDataVersion(0, "Initial data", tables, {name: 0 for name in tables}, ())]
+        self.position = 0
+        self._next_id = 1
+
+    @staticmethod
+    def _wrap(tables):
+        return {name: FormulaBook.from_frame(table) if name == 'fg_formulas' and isinstance(table, pd.DataFrame)
+                else table for name, table in tables.items()}
+
+    @property
+    def head(self):
+        return self.timeline[self.position]
+
+    def table(self, name):
+        return self.head.table(name)
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.timeline) - 1
+
+    def _checkout(self, position):
+        previous = self.head.tables.get('fg_formulas')
+        self.position = position
+        # Only the current formulas are kept flattened
+        if isinstance(previous, FormulaBook) and previous is not self.head.tables.get('fg_formulas'):
+            previous.release()
+        return self.head
+
+    def _append(self, label, tables, table_ids, changed):
+        version = MasterDataVersion(self._next_id, label, tables, table_ids, changed)
+        self._next_id += 1
+        del self.timeline[self.position + 1:]
+        self.timeline.append(version)
+        dropped = max(0, len(self.timeline) - self.limit)
+        del self.timeline[:dropped]
+        self.position -= dropped
+        return self._checkout(len(self.timeline) - 1)
+
+    def commit(self, label, **tables):
+        """New version with ``tables`` replaced; the head itself when none of them changed"""
+        head = self.head
+        changed = {name: table for name, table in self._wrap(tables).items() if table is not head.tables[name]}
+        if not changed:
+            return head
+        return self._append(label, {**head.tables, **changed},
+                            {**head.table_ids, **{name: self._next_id for name in changed}}, tuple(changed))
+
+    def undo(self):
+        return self._checkout(self.position - 1) if self.can_undo() else None
+
+    def redo(self):
+        return self._checkout(self.position + 1) if self.can_redo() else None
+
+    def restore(self, version_id):
+        """Commit the tables of an earlier version again (their IDs too, so caches still match)"""
+        version = next(v for v in self.timeline if v.id == version_id)
+        head = self.head
+        changed = tuple(name for name in head.tables if version.tables[name] is not head.tables[name])
+        if not changed:
+            return head
+        return self._append(f"Restore v{version.id}: {version.label}", dict(version.tables),
+                            dict(version.table_ids), changed)
+
+    def summary(self):
+        """One row per kept version, newest first"""
+        return pd.DataFrame({
+            'Version': [v.id for v in self.timeline],
+            'Change': [v.label for v in self.timeline],
+            'Tables': [", ".join(v.changed) for v in self.timeline],
+            'Created': [v.created.strftime('%Y-%m-%d %H:%M:%S') for v in self.timeline],
+            'Current': [i == self.position for i in range(len(self.timeline))],
+        }).iloc[::-1].reset_index(drop=True)
+
+
+# --- Where-used index ---
+
+class WhereUsedIndex:
+    """RM -> FG inverted index over the formula table.
+
+    Formula lines are sorted once by (RM Code, FG Code); every RM maps to a
+    contiguous slice, so "which FGs use RM X" is a dict lookup and a single
+    (FG, RM) requirement is a binary search inside that slice. Duplicate
+    (FG, RM) lines keep the first quantity, like the rest of the dashboard.
+    """
+
+    def __init__(self, fg_formulas):
+        lines = fg_formulas.drop_duplicates(subset=['FG Code', 'RM Code'], keep='first')
+        lines = lines.sort_values(['RM Code', 'FG Code'], kind='stable')
+
+        self.rm_codes = lines['RM Code'].to_numpy(dtype=object)
+        self.fg_codes = lines['FG Code'].to_numpy(dtype=object)
+        self.quantities = lines['Quantity'].to_numpy(dtype=float)
+
+        rms, starts = np.unique(self.rm_codes, return_index=True)
+        ends = np.append(starts[1:], len(self.rm_codes))
+        self._slices = {rm: slice(start, end) for rm, start, end in zip(rms, starts, ends)}
+
+    def __len__(self):
+        return len(self._slices)
+
+    def __contains__(self, rm_code):
+        return rm_code in self._slices
+
+    def rms(self):
+        return list(self._slices)
+
+    def where_used(self, rm_code):
+        """FG codes using ``rm_code`` and their per-batch quantities"""
+        window = self._slices.get(rm_code)
+        if window is None:
+            return np.empty(0, dtype=object), np.empty(0, dtype=float)
+        return self.fg_codes[window], self.quantities[window]
+
+    def requirement(self, fg_code, rm_code):
+        """Per-batch quantity of ``rm_code`` in ``fg_code``'s formula, or None"""
+        fg_codes, quantities = self.where_used(rm_code)
+        pos = np.searchsorted(fg_codes, fg_code)
+        if pos < len(fg_codes) and fg_codes[pos] == fg_code:
+            return float(quantities[pos])
+        return None
+
+    def frame(self):
+        """The index as a DataFrame of (RM Code, FG Code, Quantity) lines"""
+        return pd.DataFrame({'RM Code': self.rm_codes, 'FG Code': self.fg_codes, 'Quantity': self.quantities})
+
+
+class POIndex:
+    """Per-RM purchase order schedule, sorted by arrival date with cumulative quantities.
+
+    PO lines are sorted once by (RM Code, Arrival Date); every RM maps to a
+    contiguous slice and ``cumulative`` holds the running open quantity over
+    the whole schedule, so "how much of RM X arrives by date D" is one binary
+    search and a subtraction, for any number of (RM, date) pairs at once.
+    Lines with a non-positive quantity stay in the schedule (and get a status)
+    but add nothing to the open quantities.
+    """
+
+    def __init__(self, rm_po):
+        rm_codes = rm_po['RM Code'].to_numpy(dtype=object)
+        days = pd.to_datetime(rm_po['Arrival Date']).to_numpy().astype('datetime64[D]').astype(np.int64)
+        self.rm_codes, rm_idx = np.unique(rm_codes, return_inverse=True)
+        rm_idx = rm_idx.reshape(-1)
+
+        order = np.lexsort((days, rm_idx))
+        self.rows = rm_po.iloc[order].reset_index(drop=True)
+        self.rm_idx = rm_idx[order]
+        self.days = days[order]
+        self.quantities = self.rows['Quantity'].to_numpy(dtype=float)
+        self.cumulative = np.concatenate(([0.0], np.cumsum(np.clip(self.quantities, 0, None))))
+        self.rm_start = np.searchsorted(self.rm_idx, np.arange(len(self.rm_codes) + 1))
+        self._positions = pd.Index(self.rm_codes)
+
+        # One sortable key per line: RM slot times a stride wider than the date range, plus the day
+        self._day0 = int(self.days.min()) if len(self.days) else 0
+        self._stride = (int(self.days.max()) - self._day0 + 2) if len(self.days) else 2
+        self._keys = self.rm_idx * self._stride + (self.days - self._day0)
+        # First open (positive) line at or after each position
+        open_pos = np.where(self.quantities > 0, np.arange(len(self.quantities)), len(self.quantities))
+        self._next_open = np.append(np.minimum.accumulate(open_pos[::-1])[::-1], len(self.quantities))
+
+    def __len__(self):
+        return len(self.quantities)
+
+    @staticmethod
+    def _day(date):
+        return np.asarray(date, dtype='datetime64[D]').astype(np.int64)
+
+    def _lookup(self, rm_codes):
+        rm_pos = self._positions.get_indexer(np.asarray(rm_codes, dtype=object))
+        return rm_pos, rm_pos >= 0
+
+    def _search(self, rm_pos, day, side):
+        # NaT (the smallest int64) would wrap around; it sorts before every arrival instead
+        day = np.where(day == np.iinfo(np.int64).min, self._day0 - 1, day)
+        offset = np.clip(day - self._day0, -1, self._stride - 1)
+        return np.searchsorted(self._keys, rm_pos * self._stride + offset, side=side)
+
+    def _window(self, rm_code):
+        if rm_code is None:
+            return slice(None)
+        pos = self._positions.get_indexer([rm_code])[0]
+        if pos < 0:
+            return slice(0, 0)
+        return slice(self.rm_start[pos], self.rm_start[pos + 1])
+
+    def schedule(self, rm_code=None):
+        """The PO lines in (RM, arrival) order, or only those of ``rm_code``"""
+        return self.rows.iloc[self._window(rm_code)]
+
+    def status(self, as_of, rm_code=None):
+        """'Delayed' / 'Incoming' per line of ``schedule(rm_code)``: delayed lines were due before ``as_of``"""
+        return np.where(self.days[self._window(rm_code)] < self._day(as_of), "Delayed", "Incoming")
+
+    def delayed_count(self, as_of):
+        """Number of lines due before ``as_of``; each RM's delayed lines are a prefix of its slice"""
+        rm_pos = np.arange(len(self.rm_codes))
+        return int((self._search(rm_pos, self._day(as_of), 'left') - self.rm_start[:-1]).sum())
+
+    def arriving_by(self, rm_codes, date):
+        """Open PO quantity of each RM arriving on or before ``date`` (a date or one per RM; NaT = none)"""
+        rm_pos, known = self._lookup(rm_codes)
+        days = np.broadcast_to(self._day(date), rm_pos.shape)[known]
+        arriving = np.zeros(len(rm_pos))
+        end = self._search(rm_pos[known], days, 'right')
+        arriving[known] = self.cumulative[end] - self.cumulative[self.rm_start[rm_pos[known]]]
+        return arriving
+
+    def open_quantity(self, rm_codes):
+        """Open PO quantity of each RM over every arrival date"""
+        rm_pos, known = self._lookup(rm_codes)
+        total = np.zeros(len(rm_pos))
+        slots = rm_pos[known]
+        total[known] = self.cumulative[self.rm_start[slots + 1]] - self.cumulative[self.rm_start[slots]]
+        return total
+
+    def next_arrival_after(self, rm_codes, date):
+        """First arrival date of an open line after ``date`` per RM (NaT when none)"""
+        rm_pos, known = self._lookup(rm_codes)
+        slots = rm_pos[known]
+        days = np.broadcast_to(self._day(date), rm_pos.shape)[known]
+        nxt = self._next_open[self._search(slots, days, 'right')]
+        found = nxt < self.rm_start[slots + 1]
+        arrival = np.full(len(rm_pos), np.datetime64('NaT'), dtype='datetime64[ns]')
+        arrival[np.flatnonzero(known)[found]] = self.days[nxt[found]].astype('datetime64[D]')
+        return arrival
+
+    def available_by(self, rm_stock, rm_codes, date):
+        """Pooled stock in hand plus open POs arriving by ``date``, per RM"""
+        in_hand = rm_stock.groupby('RM Code')['Quantity'].sum().reindex(np.asarray(rm_codes, dtype=object))
+        return in_hand.fillna(0.0).to_numpy(dtype=float) + self.arriving_by(rm_codes, date)
+
+
+# --- Requirement matrix ---
+
+class RequirementMatrix:
+    """Per-batch RM requirements of the planned FGs in compressed-row form.
+
+    Row ``i`` is the formula of ``fg_codes[i]`` (FIFO order) and covers lines
+    ``indptr[i]:indptr[i + 1]``; each line holds an index into ``rm_codes`` and
+    the per-batch quantity rounded like the plan rounds it (``quantities``)
+    next to the raw quantity the plan allocates with (``raw_quantities``).
+    Formula lines are kept as they are, duplicates included, so vectorized
+    analyses see exactly what the FIFO loop sees.
+    """
+
+    def __init__(self, fg_formulas, fg_order, decimal_places):
+        self.fg_codes = np.asarray(list(fg_order), dtype=object)
+        self.decimal_places = decimal_places
+
+        lines = fg_formulas[fg_formulas['FG Code'].isin(set(self.fg_codes))]
+        position = pd.Series(np.arange(len(self.fg_codes)), index=self.fg_codes)
+        fg_pos = position.reindex(lines['FG Code']).to_numpy()
+        order = np.argsort(fg_pos, kind='stable')
+
+        rm_codes = lines['RM Code'].astype(str).str.strip().to_numpy(dtype=object)[order]
+        self.rm_codes, self.rm_idx = np.unique(rm_codes, return_inverse=True)
+        self.raw_quantities = lines['Quantity'].to_numpy(dtype=float)[order]
+        self.quantities = np.array([round(q, decimal_places) for q in self.raw_quantities.tolist()])
+        self.line_fg = fg_pos[order]
+        self.indptr = np.searchsorted(self.line_fg, np.arange(len(self.fg_codes) + 1))
+
+    def __len__(self):
+        return len(self.fg_codes)
+
+    @property
+    def n_lines(self):
+        return len(self.rm_idx)
+
+    def stock_vector(self, rm_stock):
+        """Rounded stock per matrix RM (0 when missing) and a mask of RMs present in stock"""
+        stock = rm_stock.set_index('RM Code')['Quantity'].astype(float)
+        stock = stock[~stock.index.duplicated(keep='last')]
+        present = pd.Index(stock.index).get_indexer(self.rm_codes)
+        in_stock = present >= 0
+        values = np.zeros(len(self.rm_codes))
+        values[in_stock] = [round(q, self.decimal_places) for q in stock.to_numpy()[present[in_stock]].tolist()]
+        return values, in_stock
+
+    def available_before(self, rm_stock, batches):
+        """Stock each formula line sees at its FG's turn in the FIFO plan.
+
+        ``batches`` holds the planned batches per FG (matrix order). Allocations
+        of the FGs earlier in the order are summed per RM with one grouped
+        cumulative sum instead of replaying the plan.
+        """
+        stock, in_stock = self.stock_vector(rm_stock)
+        batches = np.asarray(batches, dtype=float)
+        allocated = np.round(self.raw_quantities * batches[self.line_fg], self.decimal_places)
+        allocated[~in_stock[self.rm_idx]] = 0.0
+
+        pairs = pd.DataFrame({'rm': self.rm_idx, 'fg': self.line_fg, 'kg': allocated})
+        per_pair = pairs.groupby(['rm', 'fg'])['kg'].sum()
+        before = per_pair.groupby(level='rm').cumsum() - per_pair
+        before = before.reindex(pd.MultiIndex.from_arrays([self.rm_idx, self.line_fg])).to_numpy()
+        return np.round(stock[self.rm_idx] - before, self.decimal_places)
+
+
+def planned_batches(matrix, results):
+    """Planned batches per matrix FG taken from the plan results (0 when not planned)"""
+    batches = {r['FG']: r['Batches'] for r in results}
+    return np.array([batches.get(fg, 0) for fg in matrix.fg_codes], dtype=float)
+
+
+def bottleneck_analysis(matrix, rm_stock, results, fg_expected_capacity, extra_batches=5, available=None):
+    """Binding RM per FG and the RM needed for +1 / +``extra_batches`` batches.
+
+    Every FG is looked at in its FIFO slot, with the stock left by the FGs
+    before it. The binding RM is the formula line with the fewest whole batches
+    in stock (``avail // req``); the extra kg for ``n`` more batches is
+    ``req * (batches + n) - avail`` wherever that is positive. FGs held back by
+    their expected capacity or by a non-positive requirement are flagged in
+    ``Limited By`` rather than blamed on an RM. RMs are ranked by
+    the output they unlock on their own: an FG whose next batch is blocked by a
+    single RM gains 25 Kg when that RM is topped up.
+
+    ``available`` (Kg per formula line) replaces the FIFO stock-at-turn for
+    plans made under a sharing policy (see :meth:`OrderProblem.reachable`).
+
+    Returns ``{'fgs': ..., 'lines': ..., 'rms': ...}`` DataFrames.
+    """
+    decimal_places = matrix.decimal_places
+    batches = planned_batches(matrix, results)
+    avail = matrix.available_before(rm_stock, batches) if available is None else available
+    req = matrix.quantities
+
+    line_batches = batches[matrix.line_fg]
+    capacity = np.zeros(matrix.n_lines)
+    usable = (req > 0) & (avail > 0)
+    capacity[usable] = np.floor_divide(avail[usable], req[usable])
+    need_next = np.round(np.clip(req * (line_batches + 1) - avail, 0, None), decimal_places)
+    need_extra = np.round(np.clip(req * (line_batches + extra_batches) - avail, 0, None), decimal_places)
+
+    lines = pd.DataFrame({
+        'FG Code': matrix.fg_codes[matrix.line_fg],
+        'FIFO Position': matrix.line_fg + 1,
+        'RM Code': matrix.rm_codes[matrix.rm_idx],
+        'Required per Batch (Kg)': req,
+        'Available at Turn (Kg)': avail,
+        'Batches Covered': capacity.astype(int),
+        'Kg for +1 Batch': need_next,
+        f'Kg for +{extra_batches} Batches': need_extra,
+    })
+
+    # Per FG: binding line (first minimum in formula order) and totals
+    by_fg = lines.groupby('FIFO Position', sort=True)
+    binding = lines.loc[by_fg['Batches Covered'].idxmin()].set_index('FIFO Position')
+    short_next = lines['Kg for +1 Batch'] > 0
+    rms_short = short_next.groupby(lines['FIFO Position']).sum()
+
+    fg_positions = binding.index.to_numpy()
+    fg_batches = batches[fg_positions - 1].astype(int)
+    expected = np.array([fg_expected_capacity.get(fg, 0) for fg in binding['FG Code']], dtype=float)
+    target_batches = np.where(expected > 0, np.maximum(1, expected // BATCH_SIZE_KG), np.nan)
+    at_target = fg_batches >= target_batches
+
+    fgs = pd.DataFrame({
+        'FG Code': binding['FG Code'].to_numpy(),
+        'FIFO Position': fg_positions,
+        'Batches': fg_batches,
+        'Limited By': np.select(
+            [at_target, binding['Required per Batch (Kg)'].to_numpy() <= 0], ['Target', 'Invalid requirement'], 'RM'
+        ),
+        'Binding RM': binding['RM Code'].to_numpy(),
+        'Binding RM Available (Kg)': binding['Available at Turn (Kg)'].to_numpy(),
+        'RMs Short for +1': rms_short.reindex(fg_positions).to_numpy(),
+        'Kg for +1 Batch': by_fg['Kg for +1 Batch'].sum().round(decimal_places).to_numpy(),
+        f'Kg for +{extra_batches} Batches': by_fg[f'Kg for +{extra_batches} Batches'].sum().round(decimal_places).to_numpy(),
+    })
+
+    # Per RM: how often it binds and what it unlocks when it is the only blocker
+    sole = short_next & (lines['FIFO Position'].map(rms_short) == 1)
+    bound_by = fgs.loc[fgs['Limited By'] == 'RM', 'Binding RM'].value_counts()
+    blocking = lines[short_next]
+    rms = pd.DataFrame({
+        'FGs Blocked': blocking.groupby('RM Code')['FG Code'].nunique(),
+        'Sole Blocker For': sole[short_next].groupby(blocking['RM Code']).sum(),
+        'Kg for +1 Batch (All FGs)': blocking.groupby('RM Code')['Kg for +1 Batch'].sum(),
+        'Kg to Unlock': blocking['Kg for +1 Batch'].where(sole[short_next], 0.0).groupby(blocking['RM Code']).sum(),
+    })
+    rms.insert(0, 'Binding For', bound_by.reindex(rms.index, fill_value=0))
+    rms['Output Unlocked (Kg)'] = rms['Sole Blocker For'] * BATCH_SIZE_KG
+    rms['Output per Kg RM'] = (rms['Output Unlocked (Kg)'] / rms['Kg to Unlock'].where(rms['Kg to Unlock'] > 0)).fillna(0.0)
+    rms[['Kg for +1 Batch (All FGs)', 'Kg to Unlock']] = rms[['Kg for +1 Batch (All FGs)', 'Kg to Unlock']].round(decimal_places)
+    rms = rms.rename_axis('RM Code').reset_index()
+    rms = rms.sort_values(['Output Unlocked (Kg)', 'Kg to Unlock', 'FGs Blocked'], ascending=[False, True, False], kind='stable')
+
+    return {'fgs': fgs, 'lines': lines, 'rms': rms.reset_index(drop=True)}
+
+
+# --- What-if replanning ---
+
+class SensitivityPlanner:
+    """Array FIFO planner for fast stock what-ifs on a fixed requirement matrix.
+
+    The baseline plan is run once over the matrix, keeping a copy of the stock
+    vector every ``checkpoint_every`` FGs. A what-if only changes FGs from the
+    first one that uses an adjusted RM, so :meth:`plan` resumes from the last
+    checkpoint before that FG instead of starting over. Batch sizing and
+    allocation follow :func:`compute_production_plan` line for line.
+    """
+
+    def __init__(self, matrix, rm_stock, fg_expected_capacity, checkpoint_every=32, fixed_point=False,
+                 policy='fifo', fg_weights=None, skip_fgs=()):
+        self.matrix = matrix
+        self.checkpoint_every = checkpoint_every
+        self.fixed_point = fixed_point or policy != 'fifo'
+        self.policy = policy
+        self.base_stock, _ = matrix.stock_vector(rm_stock)
+        self.quantities, self.raw_quantities = matrix.quantities, matrix.raw_quantities
+        if self.fixed_point:
+            # Same integer base units as compute_fixed_point_plan
+            self.base_stock = to_units(self.base_stock, matrix.decimal_places)
+            self.quantities = self.raw_quantities = to_units(matrix.quantities, matrix.decimal_places)
+
+        expected = np.array([fg_expected_capacity.get(fg, 0) for fg in matrix.fg_codes], dtype=float)
+        self.expected_batches = np.where(expected > 0, np.maximum(1, expected // BATCH_SIZE_KG), 0).astype(int)
+
+        # FGs listing an RM twice allocate it line by line, like the plan loop
+        pairs = matrix.line_fg.astype(np.int64) * len(matrix.rm_codes) + matrix.rm_idx
+        unique_pairs, counts = np.unique(pairs, return_counts=True)
+        self.repeats_rm = np.zeros(len(matrix), dtype=bool)
+        self.repeats_rm[unique_pairs[counts > 1] // len(matrix.rm_codes)] = True
+
+        # First FG (in FIFO order) using each RM
+        self.first_use = np.full(len(matrix.rm_codes), len(matrix), dtype=int)
+        np.minimum.at(self.first_use, matrix.rm_idx, matrix.line_fg)
+        self._rm_pos = {rm: i for i, rm in enumerate(matrix.rm_codes)}
+
+        if policy != 'fifo':
+            # Sharing policies are re-solved as a whole; they are vectorized and cheap
+            self.problem = OrderProblem(matrix, rm_stock, fg_expected_capacity, skip_fgs)
+            self.weights = np.array([(fg_weights or {}).get(fg, 1) for fg in matrix.fg_codes], dtype=float)
+            self.baseline, self.baseline_left = allocate_by_policy(self.problem, policy, self.weights)
+            return
+
+        self.checkpoints = []
+        self.baseline = np.zeros(len(matrix), dtype=int)
+        self._run(self.base_stock.copy(), 0, self.baseline, self.checkpoints)
+
+    def drop_checkpoints(self):
+        """Free the stock checkpoints; the next what-if replays the baseline to rebuild them"""
+        if self.policy == 'fifo':
+            self.checkpoints = None
+
+    def _run(self, stock, start, batches, checkpoints=None):
+        matrix = self.matrix
+        decimal_places = matrix.decimal_places
+        indptr, rm_idx, req_all, raw_all = matrix.indptr, matrix.rm_idx, self.quantities, self.raw_quantities
+
+        for i in range(start, len(matrix)):
+            if checkpoints is not None and i % self.checkpoint_every == 0:
+                checkpoints.append(stock.copy())
+
+            lo, hi = indptr[i], indptr[i + 1]
+            if lo == hi:
+                batches[i] = 0
+                continue
+
+            idx = rm_idx[lo:hi]
+            req = req_all[lo:hi]
+            avail = stock[idx]
+            usable = (req > 0) & (avail > 0)
+            covered = np.where(usable, np.floor_divide(avail, np.where(usable, req, 1.0)), 0)
+
+            expected_batches = self.expected_batches[i]
+            if expected_batches > 0:
+                possible = np.where(usable & (avail >= req * expected_batches), expected_batches, covered)
+                actual = min(expected_batches, int(possible.min()))
+            else:
+                actual = int(covered.min())
+            batches[i] = actual
+
+            if actual > 0 and self.fixed_point:
+                np.subtract.at(stock, idx, req * actual)
+            elif actual > 0:
+                allocated = [round(q * actual, decimal_places) for q in raw_all[lo:hi].tolist()]
+                if self.repeats_rm[i]:
+                    for rm, kg in zip(idx.tolist(), allocated):
+                        stock[rm] = round(stock[rm] - kg, decimal_places)
+                else:
+                    stock[idx] = [round(a - kg, decimal_places) for a, kg in zip(avail.tolist(), allocated)]
+        return batches
+
+    def line_available(self):
+        """Kg each formula line could reach under a sharing policy, or None under FIFO"""
+        if self.policy == 'fifo':
+            return None
+        units = self.problem.reachable(self.baseline, self.baseline_left)
+        return units / 10 ** self.matrix.decimal_places
+
+    def stock_of(self, rm_code):
+        """Baseline (rounded) stock of ``rm_code``"""
+        if rm_code not in self._rm_pos:
+            return 0.0
+        stock = float(self.base_stock[self._rm_pos[rm_code]])
+        return stock / 10 ** self.matrix.decimal_places if self.fixed_point else stock
+
+    def plan(self, adjustments):
+        """Planned batches per FG with ``adjustments`` ({RM Code: +/- Kg}) applied to stock"""
+        decimal_places = self.matrix.decimal_places
+        adjusted = {self._rm_pos[rm]: kg for rm, kg in adjustments.items() if rm in self._rm_pos and kg}
+        if not adjusted:
+            return self.baseline.copy()
+
+        if self.policy != 'fifo':
+            stock = self.problem.stock.copy()
+            for rm, kg in adjusted.items():
+                stock[rm] += to_units(kg, decimal_places)
+            return allocate_by_policy(self.problem, self.policy, self.weights, stock)[0]
+
+        first_affected = min(self.first_use[rm] for rm in adjusted)
+        checkpoint = first_affected // self.checkpoint_every
+        start = checkpoint * self.checkpoint_every
+
+        if self.checkpoints is None:
+            self.checkpoints = []
+            self._run(self.base_stock.copy(), 0, np.zeros(len(self.matrix), dtype=int), self.checkpoints)
+
+        # Adjusted RMs are untouched before their first use, so they still hold initial stock here
+        stock = self.checkpoints[checkpoint].copy()
+        for rm, kg in adjusted.items():
+            if self.fixed_point:
+                stock[rm] = self.base_stock[rm] + to_units(kg, decimal_places)
+            else:
+                stock[rm] = round(self.base_stock[rm] + kg, decimal_places)
+
+        batches = self.baseline.copy()
+        return self._run(stock, start, batches)
+
+
+# --- Fixed-point plan ---
+
+def to_units(values, decimal_places):
+    """Kg -> integer base units of ``10 ** -decimal_places`` Kg"""
+    return np.rint(np.asarray(values, dtype=float) * 10 ** decimal_places).astype(np.int64)
+
+
+def _max_batches(req, stock):
+    """Whole batches ``stock`` covers for every line (integer units); 0 if any line can't be made"""
+    positive = req > 0
+    return int(np.where(positive & (stock > 0), stock // np.where(positive, req, 1), 0).min())
+
+
+def _size_fg(rm_names, req, avail, expected_capacity, kg):
+    """Batches one FG gets from ``avail`` (integer units) and its shortage lines in the plan's wording.
+
+    Returns ``(batches, shortage_breakdown, missing_count)``; ``kg`` formats
+    units back to Kg for the messages.
+    """
+    positive = req > 0
+    covered = np.where(positive & (avail > 0), avail // np.where(positive, req, 1), 0)
+    shortage_breakdown = []
+
+    if expected_capacity > 0:
+        expected_batches = max(1, int(expected_capacity // BATCH_SIZE_KG))
+        total_required = req * expected_batches
+        enough = positive & (avail >= total_required)
+        possible = np.where(enough, expected_batches, covered)
+        actual_batches = min(expected_batches, int(possible.min()))
+
+        short = (~positive) | (avail <= 0) | (~enough & (covered < expected_batches))
+        for line in np.flatnonzero(short):
+            rm = rm_names[line]
+            if not positive[line]:
+                shortage_breakdown.append(f"{rm}: Invalid requirement ({kg(req[line])} Kg per batch)")
+            elif avail[line] <= 0:
+                shortage_breakdown.append(f"{rm}: Required {kg(total_required[line])} Kg, Available 0.0000 Kg")
+            else:
+                shortage_breakdown.append(
+                    f"{rm}: Required {kg(total_required[line])} Kg for {expected_batches} batches, "
+                    f"Available {kg(avail[line])} Kg, Shortage {kg(total_required[line] - avail[line])} Kg"
+                )
+    else:
+        actual_batches = int(covered.min())
+
+        short = (~positive) | (covered == 0)
+        for line in np.flatnonzero(short):
+            rm = rm_names[line]
+            if not positive[line]:
+                shortage_breakdown.append(f"{rm}: Invalid requirement ({kg(req[line])} Kg)")
+            elif avail[line] <= 0:
+                shortage_breakdown.append(f"{rm}: Required {kg(req[line])} Kg per batch, Available 0.0000 Kg")
+            else:
+                shortage_breakdown.append(
+                    f"{rm}: Required {kg(req[line])} Kg per batch, Available {kg(avail[line])} Kg, "
+                    f"Shortage {kg(req[line] - avail[line])} Kg"
+                )
+
+    return actual_batches, shortage_breakdown, int((positive & short).sum())
+
+
+def _result_row(fg, expected_capacity, max_batches, actual_batches, missing_count):
+    return {
+        "FG": fg,
+        "Expected": f"{expected_capacity:,.1f} Kg" if expected_capacity > 0 else "Auto",
+        "Max": f"{max_batches * BATCH_SIZE_KG:,.1f} Kg",
+        "Actual": f"{actual_batches * BATCH_SIZE_KG:,.1f} Kg",
+        "Status": "✅ Ready" if actual_batches > 0 else "❌ Shortage",
+        "Missing": f"{missing_count} RM(s)" if missing_count else "None",
+        "Batches": actual_batches
+    }
+
+
+def compute_fixed_point_plan(rm_stock, fg_formulas, fg_order, fg_expected_capacity, decimal_places,
+                             progress=None, cancel_event=None, skip_fgs=(), ledger=None):
+    """FIFO plan on integer base units; same inputs and outputs as :func:`compute_production_plan`.
+
+    Stock and per-batch requirements are converted once to integers scaled by
+    ``10 ** decimal_places``. Batch counts are integer floor divisions and
+    allocations integer subtractions, so allocated stock can never drift below
+    zero and the same inputs always give the same plan. Quantities go back to
+    Kg only when the shortage messages are formatted. Allocation uses the
+    rounded per-batch requirement, where the float plan rounds raw
+    quantity x batches.
+    """
+    matrix = RequirementMatrix(fg_formulas, fg_order, decimal_places)
+    scale = 10 ** decimal_places
+    stock_kg, _ = matrix.stock_vector(rm_stock)
+    initial_stock = to_units(stock_kg, decimal_places)
+    allocated_stock = initial_stock.copy()
+    req_all = to_units(matrix.quantities, decimal_places)
+    rm_names = matrix.rm_codes
+    if ledger is not None:
+        ledger.start(rm_stock)
+
+    def kg(units):
+        return f"{units / scale:.{decimal_places}f}"
+
+    total_fgs = len(matrix)
+    results = []
+    shortage_details = {}
+
+    for i, fg in enumerate(matrix.fg_codes):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PlanCancelled()
+
+        lo, hi = matrix.indptr[i], matrix.indptr[i + 1]
+        if lo == hi:
+            if progress is not None:
+                progress(i + 1, total_fgs)
+            continue
+
+        idx = matrix.rm_idx[lo:hi]
+        req = req_all[lo:hi]
+        expected_capacity = fg_expected_capacity.get(fg, 0)
+
+        if fg in skip_fgs:
+            result, shortage_details[fg] = _skipped_fg(fg, rm_names[idx], matrix.quantities[lo:hi],
+                                                       expected_capacity, decimal_places)
+            results.append(result)
+            if progress is not None:
+                progress(i + 1, total_fgs)
+            continue
+
+        # Max capacity from initial stock
+        max_possible_batches = _max_batches(req, initial_stock[idx])
+        actual_batches, shortage_details[fg], missing_count = _size_fg(
+            rm_names[idx], req, allocated_stock[idx], expected_capacity, kg
+        )
+
+        # Every line had stock when a batch was possible, so the RM is in stock
+        if actual_batches > 0:
+            if ledger is not None:
+                # Stock before each line, counting earlier lines of the same RM in this FG
+                drawn = req * actual_batches
+                earlier = pd.Series(drawn).groupby(idx).cumsum().to_numpy() - drawn
+                ledger.record(i + 1, fg, rm_names[idx], actual_batches, drawn / scale,
+                              (allocated_stock[idx] - earlier) / scale)
+            np.subtract.at(allocated_stock, idx, req * actual_batches)
+
+        results.append(_result_row(fg, expected_capacity, max_possible_batches, actual_batches, missing_count))
+
+        if progress is not None:
+            progress(i + 1, total_fgs)
+
+    return results, shortage_details
+
+
+# --- Master-data validation ---
+
+def validate_master_data(rm_stock, rm_po, fg_formulas, ingestion_issues=()):
+    """Data-quality report over the current master data, one row per finding.
+
+    Table-level checks run as whole-column operations; ``ingestion_issues``
+    (rows dropped or repaired while reading uploads) are added as they are.
+    Errors block planning: an FG whose formula has a zero or negative
+    requirement can never make a batch and is skipped by the planner
+    (see :func:`blocked_fgs`).
+    """
+    issues = [frame for frame in ingestion_issues if not frame.empty]
+
+    stock_codes = pd.Index(rm_stock['RM Code'].unique())
+    po_codes = pd.Index(rm_po['RM Code'].unique()) if not rm_po.empty else pd.Index([])
+
+    # Stock: negative quantities and RMs listed more than once per location/lot (the last row is used)
+    rm_stock = with_location(rm_stock)
+    negative = rm_stock['Quantity'] < 0
+    if negative.any():
+        issues.append(issue_frame('Warning', 'RM Stock', 'Negative quantity',
+                                  rm_stock.loc[negative, 'Quantity'].map('{:,.4f} Kg'.format),
+                                  rm_codes=rm_stock.loc[negative, 'RM Code']))
+    repeated = rm_stock.duplicated(subset=stock_key_columns(rm_stock), keep=False)
+    if repeated.any():
+        counts = rm_stock[repeated].groupby(stock_key_columns(rm_stock), sort=False).size()
+        detail = (counts.astype(str) + ' rows at ' + counts.index.get_level_values('Location')
+                  + ', last one is used')
+        issues.append(issue_frame('Warning', 'RM Stock', 'Duplicate RM', detail.to_numpy(),
+                                  rm_codes=counts.index.get_level_values('RM Code')))
+
+    # POs: negative quantities
+    if not rm_po.empty:
+        negative = rm_po['Quantity'] < 0
+        if negative.any():
+            issues.append(issue_frame('Warning', 'RM PO', 'Negative quantity',
+                                      rm_po.loc[negative, 'Quantity'].map('{:,.4f} Kg'.format),
+                                      rm_codes=rm_po.loc[negative, 'RM Code']))
+
+    if not fg_formulas.empty:
+        lines = fg_formulas.assign(**{'RM Code': fg_formulas['RM Code'].astype(str).str.strip()})
+
+        # Formulas: non-positive requirements make the FG unplannable
+        invalid = lines['Quantity'] <= 0
+        if invalid.any():
+            issues.append(issue_frame('Error', 'FG Formulas', 'Invalid requirement',
+                                      lines.loc[invalid, 'Quantity'].map('{:,.4f} Kg per batch, FG skipped by the planner'.format),
+                                      lines.loc[invalid, 'FG Code'], lines.loc[invalid, 'RM Code']))
+
+        repeated = lines.duplicated(subset=['FG Code', 'RM Code'], keep=False)
+        if repeated.any():
+            counts = lines[repeated].groupby(['FG Code', 'RM Code'], sort=False).size()
+            issues.append(issue_frame('Warning', 'FG Formulas', 'Duplicate line', counts.astype(str) + ' lines, all are used',
+                                      counts.index.get_level_values(0), counts.index.get_level_values(1)))
+
+        # Orphan RMs: used by a formula but neither in stock nor on order
+        in_stock = lines['RM Code'].isin(stock_codes)
+        orphan = ~in_stock & ~lines['RM Code'].isin(po_codes)
+        if orphan.any():
+            used_by = lines[orphan].drop_duplicates(['RM Code', 'FG Code']).groupby('RM Code', sort=False)['FG Code']
+            issues.append(issue_frame('Warning', 'FG Formulas', 'Orphan RM',
+                                      'No stock and no PO; used by ' + used_by.agg(', '.join),
+                                      rm_codes=used_by.size().index))
+
+        # FGs with none of their RMs in stock
+        no_stock = (~in_stock).groupby(lines['FG Code'], sort=False).all()
+        if no_stock.any():
+            fg_codes = no_stock.index[no_stock.to_numpy()]
+            issues.append(issue_frame('Warning', 'FG Formulas', 'FG missing from stock',
+                                      'None of its RMs are in stock', fg_codes=fg_codes))
+
+    if not issues:
+        return pd.DataFrame(columns=ISSUE_COLUMNS)
+
+    report = pd.concat(issues, ignore_index=True)[ISSUE_COLUMNS]
+    severity = pd.Categorical(report['Severity'], categories=SEVERITY_ORDER, ordered=True)
+    return report.iloc[np.argsort(severity.codes, kind='stable')].reset_index(drop=True)
+
+
+def blocked_fgs(issues):
+    """FG codes the planner skips: those with an Error in the data-quality report"""
+    errors = issues[(issues['Severity'] == 'Error') & (issues['FG Code'] != '')]
+    return set(errors['FG Code'])
+
+
+# --- FIFO order search ---
+
+ORDER_OBJECTIVES = ('ready', 'kg')
+
+
+class OrderProblem:
+    """Everything needed to score a FIFO order, as plain arrays that pickle cheaply.
+
+    Candidate orders are permutations of the matrix rows. Scoring runs the
+    integer-unit plan (see :func:`compute_fixed_point_plan`) without building
+    any messages, so one evaluation is a single pass over the formula lines.
+    """
+
+    def __init__(self, matrix, rm_stock, fg_expected_capacity, skip_fgs=()):
+        decimal_places = matrix.decimal_places
+        stock_kg, _ = matrix.stock_vector(rm_stock)
+        self.fg_codes = matrix.fg_codes
+        self.stock = to_units(stock_kg, decimal_places)
+        self.req = to_units(matrix.quantities, decimal_places)
+        self.indptr = matrix.indptr
+        self.rm_idx = matrix.rm_idx
+        self.line_fg = matrix.line_fg
+
+        expected = np.array([fg_expected_capacity.get(fg, 0) for fg in matrix.fg_codes], dtype=float)
+        self.expected_batches = np.where(expected > 0, np.maximum(1, expected // BATCH_SIZE_KG), 0).astype(np.int64)
+        self.plannable = np.array([fg not in skip_fgs for fg in matrix.fg_codes]) & (np.diff(self.indptr) > 0)
+
+    def batches(self, order):
+        """Batches per FG (matrix row) when the FGs are planned in ``order``"""
+        stock = self.stock.copy()
+        batches = np.zeros(len(self.fg_codes), dtype=np.int64)
+        for row in order:
+            if not self.plannable[row]:
+                continue
+            lo, hi = self.indptr[row], self.indptr[row + 1]
+            idx = self.rm_idx[lo:hi]
+            req = self.req[lo:hi]
+            avail = stock[idx]
+            if (req <= 0).any() or (avail <= 0).any():
+                continue
+            actual = int((avail // req).min())
+            if self.expected_batches[row] > 0:
+                actual = min(actual, int(self.expected_batches[row]))
+            if actual > 0:
+                batches[row] = actual
+                np.subtract.at(stock, idx, req * actual)
+        return batches
+
+    def reachable(self, batches, left):
+        """Per formula line: the FG's own allocation plus the stock nobody took (integer units)"""
+        return self.req * batches[self.line_fg] + left[self.rm_idx]
+
+    def score(self, order, objective='ready'):
+        """Comparable score: (ready FGs, total batches) or (total batches, ready FGs)"""
+        batches = self.batches(order)
+        ready, total = int((batches > 0).sum()), int(batches.sum())
+        return (ready, total) if objective == 'ready' else (total, ready)
+
+
+def score_orders(problem, orders, objective='ready'):
+    """Score a chunk of candidate orders; the unit of work sent to pool workers"""
+    return [problem.score(order, objective) for order in orders]
+
+
+def _neighbour(order, movable, batches, rng):
+    """One local-search move on the movable positions: swap, or pull a short FG earlier"""
+    candidate = order.copy()
+    rows = candidate[movable]
+    n = len(rows)
+    short = np.flatnonzero(batches[rows] == 0)
+    if len(short) and rng.random() < 0.5:
+        src = int(rng.choice(short))
+        dst = int(rng.integers(0, src + 1))
+        rows = np.insert(np.delete(rows, src), dst, rows[src])
+    elif rng.random() < 0.5:
+        i, j = rng.choice(n, 2, replace=False)
+        rows[i], rows[j] = rows[j], rows[i]
+    else:
+        src, dst = rng.choice(n, 2, replace=False)
+        rows = np.insert(np.delete(rows, src), dst, rows[src])
+    candidate[movable] = rows
+    return candidate
+
+
+def search_fifo_order(problem, pinned=(), objective='ready', executor=None, workers=1, time_budget=5.0,
+                      candidates_per_round=64, patience=20, seed=0, progress=None):
+    """Hill-climbing search for a better FIFO order.
+
+    Starts from the current order (matrix row order). Every round draws
+    ``candidates_per_round`` neighbours of the best order so far, scores them
+    (split into ``workers`` chunks on ``executor`` when one is given, e.g. a
+    process pool) and keeps the best if
+    it improves. FGs in ``pinned`` keep their positions. Stops after
+    ``time_budget`` seconds or ``patience`` rounds without improvement.
+
+    Returns a dict with the best ``order`` (FG codes) and the start/best scores.
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    n = len(problem.fg_codes)
+    best = np.arange(n)
+    pinned = set(pinned)
+    movable = np.array([fg not in pinned for fg in problem.fg_codes])
+    start_score = best_score = problem.score(best, objective)
+    evaluated, rounds, stale = 1, 0, 0
+
+    if movable.sum() >= 2:
+        deadline = time.monotonic() + time_budget
+        while time.monotonic() < deadline and stale < patience:
+            batches = problem.batches(best)
+            candidates = [_neighbour(best, movable, batches, rng) for _ in range(candidates_per_round)]
+            if executor is not None and workers > 1:
+                chunks = [candidates[i::workers] for i in range(workers)]
+                scored = executor.map(score_orders, [problem] * workers, chunks, [objective] * workers)
+                scores = [score for chunk in scored for score in chunk]
+                candidates = [order for chunk in chunks for order in chunk]
+            else:
+                scores = score_orders(problem, candidates, objective)
+
+            evaluated += len(candidates)
+            rounds += 1
+            top = max(range(len(scores)), key=scores.__getitem__)
+            if scores[top] > best_score:
+                best, best_score, stale = candidates[top], scores[top], 0
+            else:
+                stale += 1
+            if progress is not None:
+                progress(rounds, best_score)
+
+    return {
+        'order': [problem.fg_codes[row] for row in best],
+        'start_score': start_score,
+        'best_score': best_score,
+        'evaluated': evaluated,
+        'rounds': rounds,
+        'objective': objective,
+    }
+
+
+# --- Allocation policies ---
+# FIFO lets the first FG in the order take everything it needs. The other
+# policies share a scarce RM between the FGs competing for it: each FG gets a
+# fill fraction of its target batches from one vectorized pass over the
+# formula lines, whole batches are floored, and stock left over by the
+# flooring is handed out again in the policy's priority order.
+
+LOCATION_RULES = {
+    'transfer_cost': "Cheapest transfer first",
+    'priority': "Location priority order",
+}
+ALLOCATION_POLICIES = {
+    'fifo': "FIFO (order priority)",
+    'fair_share': "Proportional fair-share",
+    'priority': "Weighted priority classes",
+    'max_min': "Max-min fair (water-filling)",
+}
+PRIORITY_CLASS_WEIGHTS = {'High': 4, 'Medium': 2, 'Low': 1}
+
+
+def _fill_fractions(problem, stock, targets, policy, weights):
+    """Fraction of its target each FG can get under ``policy`` (vectorized over lines)"""
+    n_rm = len(stock)
+    lines_fg, lines_rm = problem.line_fg, problem.rm_idx
+    demand = problem.req * targets[lines_fg].astype(float)
+    stock = stock.astype(float)
+
+    if policy == 'max_min':
+        # Progressive filling: raise every active FG's fraction together until an
+        # RM runs out, freeze the FGs using it, repeat with the rest
+        fractions = np.zeros(len(targets))
+        active = targets > 0
+        frozen_use = np.zeros(n_rm)
+        level = 0.0
+        while active.any():
+            active_demand = np.bincount(lines_rm, weights=demand * active[lines_fg], minlength=n_rm)
+            competing = active_demand > 0
+            saturation = np.full(n_rm, np.inf)
+            saturation[competing] = (stock[competing] - frozen_use[competing]) / active_demand[competing]
+            level = max(level, saturation.min())
+            if level >= 1:
+                fractions[active] = 1.0
+                break
+            saturated = saturation <= level + 1e-12
+            freeze = np.zeros(len(targets), dtype=bool)
+            freeze[lines_fg[saturated[lines_rm]]] = True
+            freeze &= active
+            fractions[freeze] = level
+            frozen_use += np.bincount(lines_rm, weights=demand * freeze[lines_fg] * level, minlength=n_rm)
+            active &= ~freeze
+        return fractions
+
+    if policy == 'priority':
+        share_weight = weights[lines_fg]
+    else:
+        share_weight = np.ones(len(lines_fg))
+
+    # Each FG's share of an RM is proportional to (weight x demand)
+    weighted_demand = np.bincount(lines_rm, weights=share_weight * demand, minlength=n_rm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        line_fraction = np.where(weighted_demand[lines_rm] > 0,
+                                 share_weight * stock[lines_rm] / weighted_demand[lines_rm], 1.0)
+    line_fraction = np.minimum(line_fraction, 1.0)
+
+    fractions = np.ones(len(targets))
+    rows = np.flatnonzero(np.diff(problem.indptr) > 0)
+    fractions[rows] = np.minimum.reduceat(line_fraction, problem.indptr[rows])
+    return fractions
+
+
+def allocate_by_policy(problem, policy, weights=None, stock=None):
+    """Batches per FG (matrix row) under an allocation policy, and the stock left over.
+
+    ``weights`` (per matrix row) is used by the ``priority`` policy; ``stock``
+    (integer units per RM) defaults to the problem's stock. FIFO follows the
+    matrix order exactly like the plan loop.
+    """
+    stock = problem.stock if stock is None else stock
+    n_fg = len(problem.fg_codes)
+    weights = np.ones(n_fg) if weights is None else np.asarray(weights, dtype=float)
+
+    # Target batches: expected capacity, capped by what the initial stock allows
+    cover = np.where((problem.req > 0) & (stock[problem.rm_idx] > 0),
+                     stock[problem.rm_idx] // np.where(problem.req > 0, problem.req, 1), 0)
+    max_batches = np.zeros(n_fg, dtype=np.int64)
+    rows = np.flatnonzero(np.diff(problem.indptr) > 0)
+    max_batches[rows] = np.minimum.reduceat(cover, problem.indptr[rows])
+    max_batches[~problem.plannable] = 0
+    targets = np.where(problem.expected_batches > 0, np.minimum(problem.expected_batches, max_batches), max_batches)
+
+    if policy == 'fifo':
+        batches = np.zeros(n_fg, dtype=np.int64)
+        top_up_order = np.arange(n_fg)
+    else:
+        fractions = _fill_fractions(problem, stock, targets, policy, weights)
+        batches = np.floor(targets * fractions + 1e-9).astype(np.int64)
+        batches = np.minimum(batches, targets)
+        if policy == 'priority':
+            top_up_order = np.lexsort((np.arange(n_fg), -weights))
+        elif policy == 'max_min':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                filled = np.where(targets > 0, batches / targets, 1.0)
+            top_up_order = np.lexsort((np.arange(n_fg), filled))
+        else:
+            top_up_order = np.arange(n_fg)
+
+    left = stock - np.bincount(problem.rm_idx, weights=problem.req * batches[problem.line_fg],
+                               minlength=len(stock)).astype(np.int64)
+
+    # Hand out what is left (everything, for FIFO) in priority order
+    for row in top_up_order:
+        room = targets[row] - batches[row]
+        if room <= 0:
+            continue
+        lo, hi = problem.indptr[row], problem.indptr[row + 1]
+        idx = problem.rm_idx[lo:hi]
+        req = problem.req[lo:hi]
+        extra = min(int(room), _max_batches(req, left[idx]))
+        if extra > 0:
+            batches[row] += extra
+            np.subtract.at(left, idx, req * extra)
+
+    return batches, left
+
+
+def compute_policy_plan(rm_stock, fg_formulas, fg_order, fg_expected_capacity, decimal_places, policy,
+                        fg_weights=None, progress=None, cancel_event=None, skip_fgs=(), ledger=None):
+    """Plan under a shared allocation policy; same outputs as :func:`compute_production_plan`.
+
+    Batches come from :func:`allocate_by_policy` on integer units. Each FG's
+    shortage lines are then worded as in the FIFO plan, measured against what
+    the FG could reach: its own allocation plus the stock left unallocated.
+    """
+    matrix = RequirementMatrix(fg_formulas, fg_order, decimal_places)
+    problem = OrderProblem(matrix, rm_stock, fg_expected_capacity, skip_fgs)
+    weights = None
+    if fg_weights is not None:
+        weights = np.array([fg_weights.get(fg, 1) for fg in matrix.fg_codes], dtype=float)
+
+    if cancel_event is not None and cancel_event.is_set():
+        raise PlanCancelled()
+    batches, left = allocate_by_policy(problem, policy, weights)
+
+    scale = 10 ** decimal_places
+    rm_names = matrix.rm_codes
+    if ledger is not None:
+        # A shared allocation has no draw order; lines are booked in matrix order
+        drawing = batches[problem.line_fg] > 0
+        idx = problem.rm_idx[drawing]
+        drawn = problem.req[drawing] * batches[problem.line_fg][drawing]
+        earlier = pd.Series(drawn).groupby(idx).cumsum().to_numpy() - drawn
+        ledger.start(rm_stock)
+        ledger.record(problem.line_fg[drawing] + 1, matrix.fg_codes[problem.line_fg[drawing]], rm_names[idx],
+                      batches[problem.line_fg][drawing], drawn / scale, (problem.stock[idx] - earlier) / scale)
+
+    def kg(units):
+        return f"{units / scale:.{decimal_places}f}"
+
+    total_fgs = len(matrix)
+    results = []
+    shortage_details = {}
+
+    for i, fg in enumerate(matrix.fg_codes):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PlanCancelled()
+
+        lo, hi = matrix.indptr[i], matrix.indptr[i + 1]
+        if lo == hi:
+            if progress is not None:
+                progress(i + 1, total_fgs)
+            continue
+
+        idx = matrix.rm_idx[lo:hi]
+        req = problem.req[lo:hi]
+        expected_capacity = fg_expected_capacity.get(fg, 0)
+
+        if fg in skip_fgs:
+            result, shortage_details[fg] = _skipped_fg(fg, rm_names[idx], matrix.quantities[lo:hi],
+                                                       expected_capacity, decimal_places)
+        else:
+            reachable = req * batches[i] + left[idx]
+            _, shortage_details[fg], missing_count = _size_fg(rm_names[idx], req, reachable, expected_capacity, kg)
+            result = _result_row(fg, expected_capacity, _max_batches(req, problem.stock[idx]), int(batches[i]),
+                                 missing_count)
+        results.append(result)
+
+        if progress is not None:
+            progress(i + 1, total_fgs)
+
+    return results, shortage_details
+
+
+# --- Stock locations ---
+# Stock is held in several warehouses and at the production site. The plan is
+# sized on the pooled stock; each FG's allocation is then drawn from the
+# locations in rule order with one pass over an RM x location array, so the
+# number of locations doesn't multiply planning time.
+
+class LocationStock:
+    """Stock per RM and location as one RM x location array.
+
+    Rows follow ``rm_codes`` (a requirement matrix's RMs), columns
+    ``locations``. Repeated stock keys keep the last row, like the pooled
+    stock; the lots of an RM at one location are summed.
+    """
+
+    def __init__(self, rm_stock, rm_codes, decimal_places):
+        stock = latest_stock_rows(rm_stock)
+        self.rm_codes = np.asarray(rm_codes, dtype=object)
+        self.locations = np.array(sorted(stock['Location'].astype(str).unique()), dtype=object)
+        rows = pd.Index(self.rm_codes).get_indexer(stock['RM Code'])
+        cols = np.searchsorted(self.locations, stock['Location'].astype(str).to_numpy())
+        known = rows >= 0
+        self.quantities = np.zeros((len(self.rm_codes), len(self.locations)))
+        np.add.at(self.quantities, (rows[known], cols[known]),
+                  np.round(stock['Quantity'].to_numpy(dtype=float)[known], decimal_places))
+
+    def totals(self):
+        return self.quantities.sum(axis=1)
+
+
+def location_rank(locations, rule='transfer_cost', priority=None, transfer_cost=None):
+    """Column order in which stock is drawn from ``locations``.
+
+    ``transfer_cost`` draws from the cheapest location to move stock from
+    first (the production site costs nothing), ``priority`` follows the
+    planner-set rank; ties fall back to the other key, then to the name.
+    """
+    priority = priority or {}
+    transfer_cost = transfer_cost or {}
+    cost = [float(transfer_cost.get(loc, 0.0)) for loc in locations]
+    rank = [int(priority.get(loc, len(locations))) for loc in locations]
+    if rule == 'priority':
+        keys = (list(locations), cost, rank)
+    else:
+        keys = (list(locations), rank, cost)
+    return np.lexsort(keys)
+
+
+def _allocation_intervals(matrix, batches):
+    """Kg of each line's RM allocated before and after the line, in FIFO order"""
+    batches = np.asarray(batches, dtype=float)
+    allocated = np.round(matrix.raw_quantities * batches[matrix.line_fg], matrix.decimal_places)
+    allocated = np.where(allocated > 0, allocated, 0.0)
+
+    # Lines are already in FIFO order; a stable sort groups them per RM
+    order = np.argsort(matrix.rm_idx, kind='stable')
+    rm_sorted = matrix.rm_idx[order]
+    cum = np.cumsum(allocated[order])
+    group_start = np.searchsorted(rm_sorted, rm_sorted, side='left')
+    offset = np.concatenate(([0.0], cum))[group_start]
+    after = np.empty_like(cum)
+    after[order] = cum - offset
+    return after - allocated, after
+
+
+def location_draws(matrix, location_stock, batches, rank, transfer_cost=None):
+    """Kg each planned FG draws from each location, and the stock left per location.
+
+    Allocations are consumed per RM in FIFO order; location ``rank[0]`` is
+    emptied first. With the cumulative allocation per RM before and after
+    each line, a line's draw from a location is the overlap of that interval
+    with the location's slice of the ranked stock, computed for all lines
+    and locations at once. Returns ``(draws, residual)``: ``draws`` has one
+    row per FG, RM and location drawn from, ``residual`` is RM x location.
+    """
+    transfer_cost = transfer_cost or {}
+    decimal_places = matrix.decimal_places
+    before, after = _allocation_intervals(matrix, batches)
+
+    ranked = np.clip(location_stock.quantities[:, rank], 0, None)
+    upper = np.cumsum(ranked, axis=1)
+    lower = upper - ranked
+
+    rms = matrix.rm_idx
+    drawn = (np.clip(after[:, None], lower[rms], upper[rms])
+             - np.clip(before[:, None], lower[rms], upper[rms]))
+    drawn = np.round(drawn, decimal_places)
+
+    line, col = np.nonzero(drawn > 0)
+    locations = location_stock.locations[rank][col]
+    kg = drawn[line, col]
+    cost = np.array([float(transfer_cost.get(loc, 0.0)) for loc in location_stock.locations[rank]])[col]
+    draws = pd.DataFrame({
+        'FG Code': matrix.fg_codes[matrix.line_fg[line]],
+        'RM Code': matrix.rm_codes[rms[line]],
+        'Location': locations,
+        'Drawn (Kg)': kg,
+        'Transfer Cost': np.round(kg * cost, 2),
+    })
+
+    used = np.zeros_like(ranked)
+    np.add.at(used, (rms[line], col), kg)
+    residual = np.empty_like(location_stock.quantities)
+    residual[:, rank] = np.round(location_stock.quantities[:, rank] - used, decimal_places)
+    return draws, residual
+
+
+def residual_by_location(location_stock, draws, decimal_places):
+    """RM x location stock left after ``draws`` (rows with RM Code / Location / Drawn (Kg))"""
+    rows = pd.Index(location_stock.rm_codes).get_indexer(draws['RM Code'])
+    cols = np.searchsorted(location_stock.locations, draws['Location'].to_numpy())
+    residual = location_stock.quantities.copy()
+    np.subtract.at(residual, (rows, cols), draws['Drawn (Kg)'].to_numpy(dtype=float))
+    return np.round(residual, decimal_places)
+
+
+# --- Lots and expiry ---
+# Lot-level stock is drawn first-expired-first-out. All lots live in flat
+# arrays sorted by (RM, expiry), with cumulative quantities, so a line's lots
+# are found by binary search instead of walking each RM's queue.
+
+class LotQueue:
+    """Per-RM lot queues in FEFO order, stored as flat sorted arrays.
+
+    Lots without an expiry date go last; lots expiring the same day are taken
+    in location draw order (``location_rank`` positions). ``bounds`` holds the
+    cumulative quantity at the end of each lot over the whole queue and
+    ``rm_start`` the first lot of each RM of ``rm_codes``.
+    """
+
+    def __init__(self, stock_rows, rm_codes, decimal_places, location_order=None):
+        stock_rows = with_location(stock_rows)
+        rm_codes = np.asarray(rm_codes, dtype=object)
+        rm_pos = pd.Index(rm_codes).get_indexer(stock_rows['RM Code'])
+        known = rm_pos >= 0
+        rows = stock_rows[known]
+        rm_pos = rm_pos[known]
+
+        if 'Expiry Date' in rows.columns:
+            expiry = pd.to_datetime(rows['Expiry Date']).to_numpy()
+        else:
+            expiry = np.full(len(rows), np.datetime64('NaT'), dtype='datetime64[ns]')
+        expiry_key = np.where(np.isnat(expiry), np.iinfo(np.int64).max, expiry.astype(np.int64))
+        location_key = np.zeros(len(rows), dtype=int)
+        if location_order is not None:
+            location_key = pd.Index(location_order).get_indexer(rows['Location'].astype(str))
+
+        order = np.lexsort((location_key, expiry_key, rm_pos))
+        self.rm_codes = rm_codes
+        self.rm_idx = rm_pos[order]
+        self.location = rows['Location'].astype(str).to_numpy()[order]
+        self.lot = (rows['Lot'].astype(str).to_numpy()[order] if 'Lot' in rows.columns
+                    else np.full(len(rows), '', dtype=object))
+        self.expiry = expiry[order]
+        self.quantities = np.clip(np.round(rows['Quantity'].to_numpy(dtype=float)[order], decimal_places), 0, None)
+        self.bounds = np.cumsum(self.quantities)
+        self.rm_start = np.searchsorted(self.rm_idx, np.arange(len(rm_codes) + 1))
+
+    def __len__(self):
+        return len(self.quantities)
+
+
+def fefo_draws(matrix, queue, batches, transfer_cost=None):
+    """Kg each planned FG draws from each lot, first-expired-first-out, and what every lot keeps.
+
+    Every line's allocation is an interval of its RM's FEFO queue; both ends
+    are located with ``searchsorted`` on the cumulative lot quantities, and
+    the (usually one or two) lots in between are expanded with ``repeat``.
+    Cost grows with the number of lines drawn, not with the number of lots.
+    """
+    transfer_cost = transfer_cost or {}
+    decimal_places = matrix.decimal_places
+    before, after = _allocation_intervals(matrix, batches)
+
+    rms = matrix.rm_idx
+    start, end = queue.rm_start[rms], queue.rm_start[rms + 1]
+    base = np.concatenate(([0.0], queue.bounds))[start]
+    rm_total = np.concatenate(([0.0], queue.bounds))[end] - base
+    lo = base + np.minimum(before, rm_total)
+    hi = base + np.minimum(after, rm_total)
+
+    drawing = hi > lo
+    first = np.searchsorted(queue.bounds, lo, side='right')
+    last = np.minimum(np.searchsorted(queue.bounds, hi, side='left'), end - 1)
+    counts = np.where(drawing, last - first + 1, 0)
+
+    line = np.repeat(np.arange(len(rms)), counts)
+    lot = np.repeat(first, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    lot_upper = queue.bounds[lot]
+    lot_lower = lot_upper - queue.quantities[lot]
+    kg = np.round(np.minimum(hi[line], lot_upper) - np.maximum(lo[line], lot_lower), decimal_places)
+    keep = kg > 0
+    line, lot, kg = line[keep], lot[keep], kg[keep]
+
+    cost = np.array([float(transfer_cost.get(loc, 0.0)) for loc in queue.location[lot]])
+    draws = pd.DataFrame({
+        'FG Code': matrix.fg_codes[matrix.line_fg[line]],
+        'RM Code': matrix.rm_codes[rms[line]],
+        'Location': queue.location[lot],
+        'Lot': queue.lot[lot],
+        'Expiry Date': queue.expiry[lot],
+        'Drawn (Kg)': kg,
+        'Transfer Cost': np.round(kg * cost, 2),
+    })
+
+    remaining = queue.quantities.copy()
+    np.subtract.at(remaining, lot, kg)
+    return draws, np.round(remaining, decimal_places)
+
+
+def expiry_risk_report(stock_rows, queue, remaining, as_of, horizon_days=30):
+    """Lots that will be scrapped unless used: expired by ``as_of``, or expiring within the horizon with stock left after the plan"""
+    columns = ['Status', 'RM Code', 'Location', 'Lot', 'Expiry Date', 'Days to Expiry', 'At Risk (Kg)']
+    if 'Expiry Date' not in stock_rows.columns:
+        return pd.DataFrame(columns=columns)
+    as_of = pd.Timestamp(as_of)
+    horizon = as_of + pd.Timedelta(days=horizon_days)
+
+    stock_rows = with_location(stock_rows)
+    expiry = pd.to_datetime(stock_rows['Expiry Date'])
+    expired = stock_rows[(expiry < as_of) & (stock_rows['Quantity'] > 0)]
+    expired = pd.DataFrame({
+        'Status': 'Expired',
+        'RM Code': expired['RM Code'].to_numpy(),
+        'Location': expired['Location'].to_numpy(),
+        'Lot': expired['Lot'].to_numpy() if 'Lot' in expired.columns else '',
+        'Expiry Date': pd.to_datetime(expired['Expiry Date']).to_numpy(),
+        'At Risk (Kg)': expired['Quantity'].to_numpy(dtype=float),
+    })
+
+    at_risk = (~np.isnat(queue.expiry)) & (queue.expiry <= horizon.to_datetime64()) & (remaining > 0)
+    unused = pd.DataFrame({
+        'Status': 'At risk',
+        'RM Code': queue.rm_codes[queue.rm_idx[at_risk]],
+        'Location': queue.location[at_risk],
+        'Lot': queue.lot[at_risk],
+        'Expiry Date': queue.expiry[at_risk],
+        'At Risk (Kg)': remaining[at_risk],
+    })
+
+    report = pd.concat([expired, unused], ignore_index=True)
+    report['Days to Expiry'] = (pd.to_datetime(report['Expiry Date']) - as_of).dt.days
+    return report.sort_values(['Expiry Date', 'RM Code'], kind='stable')[columns].reset_index(drop=True)
+
+
+# --- Procurement ---
+
+def recommend_purchases(shortages, po_index, supplier_terms, need_by, today, defaults=None):
+    """Suggested purchase orders for the RMs short in the plan, one row per RM.
+
+    ``shortages`` has one row per short RM (RM Code / Shortage (Kg)); the
+    shortage is netted against the open POs of ``po_index`` (a ``POIndex``):
+    lines arriving by ``need_by`` reduce it, lines arriving later are flagged
+    for expediting instead of buying again. What is left is raised to the RM's minimum order quantity and
+    rounded up to whole supplier lots; the order-by date is ``need_by`` less
+    the lead time. Priority follows the slack between ``today`` and the
+    order-by date. PO quantities are index lookups; every other step is a
+    column-wise operation over the shortages.
+    """
+    defaults = {**DEFAULT_SUPPLIER_TERMS, **(defaults or {})}
+    need_by = pd.Timestamp(need_by)
+    today = pd.Timestamp(today).normalize()
+
+    recs = shortages.groupby('RM Code', sort=False)['Shortage (Kg)'].sum().reset_index()
+
+    if po_index is not None and len(po_index):
+        rm_codes = recs['RM Code'].to_numpy(dtype=object)
+        recs['On-Time PO (Kg)'] = po_index.arriving_by(rm_codes, need_by)
+        recs['Late PO (Kg)'] = np.clip(po_index.open_quantity(rm_codes) - recs['On-Time PO (Kg)'].to_numpy(), 0, None)
+        recs['Next Late Arrival'] = po_index.next_arrival_after(rm_codes, need_by)
+    else:
+        recs['On-Time PO (Kg)'] = 0.0
+        recs['Late PO (Kg)'] = 0.0
+        recs['Next Late Arrival'] = pd.NaT
+
+    terms = supplier_terms.set_index('RM Code') if supplier_terms is not None and not supplier_terms.empty else None
+    for name, default in defaults.items():
+        values = terms[name].reindex(recs['RM Code']).to_numpy(dtype=float) if terms is not None else np.nan
+        recs[name] = pd.Series(values, index=recs.index, dtype=float).fillna(default)
+
+    shortage = recs['Shortage (Kg)'].to_numpy(dtype=float)
+    net = np.clip(shortage - recs['On-Time PO (Kg)'].to_numpy(), 0, None)
+    expedite = np.minimum(net, recs['Late PO (Kg)'].to_numpy())
+    to_buy = net - expedite
+
+    lot = recs['Lot Size (Kg)'].to_numpy()
+    rounded = np.where(lot > 0, np.ceil(np.round(to_buy / np.where(lot > 0, lot, 1), 9)) * lot, to_buy)
+    order_qty = np.where(to_buy > 0, np.maximum(rounded, recs['MOQ (Kg)'].to_numpy()), 0.0)
+
+    order_by = need_by - pd.to_timedelta(recs['Lead Time (days)'].to_numpy(), unit='D')
+    slack = (order_by - today).days.to_numpy()
+    recs['Net Requirement (Kg)'] = net
+    recs['Expedite (Kg)'] = expedite
+    recs['Suggested Order (Kg)'] = order_qty
+    recs['Need By'] = need_by
+    recs['Order By'] = order_by
+    recs['Slack (days)'] = np.where(to_buy > 0, slack, 0)
+
+    ordering = order_qty > 0
+    expediting = expedite > 0
+    recs['Priority'] = np.select(
+        [ordering & (slack < 0), ordering & (slack <= 7), ordering, expediting],
+        ['High', 'Medium', 'Low', 'High'],
+        default='Covered'
+    )
+
+    rm = recs['RM Code']
+    order_text = ('Order ' + pd.Series(order_qty, index=recs.index).map('{:,.4f}'.format) + ' Kg of ' + rm
+                  + ' by ' + recs['Order By'].dt.strftime('%Y-%m-%d'))
+    expedite_text = ('Expedite open PO for ' + pd.Series(expedite, index=recs.index).map('{:,.4f}'.format)
+                     + ' Kg of ' + rm + ' (arrives ' + recs['Next Late Arrival'].dt.strftime('%Y-%m-%d').fillna('')
+                     + ', needed ' + need_by.strftime('%Y-%m-%d') + ')')
+    recs['Action Required'] = np.select(
+        [ordering & expediting, ordering, expediting],
+        [order_text + '; ' + expedite_text, order_text, expedite_text],
+        default='Covered by open POs arriving by ' + need_by.strftime('%Y-%m-%d')
+    )
+
+    columns = ['RM Code', 'Shortage (Kg)', 'On-Time PO (Kg)', 'Late PO (Kg)', 'Net Requirement (Kg)',
+               'Expedite (Kg)', 'Suggested Order (Kg)', 'MOQ (Kg)', 'Lot Size (Kg)', 'Lead Time (days)',
+               'Need By', 'Order By', 'Slack (days)', 'Priority', 'Action Required']
+    rank = recs['Priority'].map({'High': 0, 'Medium': 1, 'Low': 2, 'Covered': 3})
+    return recs.assign(_rank=rank).sort_values(['_rank', 'Order By', 'RM Code'], kind='stable')[columns].reset_index(drop=True)
+
+
+# --- Plan diff ---
+# Two saved runs are compared table by table on their keys (FG; FG and RM;
+# RM and location). Both sides are aligned once on the union of the keys with
+# index lookups, and every delta is a column-wise operation on the aligned arrays.
+
+def _align_runs(old, new, keys, values):
+    """Union of the keys of ``old`` and ``new`` with each side's ``values`` aligned to it (NaN where absent)"""
+    old_keys = pd.MultiIndex.from_frame(old[keys])
+    new_keys = pd.MultiIndex.from_frame(new[keys])
+    union = old_keys.union(new_keys, sort=False)
+    aligned = union.to_frame(index=False)
+    old_pos, new_pos = old_keys.get_indexer(union), new_keys.get_indexer(union)
+    for column in values:
+        for suffix, frame, pos in ((' (old)', old, old_pos), (' (new)', new, new_pos)):
+            source = frame[column].to_numpy(dtype=float)
+            aligned[column + suffix] = np.where(pos >= 0, source[np.maximum(pos, 0)] if len(source) else np.nan, np.nan)
+    return aligned, old_pos >= 0, new_pos >= 0
+
+
+def diff_plans(old, new, decimal_places=3):
+    """What changed between two runs' typed plan tables (``results``, ``shortages``, ``residual_stock``).
+
+    Returns ``{'fgs', 'shortages', 'stock'}``, each holding only the changed
+    keys: batch and output deltas per FG with its status change, new, cleared
+    and changed shortages per (FG, RM), and stock / drawn / residual movements
+    per (RM, location).
+    """
+    fgs, in_old, in_new = _align_runs(old['results'], new['results'], ['FG Code'],
+                                      ['Batches', 'Actual (Kg)', 'Ready'])
+    ready_old, ready_new = fgs.pop('Ready (old)').to_numpy(), fgs.pop('Ready (new)').to_numpy()
+    fgs['Δ Batches'] = np.nan_to_num(fgs['Batches (new)']) - np.nan_to_num(fgs['Batches (old)'])
+    fgs['Δ Actual (Kg)'] = np.nan_to_num(fgs['Actual (Kg) (new)']) - np.nan_to_num(fgs['Actual (Kg) (old)'])
+    fgs['Change'] = np.select(
+        [~in_old, ~in_new, (ready_old == 0) & (ready_new == 1), (ready_old == 1) & (ready_new == 0),
+         fgs['Δ Batches'] != 0],
+        ['Added to plan', 'Removed from plan', 'Now ready', 'Now short', 'Batches changed'],
+        default=''
+    )
+    fgs = fgs[fgs['Change'] != ''].reset_index(drop=True)
+
+    shortages, short_old, short_new = _align_runs(old['shortages'], new['shortages'], ['FG Code', 'RM Code'],
+                                                  ['Shortage (Kg)'])
+    shortages['Δ Shortage (Kg)'] = np.round(np.nan_to_num(shortages['Shortage (Kg) (new)'])
+                                            - np.nan_to_num(shortages['Shortage (Kg) (old)']), decimal_places)
+    shortages['Change'] = np.select(
+        [~short_old, ~short_new, shortages['Δ Shortage (Kg)'] != 0],
+        ['New shortage', 'Cleared', 'Changed'],
+        default=''
+    )
+    shortages = shortages[shortages['Change'] != ''].reset_index(drop=True)
+
+    stock, _, _ = _align_runs(old['residual_stock'], new['residual_stock'], ['RM Code', 'Location'],
+                              ['Stock (Kg)', 'Drawn (Kg)', 'Residual (Kg)'])
+    moved = np.zeros(len(stock), dtype=bool)
+    for column in ('Stock (Kg)', 'Drawn (Kg)', 'Residual (Kg)'):
+        delta = np.round(np.nan_to_num(stock[column + ' (new)']) - np.nan_to_num(stock[column + ' (old)']),
+                         decimal_places)
+        stock['Δ ' + column] = delta
+        moved |= delta != 0
+    stock = stock[moved].reset_index(drop=True)
+
+    return {'fgs': fgs, 'shortages': shortages, 'stock': stock}
@@ -0,0 +1,296 @@
+"""Concurrent-session load test for the MRP dashboard.
+
+Drives RGI.py headlessly with Streamlit's AppTest. For every session count N,
+N sessions run side by side and click Generate at the same moment. Each
+session uploads synthetic stock, PO and formula files, selects all FGs,
+generates the analysis, edits capacities and clicks the export downloads.
+Every rerun is timed; the report gives p50/p95/p99 rerun latency plus the
+memory each session adds, for each session count.
+
+    python mrp_loadtest.py --sessions 1 4 8 --fgs 200 --rms 400
+
+Like a server, all sessions run on threads of one process against one shared
+runtime: the same caches, the same analysis executor and the same GIL.
+AppTest installs a mocked runtime of its own for every rerun and drops it
+afterwards, so share_runtime() pins a single one for the whole test. What is
+not measured is the server's own work (websockets, protobuf delivery to a
+browser), so the latencies are those of the script reruns. Per-session
+memory is the growth of the process during the round divided by the number
+of sessions. Uploads need a Streamlit whose AppTest supports
+``file_uploader``.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+from streamlit import config
+from streamlit.components.v2.component_manager import BidiComponentManager
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test
+from streamlit.testing.v1.util import build_mock_config_get_option
+
+from mrp_engine import estimate_nbytes
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RGI.py")
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+DOWNLOAD_KEYS = ("pdf_html_download", "shortage_excel_download", "results_excel_download",
+                 "all_missing_download", "production_report_download")
+
+
+def synthetic_uploads(n_fg, n_rm, lines_per_fg=6, seed=0):
+    """Stock, PO and formula workbooks (xlsx bytes) with some RMs short"""
+    rng = np.random.default_rng(seed)
+    rm_codes = np.array([f"RM{i:05d}" for i in range(n_rm)])
+    stock = pd.DataFrame({
+        'RM Code': rm_codes,
+        'Quantity': np.round(rng.uniform(0, 2000, n_rm), 3),
+    })
+    po_rms = rng.choice(rm_codes, size=max(1, n_rm // 3), replace=False)
+    po = pd.DataFrame({
+        'RM Code': po_rms,
+        'Quantity': np.round(rng.uniform(50, 500, len(po_rms)), 3),
+        'Arrival Date': (pd.Timestamp.now().normalize()
+                         + pd.to_timedelta(rng.integers(-10, 60, len(po_rms)), unit='D')).strftime('%d/%m/%Y'),
+    })
+    lines = min(lines_per_fg, n_rm)
+    formulas = pd.DataFrame({
+        'FG Code': np.repeat([f"FG{i:04d}" for i in range(n_fg)], lines),
+        'RM Code': np.concatenate([rng.choice(rm_codes, size=lines, replace=False) for _ in range(n_fg)]),
+        'Quantity': np.round(rng.uniform(0.5, 20, n_fg * lines), 4),
+    })
+
+    def to_xlsx(df):
+        output = io.BytesIO()
+        df.to_excel(output, index=False)
+        return output.getvalue()
+
+    return {'stock': to_xlsx(stock), 'po': to_xlsx(po), 'formulas': to_xlsx(formulas)}
+
+
+def process_rss_mb():
+    """Resident memory of this process in MB (0 where /proc is not available)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+_shared_bytecode = {}
+_compile_lock = threading.Lock()
+_compile_script = ScriptCache.get_bytecode
+
+
+def _get_shared_bytecode(script_cache, script_path):
+    with _compile_lock:
+        if script_path not in _shared_bytecode:
+            _shared_bytecode[script_path] = _compile_script(script_cache, script_path)
+        return _shared_bytecode[script_path]
+
+
+def share_script_cache():
+    """Compile the app once for all sessions, as a server does.
+
+    AppTest compiles the script into a fresh cache on every rerun, which
+    would add compile time to every measured rerun that a server doesn't pay.
+    """
+    ScriptCache.get_bytecode = _get_shared_bytecode
+
+
+def share_runtime():
+    """Run every session against one runtime, as the sessions of a server do.
+
+    AppTest sets ``Runtime._instance`` to a fresh mock at the start of every
+    rerun and back to None at its end, and patches the config for the length
+    of the rerun. On parallel threads those would clobber each other, so the
+    runtime and the config patch are installed once, here, for the process.
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    component_manager = BidiComponentManager()
+    component_manager.discover_and_register_components(start_file_watching=False)
+    runtime.bidi_component_registry = component_manager
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    patch.object(config, "get_option", build_mock_config_get_option({"global.appTest": True})).start()
+    app_test.patch_config_options = lambda overrides: contextlib.nullcontext()
+
+
+class SessionDriver:
+    """One simulated user working through the dashboard; records the latency of every rerun"""
+
+    def __init__(self, session_id, uploads, app_path=APP_PATH, timeout=600, capacity_edits=5):
+        self.session_id = session_id
+        self.uploads = uploads
+        self.app_path = app_path
+        self.timeout = timeout
+        self.capacity_edits = capacity_edits
+        self.timings = []
+        self.errors = []
+        self.at = None
+
+    def _timed(self, step, action):
+        started = time.perf_counter()
+        action()
+        self.timings.append((step, (time.perf_counter() - started) * 1000))
+        self.errors.extend(f"{step}: {e.value}" for e in self.at.exception)
+
+    def _upload(self, key, name, content, multiple=False):
+        files = [(name, content, EXCEL_MIME)] if multiple else (name, content, EXCEL_MIME)
+        self.at.file_uploader(key=key).set_value(files).run()
+
+    def _wait_for_analysis(self):
+        # The plan view blocks on the job; a rerun cut short by the timeout just polls again
+        deadline = time.perf_counter() + self.timeout
+        while self.at.session_state['analysis_job'] is not None and time.perf_counter() < deadline:
+            time.sleep(0.1)
+            self.at.run()
+
+    def run(self, start_barrier=None):
+        self.at = AppTest.from_file(self.app_path, default_timeout=self.timeout)
+        self._timed('initial load', self.at.run)
+        self._timed('upload stock', lambda: self._upload('rm_up', 'stock.xlsx', self.uploads['stock']))
+        self._timed('upload PO', lambda: self._upload('po_up', 'po.xlsx', self.uploads['po']))
+        self._timed('upload formulas', lambda: self._upload('fg_uploader', 'formulas.xlsx', self.uploads['formulas'],
+                                                            multiple=True))
+        self._timed('select all FGs', lambda: self.at.button(key='select_all_fg_button').click().run())
+
+        # Everyone clicks Generate at the same moment
+        if start_barrier is not None:
+            start_barrier.wait()
+        self._timed('generate analysis', lambda: (self.at.button(key='generate_analysis').click().run(),
+                                                  self._wait_for_analysis()))
+
+        capacity_inputs = [n for n in self.at.number_input if n.key and n.key.startswith('exp_cap_')]
+        for number_input in capacity_inputs[:self.capacity_edits]:
+            number_input.set_value(100.0)
+        apply = [b for b in self.at.button if b.label == "✅ Apply Capacities"]
+        if apply:
+            self._timed('apply capacities', lambda: (apply[0].click().run(), self._wait_for_analysis()))
+
+        for key in DOWNLOAD_KEYS:
+            buttons = [b for b in self.at.get('download_button') if b.key == key]
+            if buttons:
+                self._timed(f"download {key}", lambda: buttons[0].click().run())
+        return self
+
+    def session_state_mb(self):
+        return estimate_nbytes(self.at.session_state.to_dict()) / 1024 ** 2
+
+
+def _run_session(driver, barrier):
+    """Thread entry point: drive one session, recording a failure instead of raising it"""
+    try:
+        driver.run(barrier)
+    except threading.BrokenBarrierError:
+        driver.errors.append("another session failed before Generate")
+    except Exception as e:
+        # Release the sessions waiting for this one at the barrier
+        barrier.abort()
+        driver.errors.append(f"{type(e).__name__}: {e}")
+    return driver
+
+
+def run_load(n_sessions, uploads, app_path=APP_PATH, timeout=600, capacity_edits=5):
+    """Run ``n_sessions`` concurrent sessions; returns (timings DataFrame, memory dict, errors)"""
+    barrier = threading.Barrier(n_sessions)
+    drivers = [SessionDriver(i, uploads, app_path, timeout, capacity_edits) for i in range(n_sessions)]
+
+    rss_idle = process_rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions, thread_name_prefix="mrp-session") as pool:
+        drivers = list(pool.map(lambda driver: _run_session(driver, barrier), drivers))
+    wall_seconds = time.perf_counter() - started
+    rss = process_rss_mb()
+
+    timings = pd.DataFrame(
+        [(driver.session_id, step, ms) for driver in drivers for step, ms in driver.timings],
+        columns=['Session', 'Step', 'Latency (ms)']
+    )
+    errors = [f"session {driver.session_id}: {error}" for driver in drivers for error in driver.errors]
+    memory = {
+        'Process RSS (MB)': rss,
+        'RSS per Session (MB)': (rss - rss_idle) / n_sessions,
+        'Session State (MB)': float(np.mean([driver.session_state_mb() for driver in drivers if driver.at is not None]
+                                            or [0.0])),
+        'Wall Time (s)': wall_seconds,
+    }
+    return timings, memory, errors
+
+
+def summarize(n_sessions, timings, memory):
+    """One report row: latency percentiles over every rerun of the round, and its memory"""
+    latency = timings['Latency (ms)'].to_numpy()
+    generate = timings.loc[timings['Step'] == 'generate analysis', 'Latency (ms)'].to_numpy()
+    p50, p95, p99 = np.percentile(latency, [50, 95, 99]) if len(latency) else (np.nan,) * 3
+    return {
+        'Sessions': n_sessions,
+        'Reruns': len(latency),
+        'p50 (ms)': p50,
+        'p95 (ms)': p95,
+        'p99 (ms)': p99,
+        'Max (ms)': latency.max() if len(latency) else np.nan,
+        'Generate p95 (ms)': np.percentile(generate, 95) if len(generate) else np.nan,
+        **memory,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="session counts to run, one round each")
+    parser.add_argument('--fgs', type=int, default=100, help="FGs in the synthetic formulas")
+    parser.add_argument('--rms', type=int, default=300, help="RMs in the synthetic stock")
+    parser.add_argument('--lines', type=int, default=6, help="formula lines per FG")
+    parser.add_argument('--capacity-edits', type=int, default=5, help="capacities each session edits")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds a single rerun may take")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--app', default=APP_PATH, help="dashboard script to drive")
+    parser.add_argument('--csv', help="also write every timed rerun to this CSV file")
+    args = parser.parse_args(argv)
+
+    share_script_cache()
+    share_runtime()
+    uploads = synthetic_uploads(args.fgs, args.rms, args.lines, args.seed)
+    rows = []
+    all_timings = []
+    for n_sessions in args.sessions:
+        print(f"Running {n_sessions} concurrent session(s)...", file=sys.stderr)
+        timings, memory, errors = run_load(n_sessions, uploads, args.app, args.timeout, args.capacity_edits)
+        for error in errors[:10]:
+            print(f"  ! {error}", file=sys.stderr)
+        rows.append(summarize(n_sessions, timings, memory))
+        all_timings.append(timings.assign(Sessions=n_sessions))
+
+    report = pd.DataFrame(rows)
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:,.1f}'.format):
+        print(report.to_string(index=False))
+    print("Latencies are script reruns of AppTest sessions on threads of one process sharing its runtime and "
+          "analysis executor; websocket delivery and browser rendering are not included.")
+
+    if args.csv:
+        pd.concat(all_timings, ignore_index=True).to_csv(args.csv, index=False)
+    return report
+
+
+if __name__ == '__main__':
+    main()
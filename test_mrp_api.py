@@ -0,0 +1,111 @@
+"""Tests for the planning API, driven in-process through ``LocalPlanningClient``.
+
+    python -m pytest test_mrp_api.py      (or: python -m unittest test_mrp_api)
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from mrp_api import APIError, LocalPlanningClient, PlanningModel, PlanningService
+from mrp_engine import BATCH_SIZE_KG, compute_production_plan
+
+
+def synthetic_model(n_fg=40, n_rm=80, lines_per_fg=5, seed=0):
+    """A model with some RMs out of stock, some zero-quantity formula lines and POs either side of today"""
+    rng = np.random.default_rng(seed)
+    rm_codes = np.array([f"RM{i:04d}" for i in range(n_rm)])
+    stock = pd.DataFrame({'RM Code': rm_codes, 'Quantity': np.round(rng.uniform(0, 400, n_rm), 3)})
+    stock = stock[np.arange(n_rm) % 11 != 3].reset_index(drop=True)
+
+    formulas = pd.DataFrame({
+        'FG Code': np.repeat([f"FG{i:03d}" for i in range(n_fg)], lines_per_fg),
+        'RM Code': np.concatenate([rng.choice(rm_codes, lines_per_fg, replace=False) for _ in range(n_fg)]),
+        'Quantity': np.round(rng.uniform(0.5, 20, n_fg * lines_per_fg), 4),
+    })
+    formulas.loc[formulas.index % 23 == 7, 'Quantity'] = 0.0
+
+    po_rms = rm_codes[::3]
+    po = pd.DataFrame({
+        'RM Code': po_rms,
+        'Location': 'Main',
+        'Quantity': 100.0,
+        'Arrival Date': pd.Timestamp.now().normalize() + pd.to_timedelta(np.where(np.arange(len(po_rms)) % 2, 30, -5),
+                                                                         unit='D'),
+    })
+    return PlanningModel(stock, po, formulas, decimal_places=3)
+
+
+class LocalPlanningClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = synthetic_model()
+        self.service = PlanningService(self.model)
+        self.client = LocalPlanningClient(self.service)
+        self.fg_codes = list(self.model.matrix.fg_codes)
+
+    def test_feasibility_matches_single_fg_plans(self):
+        dates = [None, (pd.Timestamp.now() + pd.Timedelta(days=60)).strftime('%Y-%m-%d')]
+        cases = [(fg, kg, when) for fg in self.fg_codes for kg in (50, 300) for when in dates]
+        results = self.client.feasibility([{'fg': fg, 'kg': kg, 'date': when} for fg, kg, when in cases])
+        self.assertEqual(len(results), 160)
+
+        for (fg, kg, when), result in zip(cases, results):
+            with self.subTest(fg=fg, kg=kg, date=when):
+                stock = self.model.pooled if when is None else self.model.stock_by(pd.Timestamp(when))
+                sized, _ = compute_production_plan(stock, self.model.fg_formulas, [fg], {fg: float(kg)}, 3)
+                unbounded, _ = compute_production_plan(stock, self.model.fg_formulas, [fg], {}, 3)
+                self.assertEqual(result['feasible'], sized[0]['Batches'] == kg // BATCH_SIZE_KG)
+                self.assertEqual(result['max_batches'], unbounded[0]['Batches'])
+
+    def test_unknown_fg_is_reported_per_request(self):
+        results = self.client.feasibility([{'fg': 'NOPE', 'kg': 25}, {'fg': self.fg_codes[0], 'kg': 25}])
+        self.assertEqual(results[0]['error'], "Unknown FG code")
+        self.assertIn('feasible', results[1])
+
+    def test_refresh_stock_bumps_model_version(self):
+        rm = self.model.pooled['RM Code'].iloc[0]
+        before = self.model.pooled.set_index('RM Code')['Quantity'][rm]
+
+        reply = self.client.refresh_stock([{'RM Code': rm, 'Quantity': 10.0}], mode='delta')
+        self.assertEqual(reply['model_version'], 2)
+        self.assertAlmostEqual(self.service.model.pooled.set_index('RM Code')['Quantity'][rm], before + 10.0)
+
+        reply = self.client.refresh_stock([{'RM Code': rm, 'Quantity': 5.0}], mode='replace')
+        self.assertEqual(reply['model_version'], 3)
+        self.assertEqual(reply['rows'], 1)
+        self.assertEqual(self.client.health()['model_version'], 3)
+        self.assertEqual(self.client.health()['rms'], 1)
+
+    def test_malformed_requests_are_rejected(self):
+        fg = self.fg_codes[0]
+        bad = [
+            ('/feasibility', [1, 2]),
+            ('/feasibility', "requests"),
+            ('/feasibility', {'requests': {'fg': fg}}),
+            ('/feasibility', {'requests': [[fg, 25]]}),
+            ('/feasibility', {'requests': [{'fg': fg}]}),
+            ('/feasibility', {'requests': [{'fg': fg, 'kg': 'lots'}]}),
+            ('/plan', {'requests': [{'fg_order': [fg], 'capacities': [1]}]}),
+            ('/plan', {'requests': [{'fg_order': [fg], 'weights': [1]}]}),
+            ('/plan', {'requests': [{'fg_order': ['NOPE']}]}),
+            ('/plan', {'requests': [{'fg_order': [fg], 'policy': 'lottery'}]}),
+            ('/stock', {'rows': []}),
+            ('/stock', {'rows': [{'RM Code': 'RM0001', 'Quantity': 1.0}], 'mode': 'merge'}),
+        ]
+        for path, payload in bad:
+            with self.subTest(path=path, payload=payload):
+                with self.assertRaises(APIError) as raised:
+                    self.client._call('POST', path, payload)
+                self.assertEqual(raised.exception.status, 400)
+        self.assertEqual(self.client.health()['model_version'], 1)
+
+    def test_unexpected_errors_reply_500(self):
+        self.service.plan = lambda payload: 1 / 0
+        status, body = self.service.handle('POST', '/plan', {'requests': []})
+        self.assertEqual(status, 500)
+        self.assertIn('ZeroDivisionError', body['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()